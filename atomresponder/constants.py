@@ -17,3 +17,12 @@ MESSAGE_TYPE_MEDIA = "video-upload"
 MESSAGE_TYPE_PAC = "pac-file-upload"
 MESSAGE_TYPE_RESYNC_MEDIA = "video-upload-resync"
 MESSAGE_TYPE_PROJECT_ASSIGNED = "project-assigned"
+
+#ways of getting the media into Vidispine, see ATOM_RESPONDER_INGEST_STRATEGY in settings.py
+INGEST_STRATEGY_PRESIGNED = "presigned"
+INGEST_STRATEGY_DOWNLOAD = "download"
+INGEST_STRATEGY_AUTO = "auto"
+
+#ways of looking up an item in Vidispine, see ATOM_RESPONDER_ITEM_LOOKUP in settings.py
+ITEM_LOOKUP_FULL = "full"
+ITEM_LOOKUP_FIELDS = "fields"
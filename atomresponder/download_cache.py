@@ -0,0 +1,193 @@
+from threading import Lock
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadCache(object):
+    """
+    Content-addressed cache of media that we have downloaded from S3.  Each entry is a hard link to a downloaded file,
+    named after a hash of its bucket, key and ETag, so a repeat of a message for an object that has not changed (a resync,
+    a resend after a failed import, or the same key uploaded again) can be linked into place instead of being downloaded
+    again, and a changed object never matches an old entry.
+    The cache must be on the same filesystem as the download path for the links to work.  Entries are evicted least
+    recently used first once the cache holds more than max_bytes.
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def entry_name(bucket, key, etag):
+        return hashlib.sha256("{0}/{1}/{2}".format(bucket, key, etag.strip('"')).encode("UTF-8")).hexdigest()
+
+    def entry_path(self, bucket, key, etag):
+        return os.path.join(self.root, self.entry_name(bucket, key, etag))
+
+    def lookup(self, bucket, key, etag, size=None):
+        """
+        Finds the cached copy of an object
+        :param bucket: bucket name
+        :param key: object key
+        :param etag: ETag of the object, from a HEAD request
+        :param size: if given, an entry of any other size is ignored
+        :return: path to the cached file, or None
+        """
+        path = self.entry_path(bucket, key, etag)
+        try:
+            statinfo = os.stat(path)
+        except OSError:
+            self.misses += 1
+            return None
+        if size is not None and statinfo.st_size != size:
+            logger.warning("Cached copy of s3://{0}/{1} is {2} bytes, expected {3}; ignoring it".format(bucket, key, statinfo.st_size, size))
+            self.misses += 1
+            return None
+        #mark it as recently used
+        os.utime(path)
+        self.hits += 1
+        return path
+
+    def fetch(self, bucket, key, etag, dest_path, size=None):
+        """
+        Puts the cached copy of an object at dest_path, as a hard link if possible or a copy if not
+        :return: True if the object was in the cache, False if it needs downloading
+        """
+        cached = self.lookup(bucket, key, etag, size=size)
+        if cached is None:
+            return False
+        #dest_path may be a placeholder that reserves the name, so link alongside it and then swap it in
+        temp_path = "{0}.{1}.tmp".format(dest_path, uuid.uuid4().hex)
+        try:
+            try:
+                os.link(cached, temp_path)
+                os.replace(temp_path, dest_path)
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                logger.warning("Could not link {0} to {1} ({2}), copying instead".format(cached, dest_path, e))
+                shutil.copyfile(cached, dest_path)
+        except FileNotFoundError:
+            #another worker evicted the entry after we looked it up, so it will have to be downloaded after all
+            logger.info("{0} was evicted from the download cache before we could use it".format(cached))
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            self.hits -= 1
+            self.misses += 1
+            return False
+        return True
+
+    def store(self, bucket, key, etag, path):
+        """
+        Adds a downloaded file to the cache, then evicts old entries if the cache is over its size limit
+        :param path: the downloaded file. This is hard-linked into the cache, so it must be on the same filesystem.
+        :return: None
+        """
+        os.makedirs(self.root, exist_ok=True)
+        final_path = self.entry_path(bucket, key, etag)
+        temp_path = "{0}.{1}.tmp".format(final_path, uuid.uuid4().hex)
+        try:
+            os.link(path, temp_path)
+            os.replace(temp_path, final_path)
+        except OSError as e:
+            logger.warning("Could not add {0} to the download cache: {1}".format(path, e))
+            return
+        self.evict()
+
+    def _entries(self):
+        """
+        :return: list of (mtime, size, link count, path) for every entry, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            path = os.path.join(self.root, name)
+            try:
+                statinfo = os.stat(path)
+            except OSError:
+                continue
+            entries.append((statinfo.st_mtime, statinfo.st_size, statinfo.st_nlink, path))
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no bigger than max_bytes
+        :return: number of bytes removed
+        """
+        with self._lock:
+            entries = self._entries()
+            total = sum([entry[1] for entry in entries])
+            removed = 0
+            for mtime, size, nlink, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    logger.warning("Could not evict {0} from the download cache: {1}".format(path, e))
+                    continue
+                total -= size
+                removed += size
+            if removed > 0:
+                logger.info("Evicted {0} bytes from the download cache, {1} bytes remain".format(removed, total))
+            return removed
+
+    def free_space(self, bytes_needed):
+        """
+        Removes the least recently used entries until bytes_needed have actually been freed on disk. An entry that is
+        still linked to a download takes up no space of its own, so it is left alone.
+        :return: number of bytes freed
+        """
+        with self._lock:
+            freed = 0
+            for mtime, size, nlink, path in self._entries():
+                if freed >= bytes_needed:
+                    break
+                if nlink > 1:
+                    continue
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    logger.warning("Could not evict {0} from the download cache: {1}".format(path, e))
+                    continue
+                freed += size
+            if freed > 0:
+                logger.info("Evicted {0} bytes from the download cache to free up space".format(freed))
+            return freed
+
+
+_caches = {}
+_caches_lock = Lock()
+
+
+def get_download_cache(root, max_bytes):
+    """
+    Returns the shared DownloadCache for the given directory, creating it if necessary
+    """
+    with _caches_lock:
+        if root not in _caches:
+            _caches[root] = DownloadCache(root, max_bytes)
+        _caches[root].max_bytes = max_bytes
+        return _caches[root]
+
+
+def get_configured_download_cache():
+    """
+    Returns the shared download cache from the settings, or None if ATOM_RESPONDER_DOWNLOAD_CACHE_MAX_BYTES is 0
+    """
+    from django.conf import settings
+    max_bytes = getattr(settings, "ATOM_RESPONDER_DOWNLOAD_CACHE_MAX_BYTES", 0)
+    if max_bytes <= 0:
+        return None
+    root = getattr(settings, "ATOM_RESPONDER_DOWNLOAD_CACHE_PATH", None)
+    if root is None:
+        root = os.path.join(settings.ATOM_RESPONDER_DOWNLOAD_PATH, ".cache")
+    return get_download_cache(root, max_bytes)
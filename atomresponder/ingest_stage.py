@@ -0,0 +1,205 @@
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from kinesisresponder.ordered_executor import OrderedKeyExecutor
+from datetime import timedelta
+from threading import Lock, Thread
+from time import sleep
+import logging
+import os
+import socket
+import traceback
+import uuid
+
+logger = logging.getLogger(__name__)
+
+#identifies this process, so that rows left RUNNING by an earlier process can be told apart from our own
+worker_id = "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class IngestStage(object):
+    """
+    Runs the slow part of a media ingest (the download, import request and RabbitMQ update) on a bounded pool of worker
+    threads that is shared by every shard in the process, so that one slow download doesn't hold up the other messages
+    on its shard.
+    The shard reader writes a StagedIngest row and calls hand_off() before it returns from process(), so the
+    checkpoint only moves past a record once its work is safely in the database.  hand_off() blocks while the workers
+    and the queue are full, which holds up the shard reader until there is room.
+    Ingests for the same atom run one at a time in the order that they were handed off.  A row is deleted once its
+    ingest has been started; if that fails the row is left as FAILED and is tried again after retry_delay seconds,
+    doubling on each attempt, until it has been tried max_attempts times.
+    While an ingest is RUNNING its owner keeps touching updated_at.  Another process only takes a RUNNING row over once
+    that has gone stale_after seconds without an update, so an ingest that is still going on in a live process (e.g.
+    one that has just lost the lease on its shard) isn't started twice.
+    recover() is called when a shard starts up and picks up PENDING rows as well as those above; once start() has been
+    called the stage also sweeps the shards that it has recovered every sweep_interval seconds.
+    """
+    def __init__(self, worker_count=2, queue_size=4, stale_after=600, max_attempts=5, retry_delay=60, sweep_interval=60):
+        self.worker_count = worker_count
+        self.queue_size = queue_size
+        self.stale_after = timedelta(seconds=stale_after)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.sweep_interval = sweep_interval
+        self._executor = OrderedKeyExecutor(worker_count, max_in_flight=worker_count + queue_size,
+                                            thread_name_prefix="ingest", ordered_callbacks=False)
+        self._shards = {}   #(stream name, shard ID) -> ingest callable, for the sweep
+        self._lock = Lock()
+        self._started = False
+
+    @property
+    def in_flight(self):
+        return self._executor.in_flight
+
+    def hand_off(self, staged, fn):
+        """
+        Queues up a staged ingest, blocking if the stage is full
+        :param staged: saved StagedIngest instance
+        :param fn: callable that carries out the ingest. It is passed the StagedIngest on a worker thread.
+        :return: None
+        """
+        self._executor.submit(staged.atom_id, lambda: self.run(staged.pk, fn), lambda result: None)
+
+    def run(self, pk, fn):
+        """
+        Claims a staged ingest and carries it out
+        :return: True if it succeeded, False if it failed, None if it had already been claimed
+        """
+        from .models import StagedIngest
+        from kinesisresponder.sentry import inform_sentry_exception
+
+        #worker threads are long-lived, so make sure that they don't hang on to stale database connections
+        close_old_connections()
+        claimed = StagedIngest.objects.filter(pk=pk, status='PENDING').update(status='RUNNING', owner=worker_id,
+                                                                              updated_at=timezone.now())
+        if claimed == 0:
+            logger.info("Staged ingest {0} has already been dealt with".format(pk))
+            return None
+
+        staged = StagedIngest.objects.get(pk=pk)
+        staged.attempts += 1
+        staged.save()
+        try:
+            fn(staged)
+        except Exception as e:
+            logger.error("Staged ingest of {0} for atom {1} failed on attempt {2}: {3}".format(staged.s3_key, staged.atom_id,
+                                                                                            staged.attempts, e))
+            if staged.attempts >= self.max_attempts:
+                logger.error("Giving up on staged ingest of {0} for atom {1}".format(staged.s3_key, staged.atom_id))
+            staged.status = 'FAILED'
+            staged.last_error = traceback.format_exc()
+            staged.save()
+            inform_sentry_exception(extra_ctx={
+                "staged_ingest": staged.__dict__
+            })
+            return False
+        staged.delete()
+        return True
+
+    def retry_due(self, staged, now):
+        """
+        :return: True if a FAILED ingest should be tried again now
+        """
+        if staged.attempts >= self.max_attempts:
+            return False
+        return staged.updated_at + timedelta(seconds=self.retry_delay * 2**max(staged.attempts - 1, 0)) <= now
+
+    def recover(self, stream_name, shard_id, fn, include_pending=True):
+        """
+        Hands off again any ingests for the shard that were staged but never completed: PENDING rows, e.g. because the
+        process was restarted, RUNNING rows whose owner has stopped updating them, and FAILED rows that are due a retry
+        :param include_pending: set to False to leave PENDING rows alone, because they are already queued up
+        :return: number of ingests handed off
+        """
+        from .models import StagedIngest
+        with self._lock:
+            self._shards[(stream_name, shard_id)] = fn
+
+        now = timezone.now()
+        reclaimable = (Q(status='RUNNING') & ~Q(owner=worker_id) & Q(updated_at__lt=now - self.stale_after)) | \
+            Q(status='FAILED', attempts__lt=self.max_attempts)
+        if include_pending:
+            reclaimable = reclaimable | Q(status='PENDING')
+        candidates = StagedIngest.objects.filter(stream_name=stream_name, shard_id=shard_id).filter(reclaimable)
+
+        recovered = 0
+        for staged in candidates:
+            if staged.status == 'FAILED' and not self.retry_due(staged, now):
+                continue
+            if staged.status != 'PENDING':
+                #only if nobody else has changed it since we looked
+                reset = StagedIngest.objects.filter(pk=staged.pk, status=staged.status, updated_at=staged.updated_at)\
+                    .update(status='PENDING', updated_at=timezone.now())
+                if reset == 0:
+                    continue
+            logger.info("Recovering {0}".format(staged))
+            self.hand_off(staged, fn)
+            recovered += 1
+        return recovered
+
+    def heartbeat(self):
+        """
+        Marks every ingest that this process is running as still alive
+        :return: number of rows updated
+        """
+        from .models import StagedIngest
+        return StagedIngest.objects.filter(status='RUNNING', owner=worker_id).update(updated_at=timezone.now())
+
+    def sweep(self):
+        """
+        Retries failed and abandoned ingests on every shard that we have recovered
+        :return: number of ingests handed off
+        """
+        with self._lock:
+            shards = list(self._shards.items())
+        recovered = 0
+        for (stream_name, shard_id), fn in shards:
+            recovered += self.recover(stream_name, shard_id, fn, include_pending=False)
+        return recovered
+
+    def _every(self, interval, fn):
+        while True:
+            sleep(interval)
+            try:
+                close_old_connections()
+                fn()
+            except Exception as e:
+                logger.exception("Ingest stage {0} failed: ".format(fn.__name__), exc_info=e)
+
+    def start(self):
+        """
+        Starts the heartbeat and sweep threads, if they aren't already running
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        #heartbeats go out well within stale_after, so that a slow one doesn't let our rows be taken over
+        Thread(target=self._every, args=(self.stale_after.total_seconds()/5, self.heartbeat),
+               name="ingest-heartbeat", daemon=True).start()
+        #the sweep can block when the stage is full, so it has its own thread rather than holding up the heartbeat
+        Thread(target=self._every, args=(self.sweep_interval, self.sweep), name="ingest-sweep", daemon=True).start()
+
+    def wait_idle(self):
+        self._executor.wait_idle()
+
+
+_stages = {}
+_stages_lock = Lock()
+
+
+def get_ingest_stage():
+    """
+    Returns the process-wide IngestStage, configured from the settings
+    """
+    from django.conf import settings
+    with _stages_lock:
+        if "default" not in _stages:
+            _stages["default"] = IngestStage(worker_count=getattr(settings, "ATOM_RESPONDER_INGEST_WORKERS", 2),
+                                             queue_size=getattr(settings, "ATOM_RESPONDER_INGEST_QUEUE_SIZE", 4),
+                                             stale_after=getattr(settings, "ATOM_RESPONDER_INGEST_STALE_AFTER", 600),
+                                             max_attempts=getattr(settings, "ATOM_RESPONDER_INGEST_MAX_ATTEMPTS", 5),
+                                             retry_delay=getattr(settings, "ATOM_RESPONDER_INGEST_RETRY_DELAY", 60),
+                                             sweep_interval=getattr(settings, "ATOM_RESPONDER_INGEST_SWEEP_INTERVAL", 60))
+            _stages["default"].start()
+        return _stages["default"]
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from threading import Lock
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ItemMapping(object):
+    """
+    Maps atom IDs to the Vidispine IDs of their master items.  The mapping never changes once the item has been created,
+    so it is kept in the AtomItemMapping table, with a bounded LRU in front of it so that repeated messages for the same
+    atom don't even need a database query.
+    Entries are added when we create a placeholder or find an item in Vidispine, and removed when Vidispine tells us
+    that the item has been deleted.  That notification is handled by the rabbitmq responder, which is a different
+    process with its own memory, so an entry in memory is checked against the database again once it is verify_after
+    seconds old; if Vidispine tells us an item is gone before then, forget_atom() drops the mapping straight away.
+    """
+    def __init__(self, max_entries=10000, verify_after=60, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.verify_after = verify_after
+        self._clock = clock
+        #atom ID -> (item ID, when we last read it from the database)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache(self, atom_id, item_id):
+        with self._lock:
+            self._entries[atom_id] = (item_id, self._clock())
+            self._entries.move_to_end(atom_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, atom_id):
+        """
+        Looks up the master item for an atom, in memory first and then in the database.  An entry in memory that is
+        older than verify_after is read from the database again, in case another process has removed it.
+        :param atom_id: atom ID string
+        :return: Vidispine item ID, or None if we don't know it
+        """
+        from .models import AtomItemMapping
+        with self._lock:
+            entry = self._entries.get(atom_id)
+            if entry is not None and self._clock() - entry[1] < self.verify_after:
+                self._entries.move_to_end(atom_id)
+                self.hits += 1
+                return entry[0]
+
+        try:
+            item_id = AtomItemMapping.objects.get(atom_id=atom_id).item_id
+        except AtomItemMapping.DoesNotExist:
+            with self._lock:
+                self._entries.pop(atom_id, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache(atom_id, item_id)
+        return item_id
+
+    def remember(self, atom_id, item_id):
+        """
+        Records the master item for an atom
+        :param atom_id: atom ID string
+        :param item_id: Vidispine item ID
+        :return: None
+        """
+        from .models import AtomItemMapping
+        AtomItemMapping.objects.update_or_create(atom_id=atom_id, defaults={'item_id': item_id})
+        self._cache(atom_id, item_id)
+
+    def forget_item(self, item_id):
+        """
+        Removes every mapping to an item, e.g. because it has been deleted from Vidispine
+        :param item_id: Vidispine item ID
+        :return: number of atoms that were mapped to the item
+        """
+        from .models import AtomItemMapping
+        with self._lock:
+            for atom_id in [atom_id for atom_id, (mapped, checked_at) in self._entries.items() if mapped == item_id]:
+                del self._entries[atom_id]
+        removed, _ = AtomItemMapping.objects.filter(item_id=item_id).delete()
+        if removed > 0:
+            logger.info("Forgot {0} atom mapping(s) to deleted item {1}".format(removed, item_id))
+        return removed
+
+    def forget_atom(self, atom_id, item_id):
+        """
+        Removes the mapping for an atom if it still points to the given item, e.g. because Vidispine has told us that
+        the item no longer exists
+        :param atom_id: atom ID string
+        :param item_id: the Vidispine item ID that turned out to be missing
+        :return: True if a mapping was removed from the database
+        """
+        from .models import AtomItemMapping
+        with self._lock:
+            entry = self._entries.get(atom_id)
+            if entry is not None and entry[0] == item_id:
+                del self._entries[atom_id]
+        removed, _ = AtomItemMapping.objects.filter(atom_id=atom_id, item_id=item_id).delete()
+        if removed > 0:
+            logger.info("Forgot the mapping of atom {0} to missing item {1}".format(atom_id, item_id))
+        return removed > 0
+
+    def clear(self):
+        """
+        Empties the in-memory cache. The database table is left alone.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+_mappings = {}
+_mappings_lock = Lock()
+
+
+def get_item_mapping():
+    """
+    Returns the process-wide ItemMapping, configured from the settings
+    """
+    from django.conf import settings
+    with _mappings_lock:
+        if "default" not in _mappings:
+            _mappings["default"] = ItemMapping(max_entries=getattr(settings, "ATOM_RESPONDER_ITEM_MAPPING_CACHE_SIZE", 10000),
+                                               verify_after=getattr(settings, "ATOM_RESPONDER_ITEM_MAPPING_VERIFY_AFTER", 60))
+        return _mappings["default"]
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from atomresponder.s3_mixin import S3Mixin
+from time import perf_counter
+import os
+import shutil
+import tempfile
+import uuid
+
+
+def legacy_download_filename(directory, nameonly, extension):
+    """
+    The old allocation scheme, for comparison: probe name, name-1, name-2... in one flat directory until one is free
+    """
+    number_part = ""
+    n = 0
+    while True:
+        path = os.path.join(directory, nameonly + number_part + extension)
+        if not os.path.exists(path):
+            return path
+        n += 1
+        number_part = "-{0}".format(n)
+
+
+class Command(BaseCommand):
+    """
+    Times download filename allocation against a download directory that already holds a lot of files, many of them
+    with the same title, comparing the old flat probing scheme with get_download_filename.
+    """
+    help = "Benchmarks allocation of download filenames in a large download directory"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--files", type=int, default=200000, help="Number of files already in the download directory")
+        parser.add_argument("--same-title", type=int, default=2000, help="How many of those have the title that we allocate")
+        parser.add_argument("--allocations", type=int, default=1000, help="Number of filenames to allocate")
+        parser.add_argument("--path", type=str, default=None, help="Directory to work in. Defaults to a new temporary directory")
+
+    def populate_legacy(self, directory, options):
+        os.makedirs(directory)
+        for n in range(options["same_title"]):
+            open(os.path.join(directory, "my_video{0}.mp4".format("-{0}".format(n) if n > 0 else "")), "w").close()
+        for n in range(options["files"] - options["same_title"]):
+            open(os.path.join(directory, "{0}.mp4".format(uuid.uuid4().hex)), "w").close()
+
+    def populate_sharded(self, directory, options):
+        with self.settings_override(directory):
+            for n in range(options["same_title"]):
+                S3Mixin.get_download_filename("uploads/my_video.mp4", overridden_name="my video.mp4", atom_id=str(uuid.uuid4()))
+            for n in range(options["files"] - options["same_title"]):
+                S3Mixin.get_download_filename("uploads/{0}.mp4".format(uuid.uuid4().hex), atom_id=str(uuid.uuid4()))
+
+    @staticmethod
+    def settings_override(directory):
+        from django.test.utils import override_settings
+        return override_settings(ATOM_RESPONDER_DOWNLOAD_PATH=directory)
+
+    def handle(self, *args, **options):
+        root = options["path"] if options["path"] is not None else tempfile.mkdtemp()
+        legacy_dir = os.path.join(root, "legacy")
+        sharded_dir = os.path.join(root, "sharded")
+        try:
+            self.stdout.write("Populating {0} files, {1} with the same title...".format(options["files"], options["same_title"]))
+            self.populate_legacy(legacy_dir, options)
+            self.populate_sharded(sharded_dir, options)
+
+            start = perf_counter()
+            for n in range(options["allocations"]):
+                path = legacy_download_filename(legacy_dir, "my_video", ".mp4")
+                open(path, "w").close()
+            legacy_time = perf_counter() - start
+
+            start = perf_counter()
+            with self.settings_override(sharded_dir):
+                for n in range(options["allocations"]):
+                    S3Mixin.get_download_filename("uploads/my_video.mp4", overridden_name="my video.mp4", atom_id=str(uuid.uuid4()))
+            sharded_time = perf_counter() - start
+
+            largest = max([len(os.listdir(os.path.join(sharded_dir, name))) for name in os.listdir(sharded_dir)])
+            self.stdout.write("Flat directory with probing: {0:.3f}s, {1:.1f}us per file, {2} entries in one directory".format(
+                legacy_time, legacy_time*1e6/options["allocations"], len(os.listdir(legacy_dir))))
+            self.stdout.write("Sharded with exclusive create: {0:.3f}s, {1:.1f}us per file, at most {2} entries per directory".format(
+                sharded_time, sharded_time*1e6/options["allocations"], largest))
+        finally:
+            if options["path"] is None:
+                shutil.rmtree(root)
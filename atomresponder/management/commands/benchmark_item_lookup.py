@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from atomresponder.vs_mixin import VSMixin
+
+
+class Command(BaseCommand):
+    """
+    Compares the cost of looking items up in Vidispine with the whole metadata document, as populate() fetches it,
+    against fetching just VSMixin.lookup_fields.
+    """
+    help = "Benchmarks full and field-projected Vidispine item lookups"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="+", help="Atom IDs or Vidispine item IDs to look up")
+        parser.add_argument("--repeat", type=int, default=5, help="Number of times to look up each item")
+
+    def report(self, label, results):
+        count = len(results)
+        total_bytes = sum([result.bytes for result in results])
+        total_seconds = sum([result.seconds for result in results])
+        self.stdout.write("{0}: {1} lookups, {2:.0f} bytes and {3:.1f}ms per lookup".format(
+            label, count, total_bytes/count, total_seconds*1000/count))
+        return total_bytes, total_seconds
+
+    def handle(self, *args, **options):
+        full = []
+        projected = []
+        for item_id in options["ids"]:
+            for n in range(options["repeat"]):
+                #alternate between the two so that neither gets the benefit of a warm cache on the server
+                full_result = VSMixin.fetch_item_fields(item_id)
+                projected_result = VSMixin.fetch_item_fields(item_id, VSMixin.lookup_fields)
+                if full_result is None or projected_result is None:
+                    self.stderr.write("{0} does not exist, skipping".format(item_id))
+                    break
+                full.append(full_result)
+                projected.append(projected_result)
+
+        if len(full) == 0:
+            self.stderr.write("Nothing was looked up")
+            return
+        full_bytes, full_seconds = self.report("Full metadata", full)
+        projected_bytes, projected_seconds = self.report("Fields {0}".format(",".join(VSMixin.lookup_fields)), projected)
+        self.stdout.write("Field projection transfers {0:.1%} of the bytes in {1:.1%} of the time".format(
+            projected_bytes/full_bytes, projected_seconds/full_seconds if full_seconds > 0 else 0))
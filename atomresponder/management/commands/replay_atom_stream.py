@@ -0,0 +1,154 @@
+# coding: utf-8
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.utils.dateparse import parse_datetime
+from kinesisresponder.management.kinesis_responder_basecommand import KinesisResponderBaseCommand
+from kinesisresponder.kinesis_responder import AT_TIMESTAMP, AT_SEQUENCE_NUMBER
+from kinesisresponder.metrics import ShardMetrics
+from kinesisresponder.rate_limiter import TokenBucket
+from kinesisresponder.replay import ShardReplayer
+from datetime import datetime
+import atomresponder.constants as const
+import json
+import jsonschema
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def classify_record(data):
+    """
+    Works out what the responder would do with a message, without doing it
+    :param data: record content string from the stream
+    :return: short string describing the message
+    """
+    from atomresponder.message_schema import validate_message
+    from atomresponder.models import ImportJob
+
+    try:
+        content = json.loads(data)
+    except ValueError:
+        return "invalid_json"
+    try:
+        validate_message(content)
+    except (ValueError, jsonschema.ValidationError):
+        return "invalid"
+
+    if content['type'] in (const.MESSAGE_TYPE_MEDIA, const.MESSAGE_TYPE_RESYNC_MEDIA):
+        jobs = ImportJob.objects.filter(atom_id=content['atomId'], s3_path=content['s3Key'])
+        if jobs.filter(status='FINISHED').exists():
+            return "{0}:already_imported".format(content['type'])
+        if jobs.filter(processing=True).exists():
+            return "{0}:in_progress".format(content['type'])
+        return "{0}:new".format(content['type'])
+    return content['type']
+
+
+class Command(KinesisResponderBaseCommand):
+    help = "Re-runs a window of the incoming atom stream through the responder, without touching the live checkpoints"
+
+    stream_name = settings.INCOMING_KINESIS_STREAM
+    role_name = settings.MEDIA_ATOM_ROLE_ARN
+    session_name = "GNMAtomResponderReplay"
+
+    def add_arguments(self, parser):
+        start = parser.add_mutually_exclusive_group(required=True)
+        start.add_argument("--from-timestamp", type=str, help="Replay records that arrived at or after this time (ISO format, UTC unless an offset is given)")
+        start.add_argument("--from-sequence", type=str, help="Replay from this sequence number. Needs exactly one --shard.")
+        parser.add_argument("--to-timestamp", type=str, help="Stop at records that arrived after this time. Default is to replay up to the tip of each shard.")
+        parser.add_argument("--shard", type=str, action="append", dest="shards", help="Only replay this shard. Can be given more than once.")
+        parser.add_argument("--rate", type=float, default=None, help="Maximum number of records per second to replay, across all shards")
+        parser.add_argument("--dry-run", action="store_true", help="Only validate and classify the messages, don't process them")
+
+    @staticmethod
+    def parse_timestamp(value, name):
+        if value is None:
+            return None
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise CommandError("{0} '{1}' is not a valid timestamp".format(name, value))
+        return parsed
+
+    def make_handler(self, shard_id):
+        """
+        Returns the function that a replayer calls for each record
+        """
+        if self.dry_run:
+            return lambda rec: classify_record(rec['Data'])
+
+        from atomresponder.master_importer import MasterImportResponder
+        #the responder is only used for its process() method. It is never started, so it never checkpoints.
+        responder = MasterImportResponder(self.role_name, self.session_name, self.stream_name, shard_id,
+                                          aws_access_key_id=settings.MEDIA_ATOM_AWS_ACCESS_KEY_ID,
+                                          aws_secret_access_key=settings.MEDIA_ATOM_AWS_SECRET_ACCESS_KEY,
+                                          should_save=False, worker_pool_size=1)
+
+        def handler(rec):
+            outcome = classify_record(rec['Data'])
+            responder.process(rec['Data'], datetime.fromtimestamp(rec['ApproximateArrivalTimestamp']))
+            return outcome
+        return handler
+
+    def startup_thread(self, conn, shardinfo):
+        return ShardReplayer(self.role_name, self.session_name, self.stream_name, shardinfo['ShardId'],
+                             self.make_handler(shardinfo['ShardId']),
+                             self.iterator_type,
+                             sequence_number=self.from_sequence,
+                             timestamp=self.from_timestamp,
+                             end_timestamp=self.to_timestamp,
+                             rate_limiter=self.rate_limiter,
+                             stats=self.stats,
+                             aws_access_key_id=settings.MEDIA_ATOM_AWS_ACCESS_KEY_ID,
+                             aws_secret_access_key=settings.MEDIA_ATOM_AWS_SECRET_ACCESS_KEY)
+
+    def handle(self, *args, **options):
+        self.from_timestamp = self.parse_timestamp(options.get("from_timestamp"), "--from-timestamp")
+        self.to_timestamp = self.parse_timestamp(options.get("to_timestamp"), "--to-timestamp")
+        self.from_sequence = options.get("from_sequence")
+        self.dry_run = options.get("dry_run", False)
+        self.rate_limiter = TokenBucket(options["rate"]) if options.get("rate") else None
+        self.stats = ShardMetrics()
+        wanted_shards = options.get("shards")
+
+        if self.from_sequence is not None:
+            if wanted_shards is None or len(wanted_shards) != 1:
+                raise CommandError("--from-sequence needs exactly one --shard, because sequence numbers are per-shard")
+            self.iterator_type = AT_SEQUENCE_NUMBER
+        else:
+            self.iterator_type = AT_TIMESTAMP
+
+        self._credentials, self._conn = self.connect({
+            'aws_access_key_id': settings.MEDIA_ATOM_AWS_ACCESS_KEY_ID,
+            'aws_secret_access_key': settings.MEDIA_ATOM_AWS_SECRET_ACCESS_KEY
+        })
+        shardlist = self.describe_shards(self._conn)
+        if wanted_shards is not None:
+            unknown = set(wanted_shards) - set([shardinfo['ShardId'] for shardinfo in shardlist])
+            if len(unknown) > 0:
+                raise CommandError("Stream {0} has no shard(s) {1}".format(self.stream_name, ", ".join(sorted(unknown))))
+            shardlist = [shardinfo for shardinfo in shardlist if shardinfo['ShardId'] in wanted_shards]
+
+        threads = {}
+        self.start_threads(shardlist, threads)
+        print("Replaying {0} shard(s){1}. Hit CTRL-C to stop.".format(len(threads), " in dry-run mode" if self.dry_run else ""), flush=True)
+        try:
+            while any([t.is_alive() for t in threads.values()]):
+                for t in threads.values():
+                    t.join(timeout=30.0/len(threads))
+                self.stats.log_summary()
+        except KeyboardInterrupt:
+            print("CTRL-C caught, stopping replay", flush=True)
+            for t in threads.values():
+                t.request_stop()
+            for t in threads.values():
+                t.join()
+
+        totals = {}
+        for values in self.stats.snapshot().values():
+            for name, value in values.items():
+                if name != "last_sequence_number":
+                    totals[name] = totals.get(name, 0) + value
+        for (stream_name, shard_id), values in sorted(self.stats.snapshot().items()):
+            print("{0}: replayed up to {1}".format(shard_id, values.get("last_sequence_number", "(nothing)")))
+        for name, value in sorted(totals.items()):
+            print("{0}: {1}".format(name, value))
@@ -46,4 +46,5 @@ class Command(KinesisResponderBaseCommand):
     def startup_thread(self, conn, shardinfo):
         return MasterImportResponder(self.role_name,self.session_name,self.stream_name,shardinfo['ShardId'],
                                      aws_access_key_id=settings.MEDIA_ATOM_AWS_ACCESS_KEY_ID,
-                                     aws_secret_access_key=settings.MEDIA_ATOM_AWS_SECRET_ACCESS_KEY)
\ No newline at end of file
+                                     aws_secret_access_key=settings.MEDIA_ATOM_AWS_SECRET_ACCESS_KEY,
+                                     **self.responder_options)
\ No newline at end of file
@@ -4,13 +4,20 @@ import urllib.request, urllib.parse, urllib.error
 from django.conf import settings
 from .s3_mixin import S3Mixin, FileDoesNotExist
 from .vs_mixin import VSMixin
+from .message_cache import RecentMessageCache
+from .storage_manager import get_storage_manager, InsufficientDiskSpace
+from .ingest_stage import get_ingest_stage
+from .item_mapping import get_item_mapping
+from kinesisresponder.metrics import shard_metrics
 import logging
 from gnmvidispine.vs_item import VSItem, VSNotFound
+from gnmvidispine.vidispine_api import VSException
 from rabbitmq.models import LinkedProject
+from rabbitmq.publisher import get_publisher, PublishNacked
 from datetime import datetime
+from collections import namedtuple
 import atomresponder.constants as const
 import re
-import pika
 import time
 import os
 import atomresponder.message_schema as message_schema
@@ -24,38 +31,24 @@ extract_extension = re.compile(r'^(?P<basename>.*)\.(?P<extension>[^\.]+)$')
 multiple_underscore_re = re.compile(r'_{2,}')
 make_filename_re = re.compile(r'[^\w\d\.]')
 
+#what import_new_item needs to know about earlier imports, see MasterImportResponder.import_checks
+ImportChecks = namedtuple("ImportChecks", ["old_finished_jobs", "old_key", "processing", "last_retry_number"])
+
 
 class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
     def __init__(self, *args, **kwargs):
         super(MasterImportResponder, self).__init__(*args, **kwargs)
         self._pika_client = None
+        self.message_cache = RecentMessageCache(max_entries=getattr(settings, "ATOM_RESPONDER_DEDUPE_MAX_ENTRIES", 10000),
+                                                ttl=getattr(settings, "ATOM_RESPONDER_DEDUPE_TTL", 300))
+        self.ingest_stage = get_ingest_stage() if getattr(settings, "ATOM_RESPONDER_STAGED_INGEST", False) else None
 
         #set up exchange on startup. this also means we terminate if we can't connect to the broker.
+        #the publisher is shared by the whole process, so only the first shard actually waits for it to connect.
         if "CI" not in os.environ:
-            (conn, channel) = self.setup_pika_channel()
-            channel.close()
-            conn.close()
-
-    @staticmethod
-    def setup_pika_channel() -> (pika.spec.Connection, pika.spec.Channel):
-        conn = pika.BlockingConnection(pika.ConnectionParameters(
-            host=settings.RABBITMQ_HOST,
-            port=getattr(settings, "RABBITMQ_PORT", 5672),
-            virtual_host=getattr(settings, "RABBITMQ_VHOST", "/"),
-            credentials=pika.PlainCredentials(username=settings.RABBITMQ_USER, password=settings.RABBITMQ_PASSWORD),
-            connection_attempts=getattr(settings, "RABBITMQ_CONNECTION_ATTEMPTS", 3),
-            retry_delay=getattr(settings, "RABBITMQ_RETRY_DELAY", 3)
-        ))
-
-        channel = conn.channel()
-        channel.exchange_declare(settings.RABBITMQ_EXCHANGE, exchange_type="topic", durable=True)
-        channel.confirm_delivery()
-
-        return conn, channel
+            get_publisher().wait_connected(getattr(settings, "RABBITMQ_PUBLISH_TIMEOUT", 30))
 
     def update_pluto_record(self, item_id, job_id, content:dict, statinfo):
-        (conn, channel) = self.setup_pika_channel()
-
         if 'type' not in content:
             logger.error("Content dictionary had no type information! Using video-upload")
             type = const.MESSAGE_TYPE_MEDIA
@@ -98,15 +91,14 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
             **statpart
         }
 
+        publisher = get_publisher()
         while True:
             try:
                 logger.info("Updating exchange {} with routing-key {}...".format(settings.RABBITMQ_EXCHANGE, routingkey))
-                channel.basic_publish(settings.RABBITMQ_EXCHANGE, routingkey, json.dumps(message_to_send).encode("UTF-8"))
-                channel.close()
-                conn.close()    #makes sure everything gets flushed nicely
+                publisher.publish(routingkey, json.dumps(message_to_send).encode("UTF-8"))
                 break
-            except pika.exceptions.UnroutableError:
-                logger.error("Could not route message to broker, retrying in 3s...")
+            except PublishNacked:
+                logger.error("Broker did not accept the message, retrying in 3s...")
                 time.sleep(3)
 
     def get_or_create_master_item(self, atomId:str, title:str, filename:str, project_id:int, user:str) -> (VSItem, bool):
@@ -131,6 +123,17 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
             created = True
         return master_item, created
 
+    def ordering_key(self, rec):
+        """
+        Messages about the same atom must be processed in order, but different atoms can be processed in parallel
+        :param rec: dictionary of the record, as returned in the Records list from get_records
+        :return: the atom ID from the message, or the partition key if it can't be read
+        """
+        try:
+            return json.loads(rec['Data'])['atomId']
+        except (ValueError, KeyError, TypeError):
+            return super(MasterImportResponder, self).ordering_key(rec)
+
     def process(self,record, approx_arrival, attempt=0):
         """
         Process a message from the kinesis stream.  Each record is a JSON document which contains keys for atomId, s3Key,
@@ -159,6 +162,8 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
 
         #We get two types of message on the stream, one for incoming xml the other for incoming media.
         if content['type'] == const.MESSAGE_TYPE_MEDIA or content['type'] == const.MESSAGE_TYPE_RESYNC_MEDIA:
+            if self.drop_repeated_message(record, content):
+                return
             if 'user' in content:
                 atom_user = content['user']
             else:
@@ -174,7 +179,17 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
                                                                   project_id=project_id,
                                                                   user=atom_user)
 
-            return self.import_new_item(master_item, content)
+            if self.ingest_stage is not None:
+                result = self.stage_ingest(record, content)
+            else:
+                result = self.import_when_space(lambda: self.import_to_master(master_item, content,
+                                                lambda: self.get_or_create_master_item(content['atomId'],
+                                                                                       title=content['title'],
+                                                                                       filename=content['s3Key'],
+                                                                                       project_id=project_id,
+                                                                                       user=atom_user)[0]))
+            self.message_cache.remember(record, content['atomId'], content['s3Key'])
+            return result
         elif content['type'] == const.MESSAGE_TYPE_PAC:
             logger.info("Got PAC form data message")
             record = self.register_pac_xml(content)
@@ -207,6 +222,115 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
         else:
             raise ValueError("Unrecognised message type: {0}".format(content['type']))
 
+    def startup(self):
+        if self.ingest_stage is not None:
+            recovered = self.ingest_stage.recover(self.stream_name, self.shard_id, self.run_staged_ingest)
+            if recovered > 0:
+                logger.info("{0}: Recovered {1} staged ingests".format(self.shard_id, recovered))
+
+    def stage_ingest(self, record, content):
+        """
+        Hands the ingest of a media message off to the ingest stage. The StagedIngest row is saved before we return,
+        so it is safe for the record to be checkpointed. This blocks if the ingest stage is full.
+        :param record: raw message string
+        :param content: parsed message
+        :return: the StagedIngest instance
+        """
+        from .models import StagedIngest
+        staged = StagedIngest(stream_name=self.stream_name,
+                              shard_id=self.shard_id,
+                              atom_id=content['atomId'],
+                              s3_key=content['s3Key'],
+                              record=record)
+        staged.save()
+        self.ingest_stage.hand_off(staged, self.run_staged_ingest)
+        shard_metrics.set(self.stream_name, self.shard_id, "ingest_stage_in_flight", self.ingest_stage.in_flight)
+        return staged
+
+    def run_staged_ingest(self, staged):
+        """
+        Carries out a staged ingest, on one of the ingest stage's worker threads
+        :param staged: StagedIngest instance
+        :return: None
+        """
+        content = json.loads(staged.record)
+        master_item = self.get_item_for_atomid(content['atomId'])
+        if master_item is None:
+            raise RuntimeError("The master item for atom {0} no longer exists".format(content['atomId']))
+        self.import_to_master(master_item, content, lambda: self.get_item_for_atomid(content['atomId']))
+
+    def import_when_space(self, do_import):
+        """
+        Runs an import straight from the shard.  If there isn't room to download the media then the storage manager has
+        already waited ATOM_RESPONDER_DOWNLOAD_SPACE_WAIT seconds for some; rather than fail the record, which would be
+        checkpointed past and never ingested, we carry on waiting and hold the shard at this record.  (Staged ingests
+        are retried by the ingest stage instead.)  We only give up if we are asked to stop, which happens when we have
+        lost the lease on the shard, so the checkpoint can't be moved past the record anyway.
+        :param do_import: function that carries out the import
+        :return: the result of do_import
+        """
+        while True:
+            try:
+                return do_import()
+            except InsufficientDiskSpace as e:
+                if self.stop_requested:
+                    raise
+                logger.warning("{0}: {1}. Still waiting for space before importing".format(self.shard_id, e))
+                shard_metrics.increment(self.stream_name, self.shard_id, "download_deferred")
+
+    def import_to_master(self, master_item, content, find_again):
+        """
+        Calls import_new_item.  If Vidispine says that the item doesn't exist, it was deleted after we mapped the atom to
+        it, so the mapping is forgotten and we have one more go with the item that find_again() comes up with.
+        :param master_item: VSItem for the master
+        :param content: parsed message
+        :param find_again: function that looks up (or creates) the master item again once the mapping has gone
+        :return: the result of import_new_item
+        """
+        try:
+            return self.import_new_item(master_item, content)
+        except VSNotFound as e:
+            logger.warning("{0}: item no longer exists in Vidispine ({1}), looking up the master for atom {2} again".format(master_item.name, e, content['atomId']))
+            get_item_mapping().forget_atom(content['atomId'], master_item.name)
+        master_item = find_again()
+        if master_item is None:
+            raise RuntimeError("The master item for atom {0} no longer exists".format(content['atomId']))
+        return self.import_new_item(master_item, content)
+
+    def drop_repeated_message(self, record, content):
+        """
+        Checks a media message against the cache of recently processed ones, so that duplicates and a resync that
+        follows straight on from an upload of the same media don't cost us any lookups
+        :param record: raw message string
+        :param content: parsed message
+        :return: True if the message should be dropped
+        """
+        dropped = self.message_cache.check(record, content['atomId'], content['s3Key'])
+        if dropped is not None and self.last_import_failed(content['atomId']):
+            #this is the resend that VidispineMessageProcessor.handle_failed_job asks for, so it has to go through
+            logger.info("{0}: Last import failed, processing {1} message again".format(content['atomId'], content['type']))
+            self.message_cache.forget(record, content['atomId'], content['s3Key'])
+            dropped = None
+        shard_metrics.increment(self.stream_name, self.shard_id, "dedupe_" + (dropped if dropped is not None else "miss"))
+        shard_metrics.set(self.stream_name, self.shard_id, "dedupe_hit_rate", self.message_cache.hit_rate())
+        if dropped is not None:
+            logger.info("Dropping {0} {1} message for atom {2} and key {3}".format(dropped, content['type'],
+                                                                                content['atomId'], content['s3Key']))
+            return True
+        return False
+
+    @staticmethod
+    def last_import_failed(atom_id):
+        """
+        Checks whether the most recent import for an atom failed. This is only called when the message cache would drop
+        a message, so it doesn't cost a query for most messages.
+        :param atom_id: atom ID string
+        :return: True if the last ImportJob for the atom failed
+        """
+        from .models import ImportJob
+        last_job = ImportJob.objects.filter(atom_id=atom_id).order_by('-started_at').first()
+        return last_job is not None and last_job.is_failed()
+
     def register_pac_xml(self, content):
         """
         Start the import of new PAC data by registering it in the database.
@@ -226,26 +350,72 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
         record.save()
         return record
 
-    def check_for_old_finished_jobs(self, vs_item_id):
+    @staticmethod
+    def import_checks(vs_item_id, key=None, atom_id=None):
+        """
+        Finds out everything that import_new_item needs to know about earlier imports in a single query
+        :param vs_item_id: item ID of the master
+        :param key: S3 key of the incoming media
+        :param atom_id: atom ID of the incoming media
+        :return: an ImportChecks, saying whether the item has a FINISHED job, whether it has a job for this key, whether
+        it has a job still processing, and the highest retry number of the imports for the atom (None if there are none)
+        """
         from .models import ImportJob
+        from django.db.models import Count, Max, Q
+
+        result = ImportJob.objects.filter(Q(item_id=vs_item_id) | Q(atom_id=atom_id)).aggregate(
+            old_finished_jobs=Count('pk', filter=Q(item_id=vs_item_id, status='FINISHED')),
+            old_key=Count('pk', filter=Q(item_id=vs_item_id, s3_path=key)),
+            processing=Count('pk', filter=Q(item_id=vs_item_id, processing=True)),
+            last_retry_number=Max('retry_number', filter=Q(atom_id=atom_id)),
+        )
+        return ImportChecks(old_finished_jobs=result['old_finished_jobs'] > 0,
+                            old_key=result['old_key'] > 0,
+                            processing=result['processing'] > 0,
+                            last_retry_number=result['last_retry_number'])
 
-        jobs = ImportJob.objects.filter(item_id=vs_item_id).filter(status='FINISHED').count()
-
-        return jobs > 0
+    def check_for_old_finished_jobs(self, vs_item_id):
+        return self.import_checks(vs_item_id).old_finished_jobs
 
     def check_key(self, key, vs_item_id):
-        from .models import ImportJob
-
-        jobs = ImportJob.objects.filter(item_id=vs_item_id).filter(s3_path=key).count()
-
-        return jobs > 0
+        return self.import_checks(vs_item_id, key=key).old_key
 
     def check_for_processing(self, vs_item_id):
-        from .models import ImportJob
+        return self.import_checks(vs_item_id).processing
 
-        jobs = ImportJob.objects.filter(item_id=vs_item_id).filter(processing=True).count()
+    def choose_ingest_strategy(self, content):
+        """
+        Works out how to get the media for this message into Vidispine, from ATOM_RESPONDER_INGEST_STRATEGY.
+        In "auto" mode a retry after Vidispine failed to import from a presigned URL is downloaded instead, so that a
+        URL that VS can't read only costs us one attempt.
+        :param content: parsed message
+        :return: one of the INGEST_STRATEGY_ constants
+        """
+        from .models import ImportJob
+        strategy = getattr(settings, "ATOM_RESPONDER_INGEST_STRATEGY", const.INGEST_STRATEGY_DOWNLOAD)
+        if strategy not in (const.INGEST_STRATEGY_PRESIGNED, const.INGEST_STRATEGY_DOWNLOAD, const.INGEST_STRATEGY_AUTO):
+            logger.error("Unrecognised ingest strategy {0}, downloading instead".format(strategy))
+            return const.INGEST_STRATEGY_DOWNLOAD
+
+        if strategy == const.INGEST_STRATEGY_AUTO:
+            previous = ImportJob.objects.filter(atom_id=content['atomId']).order_by('-retry_number').first()
+            if previous is not None and previous.ingest_strategy == const.INGEST_STRATEGY_PRESIGNED and previous.is_failed():
+                logger.info("{0}: Previous import from a presigned URL failed, downloading this time".format(content['atomId']))
+                return const.INGEST_STRATEGY_DOWNLOAD
+        return strategy
 
-        return jobs > 0
+    @staticmethod
+    def start_import(master_item:VSItem, uri:str):
+        """
+        Asks Vidispine to import the media at the given URI onto the item
+        :return: VSJob for the import
+        """
+        return master_item.import_to_shape(uri=uri,
+                                           essence=True,
+                                           shape_tag=getattr(settings,"ATOM_RESPONDER_SHAPE_TAG","lowres"),
+                                           priority=getattr(settings,"ATOM_RESPONDER_IMPORT_PRIORITY","HIGH"),
+                                           jobMetadata={'gnm_source': 'media_atom'},
+                                           )
 
     def import_new_item(self, master_item:VSItem, content):
         from .models import ImportJob, PacFormXml
@@ -259,11 +429,9 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
         if vs_item_id is None:
             vs_item_id = master_item.name
 
-        old_finished_jobs = self.check_for_old_finished_jobs(vs_item_id)
-
-        old_key = self.check_key(content['s3Key'], vs_item_id)
+        checks = self.import_checks(vs_item_id, key=content['s3Key'], atom_id=content['atomId'])
 
-        if old_finished_jobs is True and old_key is True:
+        if checks.old_finished_jobs is True and checks.old_key is True:
             logger.info('A job for item {0} has already been successfully completed. Aborting.'.format(vs_item_id))
             inform_sentry('A job for item {0} has already been successfully completed. Aborting.'.format(vs_item_id), {
                 "master_item": master_item,
@@ -271,9 +439,7 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
             })
             return
 
-        processing_job = self.check_for_processing(vs_item_id)
-
-        if processing_job is True:
+        if checks.processing is True:
             logger.info('Job for item {0} already in progress. Aborting.'.format(vs_item_id))
             inform_sentry('Job for item {0} already in progress. Aborting.'.format(vs_item_id), {
                 "master_item": master_item,
@@ -283,29 +449,42 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
 
         safe_title = content.get('title','(unknown title)').encode("UTF-8","backslashescape").decode("UTF-8")
 
-        #using a signed URL is preferred, but right now VS seems to have trouble ingesting it.
-        #so, we download instead and ingest that. get_s3_signed_url is left in to make it simple to switch back
-        #download_url = self.get_s3_signed_url(bucket=settings.ATOM_RESPONDER_DOWNLOAD_BUCKET, key=content['s3Key'])
-        downloaded_path = self.download_to_local_location(bucket=settings.ATOM_RESPONDER_DOWNLOAD_BUCKET,
-                                                          key=content['s3Key'],
-                                                          #this is converted to a safe filename within download_to_local_location
-                                                          filename=content.get('title', None)) #filename=None => use s3key instead
-
-        download_url = "file://" + urllib.parse.quote(downloaded_path)
-
         logger.info("{n}: Ingesting atom with title '{0}' from media atom with ID {1}".format(safe_title,
                                                                                               content['atomId'],
                                                                                               n=master_item.name))
 
-        logger.info("{n}: Download URL is {0}".format(download_url, n=master_item.name))
-
-        job_result = master_item.import_to_shape(uri=download_url,
-                                                 essence=True,
-                                                 shape_tag=getattr(settings,"ATOM_RESPONDER_SHAPE_TAG","lowres"),
-                                                 priority=getattr(settings,"ATOM_RESPONDER_IMPORT_PRIORITY","HIGH"),
-                                                 jobMetadata={'gnm_source': 'media_atom'},
-                                                 )
-        logger.info("{0} Import job is at ID {1}".format(vs_item_id, job_result.name))
+        strategy = self.choose_ingest_strategy(content)
+        job_result = None
+        downloaded_path = None
+        if strategy in (const.INGEST_STRATEGY_PRESIGNED, const.INGEST_STRATEGY_AUTO):
+            download_url = self.get_s3_signed_url(bucket=settings.ATOM_RESPONDER_DOWNLOAD_BUCKET, key=content['s3Key'])
+            #don't log the URL itself, it carries our credentials
+            logger.info("{n}: Importing from a presigned URL for s3://{0}/{1}".format(settings.ATOM_RESPONDER_DOWNLOAD_BUCKET,
+                                                                                    content['s3Key'], n=master_item.name))
+            try:
+                job_result = self.start_import(master_item, download_url)
+                strategy = const.INGEST_STRATEGY_PRESIGNED
+            except VSNotFound:
+                #the item itself has gone, downloading won't help
+                raise
+            except VSException as e:
+                if strategy != const.INGEST_STRATEGY_AUTO:
+                    raise
+                logger.warning("{n}: Vidispine could not import from the presigned URL, downloading instead: {0}".format(e, n=master_item.name))
+
+        if job_result is None:
+            downloaded_path = self.download_to_local_location(bucket=settings.ATOM_RESPONDER_DOWNLOAD_BUCKET,
+                                                              key=content['s3Key'],
+                                                              #this is converted to a safe filename within download_to_local_location
+                                                              filename=content.get('title', None), #filename=None => use s3key instead
+                                                              atom_id=content['atomId'])
+
+            download_url = "file://" + urllib.parse.quote(downloaded_path)
+            logger.info("{n}: Download URL is {0}".format(download_url, n=master_item.name))
+            job_result = self.start_import(master_item, download_url)
+            strategy = const.INGEST_STRATEGY_DOWNLOAD
+
+        logger.info("{0} Import job is at ID {1}, ingesting by {2}".format(vs_item_id, job_result.name, strategy))
 
         #make a note of the record. This is to link it up with Vidispine's response message.
         record = ImportJob(item_id=vs_item_id,
@@ -316,14 +495,18 @@ class MasterImportResponder(KinesisResponder, S3Mixin, VSMixin):
                            atom_id=content['atomId'],
                            atom_title=content.get('title', "Unknown title"),
                            s3_path=content['s3Key'],
-                           processing=True)
-        previous_attempt = record.previous_attempt()
-        if previous_attempt:
-            record.retry_number = previous_attempt.retry_number+1
+                           processing=True,
+                           ingest_strategy=strategy)
+        if checks.last_retry_number is not None:
+            record.retry_number = checks.last_retry_number+1
             logger.info("{0} Import job is retry number {1}".format(vs_item_id, record.retry_number))
         record.save()
+        if downloaded_path is not None:
+            #so that the file can be cleaned up once Vidispine has finished with it
+            get_storage_manager().assign(downloaded_path, record)
 
-        statinfo = os.stat(downloaded_path)
+        #there is no local file to stat when Vidispine pulls the media itself
+        statinfo = os.stat(downloaded_path) if downloaded_path is not None else None
 
         self.update_pluto_record(vs_item_id, job_result.name, content, statinfo)
 
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+#the cache says why a message should be dropped
+EXACT_DUPLICATE = "duplicate"
+SUPERSEDED = "superseded"
+
+
+class RecentMessageCache(object):
+    """
+    Bounded LRU cache, with a time-to-live, of the messages that we have recently dealt with.  Kinesis delivers at least
+    once and the atom tool often sends a video-upload and then a video-upload-resync for the same media in quick
+    succession, so this lets us drop repeats before doing any lookups in Vidispine or the database.
+    Messages are remembered by a hash of their content, and media messages also by their (atomId, s3Key).  Only
+    remember() a message once it has been processed successfully, so that a failure can still be retried.  An import
+    that Vidispine fails after that is retried by a resend from the atom tool, so the caller has to check that a hit is
+    not for media whose import has failed, and forget() it if it is.
+    """
+    def __init__(self, max_entries=10000, ttl=300, clock=monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = {EXACT_DUPLICATE: 0, SUPERSEDED: 0}
+        self.misses = 0
+
+    @staticmethod
+    def content_key(record):
+        if isinstance(record, str):
+            record = record.encode("UTF-8")
+        return "content", hashlib.sha1(record).hexdigest()
+
+    @staticmethod
+    def media_key(atom_id, s3_key):
+        return "media", atom_id, s3_key
+
+    def _live(self, key, now):
+        expiry = self._entries.get(key)
+        if expiry is None:
+            return False
+        if expiry < now:
+            del self._entries[key]
+            return False
+        self._entries.move_to_end(key)
+        return True
+
+    def check(self, record, atom_id=None, s3_key=None):
+        """
+        Checks whether a message can be dropped
+        :param record: raw message content string
+        :param atom_id: atom ID, for media messages
+        :param s3_key: s3 key, for media messages
+        :return: EXACT_DUPLICATE or SUPERSEDED if the message has already been dealt with, otherwise None
+        """
+        if self.ttl <= 0:
+            return None
+        now = self._clock()
+        with self._lock:
+            if self._live(self.content_key(record), now):
+                result = EXACT_DUPLICATE
+            elif atom_id is not None and s3_key is not None and self._live(self.media_key(atom_id, s3_key), now):
+                result = SUPERSEDED
+            else:
+                self.misses += 1
+                return None
+            self.hits[result] += 1
+            return result
+
+    def remember(self, record, atom_id=None, s3_key=None):
+        """
+        Records that a message has been dealt with
+        """
+        if self.ttl <= 0:
+            return
+        expiry = self._clock() + self.ttl
+        keys = [self.content_key(record)]
+        if atom_id is not None and s3_key is not None:
+            keys.append(self.media_key(atom_id, s3_key))
+        with self._lock:
+            for key in keys:
+                self._entries[key] = expiry
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, record, atom_id=None, s3_key=None):
+        """
+        Removes a message from the cache, so that the next copy of it is processed again
+        """
+        keys = [self.content_key(record)]
+        if atom_id is not None and s3_key is not None:
+            keys.append(self.media_key(atom_id, s3_key))
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def hit_rate(self):
+        """
+        :return: the proportion of checked messages that were dropped, or None if nothing has been checked
+        """
+        with self._lock:
+            total = self.misses + sum(self.hits.values())
+            return float(sum(self.hits.values())) / total if total > 0 else None
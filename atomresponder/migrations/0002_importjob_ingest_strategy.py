@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atomresponder', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='ingest_strategy',
+            field=models.CharField(choices=[('download', 'Downloaded and imported from local file'), ('presigned', 'Imported from presigned S3 URL')], default='download', max_length=16),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atomresponder', '0002_importjob_ingest_strategy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DownloadedFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=2048, unique=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('downloaded_at', models.DateTimeField()),
+                ('last_used_at', models.DateTimeField(db_index=True)),
+                ('in_use', models.BooleanField(db_index=True, default=True)),
+                ('import_job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='downloaded_files', to='atomresponder.importjob')),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atomresponder', '0003_downloadedfile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedIngest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stream_name', models.CharField(max_length=128)),
+                ('shard_id', models.CharField(max_length=128)),
+                ('atom_id', models.CharField(db_index=True, max_length=64)),
+                ('s3_key', models.CharField(max_length=2048)),
+                ('record', models.TextField()),
+                ('status', models.CharField(choices=[('PENDING', 'Waiting for a worker'), ('RUNNING', 'Running'), ('FAILED', 'Failed')], default='PENDING', max_length=16)),
+                ('owner', models.CharField(blank=True, max_length=255, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+                'index_together': {('stream_name', 'shard_id', 'status')},
+            },
+        ),
+    ]
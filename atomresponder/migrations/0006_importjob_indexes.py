@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atomresponder', '0005_atomitemmapping'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(fields=['item_id', 'status'], name='importjob_item_status'),
+        ),
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(fields=['item_id', 's3_path'], name='importjob_item_s3_path'),
+        ),
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(fields=['atom_id', 'retry_number'], name='importjob_atom_retry'),
+        ),
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(condition=models.Q(processing=True), fields=['item_id'], name='importjob_item_processing'),
+        ),
+    ]
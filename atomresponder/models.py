@@ -27,9 +27,21 @@ class ImportJob(models.Model):
     s3_path = models.CharField(max_length=2048, null=True)
     retry_number = models.IntegerField(default=0)
     processing = models.BooleanField(default=False)
+    ingest_strategy = models.CharField(max_length=16, default='download', choices=[
+        ('download', 'Downloaded and imported from local file'),
+        ('presigned', 'Imported from presigned S3 URL'),
+    ])
 
     class Meta:
         ordering = ['-started_at']
+        #these back the checks that import_new_item makes before each import, see MasterImportResponder.import_checks
+        indexes = [
+            models.Index(fields=['item_id', 'status'], name='importjob_item_status'),
+            models.Index(fields=['item_id', 's3_path'], name='importjob_item_s3_path'),
+            models.Index(fields=['atom_id', 'retry_number'], name='importjob_atom_retry'),
+            #only a handful of jobs are processing at any one time, so this stays small
+            models.Index(fields=['item_id'], name='importjob_item_processing', condition=models.Q(processing=True)),
+        ]
 
     def is_failed(self):
         """
@@ -54,6 +66,67 @@ class ImportJob(models.Model):
         return "Import of {0} from {1} to item {2}".format(self.atom_title, self.user_email, self.item_id)
 
 
+class DownloadedFile(models.Model):
+    """
+    A file that we have downloaded to ATOM_RESPONDER_DOWNLOAD_PATH, see storage_manager.py
+    """
+    path = models.CharField(max_length=2048, unique=True)
+    size = models.BigIntegerField(default=0)
+    import_job = models.ForeignKey(ImportJob, null=True, blank=True, on_delete=models.SET_NULL, related_name="downloaded_files")
+    downloaded_at = models.DateTimeField()
+    last_used_at = models.DateTimeField(db_index=True)
+    #cleared once Vidispine has finished with the file, after which it can be evicted
+    in_use = models.BooleanField(default=True, db_index=True)
+
+    def __str__(self):
+        return "{0} ({1} bytes)".format(self.path, self.size)
+
+
+class StagedIngest(models.Model):
+    """
+    A media message that has been handed off from the shard reader to the ingest stage, see ingest_stage.py.
+    The row is written before the record is checkpointed and removed once the ingest has been started, so anything
+    still here after a restart has not been dealt with yet.
+    """
+    stream_name = models.CharField(max_length=128)
+    shard_id = models.CharField(max_length=128)
+    atom_id = models.CharField(max_length=64, db_index=True)
+    s3_key = models.CharField(max_length=2048)
+    record = models.TextField()
+    status = models.CharField(max_length=16, default='PENDING', choices=[
+        ('PENDING', 'Waiting for a worker'),
+        ('RUNNING', 'Running'),
+        ('FAILED', 'Failed'),
+    ])
+    owner = models.CharField(max_length=255, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['created_at']
+        index_together = [
+            ('stream_name', 'shard_id', 'status'),
+        ]
+
+    def __str__(self):
+        return "Ingest of {0} for atom {1} ({2})".format(self.s3_key, self.atom_id, self.status)
+
+
+class AtomItemMapping(models.Model):
+    """
+    The Vidispine master item for an atom, see item_mapping.py
+    """
+    atom_id = models.CharField(max_length=64, unique=True)
+    item_id = models.CharField(max_length=64, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "{0} -> {1}".format(self.atom_id, self.item_id)
+
+
 class PacFormXml(models.Model):
     atom_id = models.CharField(max_length=64, db_index=True, unique=True)
     received = models.DateTimeField()
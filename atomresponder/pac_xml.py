@@ -43,7 +43,7 @@ class PacXmlProcessor(S3Mixin, VSMixin):
         else:
             s3path = parsed.path
 
-        filename = self.download_to_local_location(bucket=parsed.hostname, key=s3path)
+        filename = self.download_to_local_location(bucket=parsed.hostname, key=s3path, atom_id=pac_xml_record.atom_id)
         logger.info("{n}: Download completed".format(n=vsitem.name))
 
         # with open(filename,"r") as f:
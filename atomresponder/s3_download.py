@@ -0,0 +1,354 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import hashlib
+import logging
+import math
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+MB = 1024*1024
+DEFAULT_PART_SIZE = 16*MB
+
+md5_etag_re = re.compile(r'^"?(?P<digest>[0-9a-fA-F]{32})(-(?P<parts>\d+))?"?$')
+
+
+def parse_etag(etag):
+    """
+    Picks apart an S3 ETag
+    :param etag: ETag string, with or without quotes
+    :return: tuple of (hex MD5 digest, number of parts). The number of parts is None for an object that was uploaded in
+    one go, when the ETag is the MD5 of the whole object; for a multipart upload the digest is the MD5 of the MD5s of
+    the parts. Returns None if the ETag is not in either form.
+    """
+    if not isinstance(etag, str):
+        return None
+    matches = md5_etag_re.match(etag)
+    if matches is None:
+        return None
+    return matches.group("digest").lower(), int(matches.group("parts")) if matches.group("parts") is not None else None
+
+
+def fetch_upload_part_size(key):
+    """
+    Asks S3 what part size a multipart upload used. A HEAD request for partNumber=1 describes just the first part, so
+    its Content-Length is the part size; every part but the last one is the same size.
+    :param key: boto Key for the object
+    :return: part size in bytes, or None if S3 didn't tell us
+    """
+    response = key.bucket.connection.make_request('HEAD', key.bucket.name, key.name, query_args='partNumber=1')
+    response.read()
+    if response.status not in (200, 206):
+        logger.warning("Could not get the first part of s3://{0}/{1}, server returned {2}".format(key.bucket.name, key.name, response.status))
+        return None
+    length = response.getheader('content-length')
+    return int(length) if length is not None else None
+
+
+class IncompletePart(Exception):
+    def __init__(self, start, end, received):
+        self.start = start
+        self.end = end
+        self.received = received
+
+    def __str__(self):
+        return "Expected {0} bytes for range {1}-{2}, got {3}".format(self.end - self.start + 1, self.start, self.end, self.received)
+
+
+class ChecksumMismatch(Exception):
+    def __init__(self, path, expected, actual):
+        self.path = path
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return "Downloaded {0} has checksum {1} but S3 has ETag {2}".format(self.path, self.actual, self.expected)
+
+
+class StreamingMd5(object):
+    """
+    Works out the MD5 of a whole file while its parts are being written in parallel and out of order.  Data that lands
+    at the current position is hashed straight away; data further on is held in memory, up to max_pending bytes, until
+    everything before it has been hashed.  Anything that didn't fit is read back from the file once the parts before
+    it have completed (see catch_up).
+    If a range that has already been hashed is written again then the digest can't be trusted any more, and valid is
+    cleared.
+    """
+    def __init__(self, fd, size, max_pending=2*DEFAULT_PART_SIZE):
+        self.fd = fd
+        self.size = size
+        self.max_pending = max_pending
+        self.position = 0
+        self.valid = True
+        self._md5 = hashlib.md5()
+        self._pending = {}
+        self._pending_bytes = 0
+        self._lock = Lock()
+
+    def _drain(self):
+        while self.position in self._pending:
+            data = self._pending.pop(self.position)
+            self._pending_bytes -= len(data)
+            self._md5.update(data)
+            self.position += len(data)
+
+    def feed(self, offset, data):
+        with self._lock:
+            if offset < self.position:
+                self.valid = False
+            elif offset == self.position:
+                self._md5.update(data)
+                self.position += len(data)
+                self._drain()
+            elif self._pending_bytes + len(data) <= self.max_pending:
+                self._pending[offset] = bytes(data)
+                self._pending_bytes += len(data)
+
+    def discard(self, start, end):
+        """
+        Forgets anything held for a range that failed and is going to be fetched again
+        """
+        with self._lock:
+            if start < self.position:
+                self.valid = False
+            for offset in [offset for offset in self._pending.keys() if start <= offset <= end]:
+                self._pending_bytes -= len(self._pending.pop(offset))
+
+    def catch_up(self, limit):
+        """
+        Hashes everything up to limit, reading back from the file whatever wasn't held in memory
+        :param limit: offset up to which the file is known to be complete
+        """
+        with self._lock:
+            while self.valid and self.position < limit:
+                self._drain()
+                if self.position >= limit:
+                    break
+                next_pending = min([offset for offset in self._pending.keys() if offset > self.position], default=limit)
+                data = os.pread(self.fd, min(next_pending, limit) - self.position, self.position)
+                if len(data) == 0:
+                    break
+                self._md5.update(data)
+                self.position += len(data)
+
+    def hexdigest(self):
+        self.catch_up(self.size)
+        return self._md5.hexdigest()
+
+
+class PositionalWriter(object):
+    """
+    File-like object that boto can write a part into. Every write goes to its own place in the file with pwrite, so
+    several parts can be written into the same file at once. The part's MD5 is worked out as it goes.
+    """
+    def __init__(self, fd, offset, name=None, stream_hash=None):
+        self.fd = fd
+        self.offset = offset
+        self.name = name
+        self.written = 0
+        self.md5 = hashlib.md5()
+        self.stream_hash = stream_hash
+
+    def write(self, data):
+        self.md5.update(data)
+        if self.stream_hash is not None:
+            self.stream_hash.feed(self.offset, data)
+        view = memoryview(data)
+        while len(view) > 0:
+            n = os.pwrite(self.fd, view, self.offset)
+            self.offset += n
+            self.written += n
+            view = view[n:]
+
+
+class RangedDownload(object):
+    """
+    Downloads an S3 object as a set of byte ranges fetched in parallel, each written straight into its place in a
+    preallocated file.  The parts that have completed are remembered, so when something fails only the missing parts
+    are fetched again on the next attempt rather than starting over from byte zero.
+    If an ETag is given then the download is checked against it, using MD5s worked out as the data arrives.  For a
+    multipart upload the ranges follow the upload's parts, so the MD5 of each range is the MD5 of a part.  An ETag can't
+    say which range is wrong, so after a mismatch every range is fetched again and the ranges whose MD5 changed are the
+    bad ones; from then on only those are fetched.  If a full second fetch gives exactly the same data then the ETag is
+    not an MD5 of the data that we can check against, and the download is accepted.
+    """
+    def __init__(self, get_key, size, dest_path, part_size=DEFAULT_PART_SIZE, concurrency=4, retries=10, retry_delay=2,
+                 etag=None):
+        """
+        Initialise
+        :param get_key: callable that returns a boto Key for the object. It is called on the thread that fetches each
+        part, because boto keys and connections can't be shared between threads.
+        :param size: size of the object in bytes
+        :param dest_path: file to download to
+        :param part_size: number of bytes to fetch in each request. For an object uploaded in parts with an ETag given,
+        the upload's part size is asked for (see fetch_upload_part_size) and used instead.
+        :param concurrency: number of parts to fetch at once
+        :param retries: number of times to retry after a failed attempt
+        :param retry_delay: seconds to wait before the first retry. This doubles on each retry, up to a minute.
+        :param etag: ETag of the object, to check the download against. If None, the download is not checked.
+        """
+        self.get_key = get_key
+        self.size = size
+        self.dest_path = dest_path
+        self.part_size = max(part_size, 1)
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.completed = set()
+        self.digests = {}
+        self.previous_digests = None
+        self.stream_hash = None
+        self.mismatch = None
+
+        self.expected = parse_etag(etag) if etag is not None else None
+        if etag is not None and self.expected is None:
+            logger.warning("Can't check {0} against ETag {1}".format(dest_path, etag))
+
+    def follow_upload_parts(self):
+        """
+        Lines the ranges up with the parts of a multipart upload, so that their MD5s can be checked against the ETag.
+        If S3 won't tell us the part size, or it doesn't give the number of parts in the ETag, the download can't be
+        checked and isn't.
+        """
+        upload_part_size = fetch_upload_part_size(self.get_key())
+        if upload_part_size is None or upload_part_size <= 0 or math.ceil(self.size / upload_part_size) != self.expected[1]:
+            logger.warning("Can't tell how {0} was uploaded (part size {1}, {2} parts), so it won't be checked against "
+                           "its ETag".format(self.dest_path, upload_part_size, self.expected[1]))
+            self.expected = None
+            return
+        self.part_size = upload_part_size
+
+    @property
+    def parts(self):
+        return [(start, min(start + self.part_size, self.size) - 1) for start in range(0, self.size, self.part_size)]
+
+    def _preallocate(self, fd):
+        if hasattr(os, "posix_fallocate") and self.size > 0:
+            try:
+                os.posix_fallocate(fd, 0, self.size)
+                return
+            except OSError:
+                #not supported by every filesystem
+                pass
+        os.ftruncate(fd, self.size)
+
+    def fetch_part(self, fd, part):
+        """
+        Downloads one byte range into the file
+        :param fd: file descriptor of the destination
+        :param part: tuple of (first byte, last byte)
+        :return: the part
+        """
+        start, end = part
+        writer = PositionalWriter(fd, start, name=self.dest_path, stream_hash=self.stream_hash)
+        try:
+            self.get_key().get_file(writer, headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+            if writer.written != end - start + 1:
+                raise IncompletePart(start, end, writer.written)
+        except Exception:
+            if self.stream_hash is not None:
+                self.stream_hash.discard(start, end)
+            raise
+        self.digests[part] = writer.md5.hexdigest()
+        return part
+
+    def _completed_until(self):
+        """
+        :return: offset up to which every part has completed
+        """
+        limit = 0
+        for start, end in self.parts:
+            if (start, end) not in self.completed:
+                break
+            limit = end + 1
+        return limit
+
+    def _attempt(self, fd, remaining):
+        """
+        Fetches the given parts in parallel
+        :return: the last exception raised, or None if every part completed
+        """
+        failure = None
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(remaining))) as pool:
+            futures = [(part, pool.submit(self.fetch_part, fd, part)) for part in remaining]
+            for part, future in futures:
+                try:
+                    future.result()
+                    self.completed.add(part)
+                    if self.stream_hash is not None:
+                        self.stream_hash.catch_up(self._completed_until())
+                except Exception as e:
+                    logger.warning("Range {0}-{1} of {2} failed: {3}".format(part[0], part[1], self.dest_path, e))
+                    failure = e
+        return failure
+
+    def checksum(self, fd):
+        """
+        Works out the ETag of what we have downloaded, in the same form as the one that we are checking against
+        """
+        if self.expected[1] is not None:
+            part_digests = b"".join([bytes.fromhex(self.digests[part]) for part in self.parts])
+            return "{0}-{1}".format(hashlib.md5(part_digests).hexdigest(), len(self.parts))
+        if self.stream_hash is None or not self.stream_hash.valid:
+            #ranges have been fetched again since we hashed them, so this has to be done from the file
+            self.stream_hash = StreamingMd5(fd, self.size)
+        return self.stream_hash.hexdigest()
+
+    def verify(self, fd):
+        """
+        Checks the download against the ETag
+        :return: list of parts that need fetching again, which is empty if the download is good
+        """
+        expected = self.expected[0] if self.expected[1] is None else "{0}-{1}".format(*self.expected)
+        actual = self.checksum(fd)
+        if actual == expected:
+            return []
+
+        self.mismatch = ChecksumMismatch(self.dest_path, expected, actual)
+        logger.warning(str(self.mismatch))
+        if self.previous_digests is None:
+            bad = self.parts
+        else:
+            bad = [part for part in self.parts if self.digests.get(part) != self.previous_digests.get(part)]
+            if len(bad) == 0:
+                logger.warning("Fetching {0} again gave exactly the same data, so ETag {1} can't be an MD5 that we can "
+                               "check against. Accepting the download.".format(self.dest_path, expected))
+                return []
+        self.previous_digests = dict(self.digests)
+        self.stream_hash = None
+        return bad
+
+    def run(self):
+        """
+        Carries out the download, retrying failed parts
+        :return: dest_path
+        """
+        fd = os.open(self.dest_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._preallocate(fd)
+            if self.expected is not None and self.expected[1] is not None:
+                self.follow_upload_parts()
+            if self.expected is not None and self.expected[1] is None:
+                self.stream_hash = StreamingMd5(fd, self.size)
+            attempt = 0
+            while True:
+                remaining = [part for part in self.parts if part not in self.completed]
+                failure = None
+                if len(remaining) > 0:
+                    logger.info("Downloading {0} of {1} parts to {2}, attempt {3}...".format(len(remaining), len(self.parts),
+                                                                                            self.dest_path, attempt))
+                    failure = self._attempt(fd, remaining)
+                if failure is None:
+                    bad = self.verify(fd) if self.expected is not None else []
+                    if len(bad) == 0:
+                        return self.dest_path
+                    self.completed.difference_update(bad)
+                    failure = self.mismatch
+                attempt += 1
+                if attempt > self.retries:
+                    raise failure
+                time.sleep(min(self.retry_delay * 2**(attempt-1), 60))
+        finally:
+            os.close(fd)
@@ -1,9 +1,13 @@
 from django.conf import settings
-from boto import s3, sts
+from kinesisresponder.credentials import get_credential_provider
+from .s3_download import RangedDownload, DEFAULT_PART_SIZE
+from .download_cache import get_configured_download_cache
+from .storage_manager import get_storage_manager
+import hashlib
 import re
 import os
+import uuid
 import logging
-import time
 logger = logging.getLogger(__name__)
 
 make_filename_re = re.compile(r'[^\w\d\.]')
@@ -32,70 +36,161 @@ class S3Mixin(object):
         self.role_name = role_name
         self.session_name = session_name
 
+    def get_credential_provider(self):
+        return get_credential_provider(self.role_name, self.session_name,
+                                       aws_access_key_id=getattr(settings,'MEDIA_ATOM_AWS_ACCESS_KEY_ID',None),
+                                       aws_secret_access_key=getattr(settings,'MEDIA_ATOM_AWS_SECRET_ACCESS_KEY',None))
+
     def get_s3_connection(self):
         """
-        Uses temporaray role credentials to connect to S3
+        Uses temporary role credentials to connect to S3. The credentials and connection are cached and shared with
+        anything else using the same role, so this does not normally make any calls to AWS.
         :return:
         """
-        sts_conn = sts.connect_to_region('eu-west-1',
-                                         aws_access_key_id=getattr(settings,'MEDIA_ATOM_AWS_ACCESS_KEY_ID',None),
-                                         aws_secret_access_key=getattr(settings,'MEDIA_ATOM_AWS_SECRET_ACCESS_KEY',None)
-                                         )
-        credentials = sts_conn.assume_role(self.role_name, self.session_name)
-        return s3.connect_to_region('eu-west-1', aws_access_key_id=credentials.credentials.access_key,
-                                    aws_secret_access_key=credentials.credentials.secret_key,
-                                    security_token=credentials.credentials.session_token)
+        return self.get_credential_provider().connection('s3')
 
     default_expiry_time=60
 
-    def get_s3_signed_url(self, bucket=None, key=None):
+    #SigV4 presigned URLs can't last longer than a week
+    max_expiry_time=7*24*3600
+
+    @classmethod
+    def signed_url_expiry(cls, size):
         """
-        Requests a signed URL from S3 to download the given content
+        Works out how long a presigned URL for an object of the given size should last. Vidispine may not start reading
+        it straight away and then reads it at its own pace, so this allows for the whole object to be read at
+        ATOM_RESPONDER_PRESIGNED_URL_BYTES_PER_SECOND after ATOM_RESPONDER_PRESIGNED_URL_MARGIN seconds.
+        This is only what we ask for: get_s3_signed_url can't make a URL outlast the role session that signs it.
+        :param size: size of the object in bytes
+        :return: expiry time in seconds
+        """
+        rate = max(getattr(settings, "ATOM_RESPONDER_PRESIGNED_URL_BYTES_PER_SECOND", 2*1024*1024), 1)
+        expiry = getattr(settings, "ATOM_RESPONDER_PRESIGNED_URL_MARGIN", 1800) + int(size / rate)
+        return min(max(expiry, getattr(settings, "ATOM_RESPONDER_PRESIGNED_URL_MIN_EXPIRY", 3600), cls.default_expiry_time),
+                   cls.max_expiry_time)
+
+    def get_s3_signed_url(self, bucket=None, key=None, expiry=None):
+        """
+        Requests a signed URL from S3 to download the given content.
+        A presigned URL stops working when the role session that signed it ends, so it is signed with credentials that
+        last for the whole expiry time, assuming the role for a longer session if need be. If the role can't be assumed
+        for that long (see AWS_ROLE_MAX_SESSION_DURATION) then the expiry is cut down to what the session allows.
         :param bucket:
         :param key:
+        :param expiry: number of seconds that the URL should be valid for. If None, this is worked out from the size of
+        the object with signed_url_expiry
         :return: String of a presigned URL
         """
         conn = self.get_s3_connection()
         bucketref = conn.get_bucket(bucket)
         keyref = bucketref.get_key(key)
-        return keyref.generate_url(self.default_expiry_time, query_auth=True)
+        if keyref is None:
+            raise FileDoesNotExist(bucket, key)
+        if expiry is None:
+            expiry = self.signed_url_expiry(keyref.size)
 
-    def download_to_local_location(self, bucket=None, key=None, filename=None, retries=10, retry_delay=2):
+        provider = self.get_credential_provider()
+        credentials = provider.get_credentials(lifetime=expiry)
+        remaining = int(provider.remaining_lifetime(credentials))
+        if remaining < expiry:
+            logger.warning("Wanted a presigned URL for s3://{0}/{1} to last {2}s, but the role session only lasts another {3}s".format(
+                bucket, key, expiry, remaining))
+            expiry = remaining
+        return provider.make_connection('s3', credentials).generate_url(expiry, 'GET', bucket=bucket, key=key, query_auth=True)
+
+    def download_to_local_location(self, bucket=None, key=None, filename=None, retries=10, retry_delay=2, atom_id=None):
         """
-        Downloads the content from the bucket to a location given by the settings
+        Downloads the content from the bucket to a location given by the settings. The object is fetched as byte ranges
+        in parallel (ATOM_RESPONDER_DOWNLOAD_CONCURRENCY at a time, ATOM_RESPONDER_DOWNLOAD_PART_SIZE bytes each) and
+        a retry only fetches the ranges that did not complete.  Unless ATOM_RESPONDER_VERIFY_DOWNLOADS is off, the download
+        is checked against the object's ETag as it arrives.
+        If the download cache is on and already has this version of the object, it is linked into place instead.
+        The file is registered with the storage manager, which waits for space to be freed first if the disk is too full.
         :param bucket:
         :param key:
         :param filename: file name to download to. If None, then the basename of key is used
+        :param atom_id: atom ID that the media is for, used to pick the subdirectory to download to
         :return: filepath that has been downloaded
         """
-        import traceback
         logger.info("Downloading from s3://{0}/{1} to {2}".format(bucket, key, filename))
-        dest_path = self.get_download_filename(key, overridden_name=filename)
         conn = self.get_s3_connection()
         bucketref = conn.get_bucket(bucket)
         keyref = bucketref.get_key(key)
 
         if keyref is None:
             raise FileDoesNotExist(bucket, key)
-        n=0
-        while True:
-            logger.info("Downloading {0}/{1} to {2}, attempt {3}...".format(bucket, key, dest_path,n))
-            try:
-                with open(dest_path, "wb") as f:
-                    keyref.get_contents_to_file(f)
-                logger.info("Completed downloading {0}/{1}".format(bucket,key))
-                return dest_path
-            except Exception as e:
-                #if something goes wrong, log it and retry
-                logger.error(str(e))
-                logger.error(traceback.format_exc())
-                time.sleep(retry_delay)
-                n+=1
-                if n>retries:
-                    raise
+        dest_path = self.get_download_filename(key, overridden_name=filename, atom_id=atom_id)
+
+        #get_key is a HEAD request, so we already know the ETag of the current version of the object
+        cache = self.get_download_cache()
+        storage = get_storage_manager()
+        etag = getattr(keyref, "etag", None)
+        if cache is not None and etag is not None and cache.fetch(bucket, key, etag, dest_path, size=keyref.size):
+            logger.info("s3://{0}/{1} with ETag {2} is already in the download cache, reusing it".format(bucket, key, etag))
+            storage.register(dest_path, keyref.size)
+            return dest_path
+
+        download = RangedDownload(lambda: self.get_s3_connection().get_bucket(bucket, validate=False).new_key(key),
+                                  keyref.size,
+                                  dest_path,
+                                  part_size=getattr(settings, "ATOM_RESPONDER_DOWNLOAD_PART_SIZE", DEFAULT_PART_SIZE),
+                                  concurrency=getattr(settings, "ATOM_RESPONDER_DOWNLOAD_CONCURRENCY", 4),
+                                  retries=retries,
+                                  retry_delay=retry_delay,
+                                  etag=etag if self.should_verify(keyref) else None)
+        entry = storage.register(dest_path, keyref.size)
+        try:
+            #this waits for space to be freed up if the disk is too full
+            with storage.reserve(keyref.size):
+                download.run()
+        except Exception:
+            #don't leave a partial file, or the empty one that reserved the name, behind
+            storage.remove(entry)
+            raise
+        logger.info("Completed downloading {0}/{1}".format(bucket,key))
+        if cache is not None and etag is not None:
+            cache.store(bucket, key, etag, dest_path)
+        return dest_path
+
+    @staticmethod
+    def should_verify(keyref):
+        """
+        Returns True if a download of the given key can be checked against its ETag. The ETag of an object encrypted
+        with SSE-KMS is not an MD5 of its content.
+        """
+        if not getattr(settings, "ATOM_RESPONDER_VERIFY_DOWNLOADS", True):
+            return False
+        return getattr(keyref, "encrypted", None) != "aws:kms"
+
+    @staticmethod
+    def get_download_cache():
+        """
+        Returns the shared download cache, or None if ATOM_RESPONDER_DOWNLOAD_CACHE_MAX_BYTES is 0
+        """
+        return get_configured_download_cache()
+
+    @staticmethod
+    def download_subdirectory(key=None, atom_id=None):
+        """
+        Downloads are spread across 256 subdirectories so that no single directory gets too big to scan. Files for an
+        atom go in the one named after the first two characters of its ID, otherwise a hash of the key is used.
+        :return: name of the subdirectory
+        """
+        if atom_id is not None and len(atom_id) >= 2:
+            return make_filename_re.sub('_', atom_id[:2].lower())
+        return hashlib.md5((key or "").encode("UTF-8")).hexdigest()[:2]
 
     @staticmethod
-    def get_download_filename(key=None, overridden_name=None):
+    def get_download_filename(key=None, overridden_name=None, atom_id=None):
+        """
+        Works out a safe, unique path to download to and reserves it by creating it as an empty file, so that no other
+        thread or process can be given the same path. If the name is already taken then a random suffix is added, rather
+        than searching for the next free number.
+        :param key: S3 key being downloaded
+        :param overridden_name: file name to use instead of the basename of the key
+        :param atom_id: atom ID that the file is for, which decides the subdirectory
+        :return: path of the newly created, empty file
+        """
         safe_basefile = make_filename_re.sub('_', os.path.basename(overridden_name if overridden_name is not None else key))
         deduped_basefile = multiple_underscore_re.sub('_', safe_basefile)
 
@@ -107,11 +202,14 @@ class S3Mixin(object):
             nameonly = deduped_basefile
             extension = ""
 
+        directory = os.path.join(settings.ATOM_RESPONDER_DOWNLOAD_PATH, S3Mixin.download_subdirectory(key, atom_id))
+        os.makedirs(directory, exist_ok=True)
+
         number_part = ""
-        n=0
         while True:
-            path = os.path.join(settings.ATOM_RESPONDER_DOWNLOAD_PATH, nameonly + number_part + extension)
-            if not os.path.exists(path):
+            path = os.path.join(directory, nameonly + number_part + extension)
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
                 return path
-            n+=1
-            number_part = "-{0}".format(n)
\ No newline at end of file
+            except FileExistsError:
+                number_part = "-" + uuid.uuid4().hex[:8]
@@ -0,0 +1,207 @@
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from contextlib import contextmanager
+from datetime import timedelta
+from threading import Lock
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientDiskSpace(Exception):
+    def __init__(self, path, needed, free):
+        self.path = path
+        self.needed = needed
+        self.free = free
+
+    def __str__(self):
+        return "Needed {0} bytes on {1} but only {2} are free".format(self.needed, self.path, self.free)
+
+
+class StorageManager(object):
+    """
+    Looks after the space in the download directory.  Every downloaded file has a DownloadedFile row, which is tied to
+    its ImportJob once the import has started:
+     - when Vidispine reports that the job FINISHED the file is deleted straight away
+     - when the job ends any other way the file is kept, but it is no longer in use and can be evicted
+     - a file that never got an ImportJob (e.g. the import request failed) can be evicted once it is orphan_age old
+    Before each download we make sure that the new file will fit below the high-water mark and still leave
+    reserve_bytes free, evicting the least recently used files that are not in use if need be, and then entries from
+    the download cache.  The cache holds hard links to downloads, so removing one name only frees space once the other
+    has gone too; only files with a single link are counted as freed.  If that isn't enough then the download is
+    deferred, waiting for imports to finish and free up space, for up to wait_timeout seconds.
+    """
+    def __init__(self, root, high_water_mark=0.85, reserve_bytes=1024*1024*1024, wait_timeout=900, poll_interval=30,
+                 orphan_age=86400, cache=None, disk_usage=shutil.disk_usage, clock=time.monotonic, sleep=time.sleep):
+        self.root = root
+        self.cache = cache
+        self.high_water_mark = high_water_mark
+        self.reserve_bytes = reserve_bytes
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.orphan_age = timedelta(seconds=orphan_age)
+        self._disk_usage = disk_usage
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = Lock()
+        #bytes promised to downloads that are in progress in this process
+        self._reserved = 0
+
+    def shortfall(self, size):
+        """
+        Works out how much we would need to free up to download a file of the given size
+        :return: number of bytes, which is 0 or less if the file fits
+        """
+        usage = self._disk_usage(self.root)
+        needed = size + self._reserved
+        over_free = needed + self.reserve_bytes - usage.free
+        over_high_water = usage.used + needed - int(usage.total * self.high_water_mark)
+        return max(over_free, over_high_water)
+
+    def evictable(self):
+        """
+        :return: queryset of the files that we can delete, least recently used first
+        """
+        from .models import DownloadedFile
+        orphaned_before = timezone.now() - self.orphan_age
+        return DownloadedFile.objects\
+            .filter(Q(in_use=False) | Q(import_job__isnull=True, downloaded_at__lt=orphaned_before))\
+            .order_by('last_used_at')
+
+    def remove(self, entry):
+        """
+        Deletes a file and its DownloadedFile row
+        :return: number of bytes freed, which is 0 if the file is still linked into the download cache
+        """
+        try:
+            freeable = os.stat(entry.path).st_nlink == 1
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            logger.warning("{0} had already been removed".format(entry.path))
+            freeable = False
+        except OSError as e:
+            logger.error("Could not remove {0}: {1}".format(entry.path, e))
+            return 0
+        entry.delete()
+        return entry.size if freeable else 0
+
+    def evict(self, bytes_needed):
+        """
+        Removes files that are not in use, least recently used first, and then download cache entries until
+        bytes_needed have been freed
+        :return: number of bytes freed
+        """
+        freed = 0
+        for entry in self.evictable().iterator():
+            if freed >= bytes_needed:
+                break
+            logger.info("Evicting {0} to free up space".format(entry))
+            freed += self.remove(entry)
+        if freed < bytes_needed and self.cache is not None:
+            freed += self.cache.free_space(bytes_needed - freed)
+        return freed
+
+    def ensure_space(self, size):
+        """
+        Makes room for a file of the given size, evicting old files and then waiting if necessary.  On success the space
+        is reserved for us until release() is called.
+        :param size: size of the file in bytes
+        :raises InsufficientDiskSpace: if there is still not enough room after wait_timeout seconds
+        :return: None
+        """
+        deadline = self._clock() + self.wait_timeout
+        while True:
+            with self._lock:
+                shortfall = self.shortfall(size)
+                if shortfall > 0:
+                    shortfall -= self.evict(shortfall)
+                if shortfall <= 0:
+                    self._reserved += size
+                    return
+            if self._clock() >= deadline:
+                raise InsufficientDiskSpace(self.root, size, self._disk_usage(self.root).free)
+            logger.warning("Not enough space in {0} for {1} bytes, {2} bytes short. Waiting for imports to finish...".format(self.root, size, shortfall))
+            self._sleep(self.poll_interval)
+
+    def release(self, size):
+        with self._lock:
+            self._reserved = max(self._reserved - size, 0)
+
+    @contextmanager
+    def reserve(self, size):
+        """
+        Context manager that makes room for a download of the given size, and holds on to the space while it runs
+        """
+        self.ensure_space(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def register(self, path, size):
+        """
+        Records that we have downloaded a file
+        :return: DownloadedFile instance
+        """
+        from .models import DownloadedFile
+        now = timezone.now()
+        entry, created = DownloadedFile.objects.update_or_create(path=path, defaults={
+            "size": size,
+            "import_job": None,
+            "downloaded_at": now,
+            "last_used_at": now,
+            "in_use": True,
+        })
+        return entry
+
+    def assign(self, path, import_job):
+        """
+        Ties a downloaded file to the ImportJob that is reading it
+        :return: None
+        """
+        from .models import DownloadedFile
+        DownloadedFile.objects.filter(path=path).update(import_job=import_job, in_use=True, last_used_at=timezone.now())
+
+    def job_completed(self, import_job):
+        """
+        Call this when Vidispine has told us that an import has ended.  If it succeeded its files are deleted, otherwise
+        they are left for eviction.
+        :param import_job: ImportJob instance
+        :return: number of bytes freed
+        """
+        if import_job.status != 'FINISHED':
+            import_job.downloaded_files.update(in_use=False)
+            return 0
+
+        freed = 0
+        with transaction.atomic():
+            for entry in import_job.downloaded_files.select_for_update():
+                logger.info("{0}: import finished, removing {1}".format(import_job.item_id, entry.path))
+                freed += self.remove(entry)
+        return freed
+
+
+_managers = {}
+_managers_lock = Lock()
+
+
+def get_storage_manager():
+    """
+    Returns the shared StorageManager for ATOM_RESPONDER_DOWNLOAD_PATH, configured from the settings
+    """
+    from django.conf import settings
+    from .download_cache import get_configured_download_cache
+    root = settings.ATOM_RESPONDER_DOWNLOAD_PATH
+    with _managers_lock:
+        if root not in _managers:
+            _managers[root] = StorageManager(root,
+                                             high_water_mark=getattr(settings, "ATOM_RESPONDER_DOWNLOAD_HIGH_WATER_MARK", 0.85),
+                                             reserve_bytes=getattr(settings, "ATOM_RESPONDER_DOWNLOAD_RESERVE_BYTES", 1024*1024*1024),
+                                             wait_timeout=getattr(settings, "ATOM_RESPONDER_DOWNLOAD_SPACE_WAIT", 900),
+                                             orphan_age=getattr(settings, "ATOM_RESPONDER_DOWNLOAD_ORPHAN_AGE", 86400),
+                                             cache=get_configured_download_cache())
+        return _managers[root]
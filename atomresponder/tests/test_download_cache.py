@@ -0,0 +1,117 @@
+import django.test
+from mock import patch
+import os
+import shutil
+import tempfile
+
+
+class TestDownloadCache(django.test.SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, ".cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.tempdir, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def test_store_and_fetch(self):
+        """
+        DownloadCache should hard-link a stored file into place for the same bucket, key and ETag, and nothing else
+        :return:
+        """
+        from atomresponder.download_cache import DownloadCache
+
+        c = DownloadCache(self.cachedir, 1024)
+        downloaded = self.make_file("first.mp4", 100)
+        c.store("bucket", "path/to/media.mp4", '"abc123"', downloaded)
+
+        dest = os.path.join(self.tempdir, "second.mp4")
+        self.assertTrue(c.fetch("bucket", "path/to/media.mp4", '"abc123"', dest, size=100))
+        self.assertEqual(os.stat(dest).st_ino, os.stat(downloaded).st_ino)
+
+        self.assertFalse(c.fetch("bucket", "path/to/media.mp4", '"def456"', os.path.join(self.tempdir, "third.mp4")))
+        self.assertFalse(c.fetch("otherbucket", "path/to/media.mp4", '"abc123"', os.path.join(self.tempdir, "third.mp4")))
+        self.assertFalse(c.fetch("bucket", "path/to/media.mp4", '"abc123"', os.path.join(self.tempdir, "third.mp4"), size=200))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "third.mp4")))
+        self.assertEqual(c.hits, 1)
+        self.assertEqual(c.misses, 3)
+
+    def test_entry_survives_deletion(self):
+        """
+        the cached copy should still be there once the downloaded file has been deleted
+        :return:
+        """
+        from atomresponder.download_cache import DownloadCache
+
+        c = DownloadCache(self.cachedir, 1024)
+        downloaded = self.make_file("first.mp4", 100)
+        c.store("bucket", "media.mp4", "abc123", downloaded)
+        os.unlink(downloaded)
+
+        self.assertTrue(c.fetch("bucket", "media.mp4", "abc123", downloaded))
+        self.assertEqual(os.path.getsize(downloaded), 100)
+
+    def test_evict(self):
+        """
+        DownloadCache should evict the least recently used entries once it goes over its size limit
+        :return:
+        """
+        from atomresponder.download_cache import DownloadCache
+
+        c = DownloadCache(self.cachedir, 350)
+        for n in range(3):
+            c.store("bucket", "media{0}.mp4".format(n), "etag", self.make_file("media{0}.mp4".format(n), 100))
+            os.utime(c.entry_path("bucket", "media{0}.mp4".format(n), "etag"), (1000 + n, 1000 + n))
+
+        #using media0 makes it the most recent, so media1 goes next
+        self.assertIsNotNone(c.lookup("bucket", "media0.mp4", "etag"))
+        c.store("bucket", "media3.mp4", "etag", self.make_file("media3.mp4", 100))
+
+        self.assertIsNotNone(c.lookup("bucket", "media0.mp4", "etag"))
+        self.assertIsNone(c.lookup("bucket", "media1.mp4", "etag"))
+        self.assertIsNotNone(c.lookup("bucket", "media2.mp4", "etag"))
+        self.assertIsNotNone(c.lookup("bucket", "media3.mp4", "etag"))
+
+    def test_fetch_replaces_placeholder(self):
+        """
+        fetch should swap the cached copy in over an empty file that was created to reserve the name
+        :return:
+        """
+        from atomresponder.download_cache import DownloadCache
+
+        c = DownloadCache(self.cachedir, 1024)
+        c.store("bucket", "media.mp4", "abc123", self.make_file("first.mp4", 100))
+        placeholder = self.make_file("second.mp4", 0)
+
+        self.assertTrue(c.fetch("bucket", "media.mp4", "abc123", placeholder))
+        self.assertEqual(os.path.getsize(placeholder), 100)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), [".cache", "first.mp4", "second.mp4"])
+
+    def test_fetch_evicted(self):
+        """
+        if the entry is evicted between being looked up and being linked, fetch should leave nothing behind and report
+        a miss so that the object is downloaded instead
+        :return:
+        """
+        from atomresponder.download_cache import DownloadCache
+
+        c = DownloadCache(self.cachedir, 1024)
+        c.store("bucket", "media.mp4", "abc123", self.make_file("first.mp4", 100))
+        placeholder = self.make_file("second.mp4", 0)
+        real_lookup = c.lookup
+
+        def lookup_then_evict(*args, **kwargs):
+            path = real_lookup(*args, **kwargs)
+            os.unlink(path)
+            return path
+
+        with patch.object(c, "lookup", side_effect=lookup_then_evict):
+            self.assertFalse(c.fetch("bucket", "media.mp4", "abc123", placeholder))
+        self.assertEqual(os.path.getsize(placeholder), 0)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), [".cache", "first.mp4", "second.mp4"])
+        self.assertEqual((c.hits, c.misses), (0, 1))
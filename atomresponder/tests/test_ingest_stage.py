@@ -0,0 +1,145 @@
+import django.test
+from threading import Event, Thread
+
+
+class TestIngestStage(django.test.TransactionTestCase):
+    """
+    The stage runs the ingest on its own threads, so these need real transactions. Only one worker is used because the
+    sqlite test database can't take writes from several threads at once.
+    """
+    @staticmethod
+    def make_staged(n, atom_id="atom-1", status='PENDING', owner=None):
+        from atomresponder.models import StagedIngest
+        staged = StagedIngest(stream_name="stream", shard_id="shard-1", atom_id=atom_id, s3_key="key-{0}".format(n),
+                              record='{"atomId": "%s"}' % atom_id, status=status, owner=owner)
+        staged.save()
+        return staged
+
+    def test_run(self):
+        """
+        a staged ingest should be removed once it has run, and left as FAILED with the error if it raised
+        :return:
+        """
+        from atomresponder.ingest_stage import IngestStage
+        from atomresponder.models import StagedIngest
+
+        ran = []
+
+        def ingest(staged):
+            ran.append(staged.s3_key)
+            if staged.s3_key == "key-2":
+                raise RuntimeError("Vidispine said no")
+
+        stage = IngestStage(worker_count=1, queue_size=2)
+        first = self.make_staged(1)
+        second = self.make_staged(2)
+        stage.hand_off(first, ingest)
+        stage.hand_off(second, ingest)
+        stage.wait_idle()
+
+        self.assertEqual(ran, ["key-1", "key-2"])
+        self.assertFalse(StagedIngest.objects.filter(pk=first.pk).exists())
+        failed = StagedIngest.objects.get(pk=second.pk)
+        self.assertEqual(failed.status, 'FAILED')
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn("Vidispine said no", failed.last_error)
+
+        #a row that has already been dealt with is not run again
+        self.assertIsNone(stage.run(second.pk, ingest))
+        self.assertEqual(len(ran), 2)
+
+    def test_backpressure(self):
+        """
+        hand_off should block while the workers and the queue are full
+        :return:
+        """
+        from atomresponder.ingest_stage import IngestStage
+
+        may_finish = Event()
+        stage = IngestStage(worker_count=1, queue_size=1)
+        rows = [self.make_staged(n, atom_id="atom-{0}".format(n)) for n in range(3)]
+
+        stage.hand_off(rows[0], lambda staged: may_finish.wait(5))
+        stage.hand_off(rows[1], lambda staged: None)
+
+        third_handed_off = Event()
+
+        def hand_off_third():
+            stage.hand_off(rows[2], lambda staged: None)
+            third_handed_off.set()
+
+        t = Thread(target=hand_off_third)
+        t.start()
+        self.assertFalse(third_handed_off.wait(0.2))
+        may_finish.set()
+        self.assertTrue(third_handed_off.wait(5))
+        t.join()
+        stage.wait_idle()
+
+    def test_recover(self):
+        """
+        recover should hand off pending ingests, ones left running by another process that has stopped updating them,
+        and failed ones that are due a retry, but not our own or ones that another process is still working on
+        :return:
+        """
+        from atomresponder.ingest_stage import IngestStage, worker_id
+        from atomresponder.models import StagedIngest
+        from django.utils import timezone
+        from datetime import timedelta
+
+        long_ago = timezone.now() - timedelta(hours=1)
+        pending = self.make_staged(1)
+        abandoned = self.make_staged(2, status='RUNNING', owner="oldhost:1:deadbeef")
+        mine = self.make_staged(3, status='RUNNING', owner=worker_id)
+        failed = self.make_staged(4, status='FAILED')
+        other_shard = self.make_staged(5)
+        other_shard.shard_id = "shard-2"
+        other_shard.save()
+        still_running = self.make_staged(6, status='RUNNING', owner="otherhost:1:cafef00d")
+        failed_long_ago = self.make_staged(7, status='FAILED')
+        given_up = self.make_staged(8, status='FAILED')
+        StagedIngest.objects.filter(pk__in=[abandoned.pk, failed_long_ago.pk, given_up.pk]).update(updated_at=long_ago)
+        StagedIngest.objects.filter(pk=failed_long_ago.pk).update(attempts=1)
+        StagedIngest.objects.filter(pk=given_up.pk).update(attempts=3)
+
+        ran = []
+        stage = IngestStage(worker_count=1, queue_size=10, stale_after=600, max_attempts=3, retry_delay=60)
+        self.assertEqual(stage.recover("stream", "shard-1", lambda staged: ran.append(staged.s3_key)), 3)
+        stage.wait_idle()
+
+        self.assertEqual(sorted(ran), ["key-1", "key-2", "key-7"])
+        self.assertEqual(sorted(StagedIngest.objects.values_list('s3_key', flat=True)), ["key-3", "key-4", "key-5", "key-6", "key-8"])
+
+    def test_sweep(self):
+        """
+        sweep should retry a failed ingest on a shard that we have recovered once it is due, but leave pending ones alone
+        :return:
+        """
+        from atomresponder.ingest_stage import IngestStage
+        from atomresponder.models import StagedIngest
+        from django.utils import timezone
+        from datetime import timedelta
+
+        ran = []
+        stage = IngestStage(worker_count=1, queue_size=10, retry_delay=60)
+        self.assertEqual(stage.recover("stream", "shard-1", lambda staged: ran.append(staged.s3_key)), 0)
+
+        failed = self.make_staged(1, status='FAILED')
+        self.make_staged(2)
+        self.assertEqual(stage.sweep(), 0)
+        StagedIngest.objects.filter(pk=failed.pk).update(attempts=1, updated_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(stage.sweep(), 1)
+        stage.wait_idle()
+        self.assertEqual(ran, ["key-1"])
+
+    def test_heartbeat(self):
+        """
+        heartbeat should only touch the rows that this process is running
+        :return:
+        """
+        from atomresponder.ingest_stage import IngestStage, worker_id
+
+        self.make_staged(1, status='RUNNING', owner=worker_id)
+        self.make_staged(2, status='RUNNING', owner="otherhost:1:cafef00d")
+        self.make_staged(3)
+        self.assertEqual(IngestStage().heartbeat(), 1)
@@ -0,0 +1,105 @@
+import django.test
+
+
+class TestItemMapping(django.test.TestCase):
+    def test_get(self):
+        """
+        get should read through to the database and then answer from memory
+        :return:
+        """
+        from atomresponder.item_mapping import ItemMapping
+        from atomresponder.models import AtomItemMapping
+
+        AtomItemMapping(atom_id="atom-1", item_id="VX-1").save()
+        mapping = ItemMapping(max_entries=10)
+        self.assertIsNone(mapping.get("atom-2"))
+        self.assertEqual(mapping.get("atom-1"), "VX-1")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(mapping.get("atom-1"), "VX-1")
+        self.assertEqual(mapping.hits, 2)
+        self.assertEqual(mapping.misses, 1)
+
+    def test_get_verifies(self):
+        """
+        once an entry in memory is verify_after seconds old, get should check it against the database, so that a mapping
+        removed by another process is not used for long
+        :return:
+        """
+        from atomresponder.item_mapping import ItemMapping
+        from atomresponder.models import AtomItemMapping
+
+        now = [1000.0]
+        mapping = ItemMapping(max_entries=10, verify_after=60, clock=lambda: now[0])
+        mapping.remember("atom-1", "VX-1")
+        mapping.remember("atom-2", "VX-2")
+        #as the rabbitmq responder does when Vidispine says the item has been deleted
+        AtomItemMapping.objects.filter(item_id="VX-1").delete()
+
+        now[0] += 30
+        with self.assertNumQueries(0):
+            self.assertEqual(mapping.get("atom-1"), "VX-1")
+        now[0] += 30
+        self.assertIsNone(mapping.get("atom-1"))
+        self.assertNotIn("atom-1", mapping._entries)
+        self.assertEqual(mapping.get("atom-2"), "VX-2")
+        #checking it again starts the clock again
+        with self.assertNumQueries(0):
+            self.assertEqual(mapping.get("atom-2"), "VX-2")
+
+    def test_remember(self):
+        """
+        remember should save the mapping and keep at most max_entries in memory
+        :return:
+        """
+        from atomresponder.item_mapping import ItemMapping
+        from atomresponder.models import AtomItemMapping
+
+        mapping = ItemMapping(max_entries=2)
+        mapping.remember("atom-1", "VX-1")
+        mapping.remember("atom-2", "VX-2")
+        mapping.get("atom-1")
+        mapping.remember("atom-3", "VX-3")
+        mapping.remember("atom-3", "VX-4")
+
+        self.assertEqual(list(mapping._entries.keys()), ["atom-1", "atom-3"])
+        self.assertEqual(dict(AtomItemMapping.objects.values_list('atom_id', 'item_id')),
+                         {"atom-1": "VX-1", "atom-2": "VX-2", "atom-3": "VX-4"})
+        #atom-2 was evicted from memory but is still in the database
+        self.assertEqual(mapping.get("atom-2"), "VX-2")
+
+    def test_forget_item(self):
+        """
+        forget_item should remove every mapping to the item from memory and the database
+        :return:
+        """
+        from atomresponder.item_mapping import ItemMapping
+        from atomresponder.models import AtomItemMapping
+
+        mapping = ItemMapping(max_entries=10)
+        mapping.remember("atom-1", "VX-1")
+        mapping.remember("atom-2", "VX-2")
+        self.assertEqual(mapping.forget_item("VX-1"), 1)
+        self.assertEqual(mapping.forget_item("VX-1"), 0)
+
+        self.assertIsNone(mapping.get("atom-1"))
+        self.assertEqual(mapping.get("atom-2"), "VX-2")
+        self.assertEqual(list(AtomItemMapping.objects.values_list('atom_id', flat=True)), ["atom-2"])
+
+    def test_forget_atom(self):
+        """
+        forget_atom should remove the mapping for an atom, but only if it still points to the missing item
+        :return:
+        """
+        from atomresponder.item_mapping import ItemMapping
+        from atomresponder.models import AtomItemMapping
+
+        mapping = ItemMapping(max_entries=10)
+        mapping.remember("atom-1", "VX-1")
+        mapping.remember("atom-2", "VX-2")
+        self.assertTrue(mapping.forget_atom("atom-1", "VX-1"))
+        self.assertFalse(mapping.forget_atom("atom-2", "VX-1"))
+
+        self.assertIsNone(mapping.get("atom-1"))
+        self.assertEqual(mapping.get("atom-2"), "VX-2")
+        self.assertEqual(list(AtomItemMapping.objects.values_list('atom_id', flat=True)), ["atom-2"])
@@ -2,7 +2,6 @@
 import django.test
 from gnmvidispine.vs_collection import VSCollection
 from mock import MagicMock, patch
-import pika
 import posix
 
 class TestMasterImporter(django.test.TestCase):
@@ -96,13 +95,10 @@ class TestMasterImporter(django.test.TestCase):
 
         pacxml = PacFormXml.objects.get(atom_id=fake_data['atomId'])
 
-        mocked_channel = MagicMock(target=pika.spec.Channel)
-        mocked_connection = MagicMock(target=pika.spec.Connection)
+        mocked_publisher = MagicMock()
         mocked_statinfo = posix.stat_result((0,0,0,0,0,0,1234,1600349884.0,1600349884.0,1600349884.0))
 
-        with patch('atomresponder.master_importer.MasterImportResponder.setup_pika_channel',
-                   return_value=(mocked_connection, mocked_channel)
-                   ):
+        with patch('atomresponder.master_importer.get_publisher', return_value=mocked_publisher):
             with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
                 with patch('atomresponder.pac_xml.PacXmlProcessor', return_value=pac_processor):
                     with patch('os.stat', return_value=mocked_statinfo):
@@ -112,8 +108,7 @@ class TestMasterImporter(django.test.TestCase):
                         m.import_new_item(master_item, fake_data)
                         pac_processor.link_to_item.assert_called_once_with(pacxml, master_item)
                         master_item.import_to_shape.assert_called_once_with(essence=True, jobMetadata={'gnm_source': 'media_atom'}, priority='HIGH', shape_tag='lowres', uri='file:///path/to/local/file')
-                        mocked_channel.basic_publish.assert_called_once()
-                        mocked_connection.close.assert_called_once()
+                        mocked_publisher.publish.assert_called_once()
 
     def test_import_new_item_nopac(self):
         """
@@ -151,13 +146,10 @@ class TestMasterImporter(django.test.TestCase):
         with self.assertRaises(PacFormXml.DoesNotExist):
             PacFormXml.objects.get(atom_id=fake_data['atomId'])
 
-        mocked_channel = MagicMock(target=pika.spec.Channel)
-        mocked_connection = MagicMock(target=pika.spec.Connection)
+        mocked_publisher = MagicMock()
 
         mocked_statinfo = posix.stat_result((0,0,0,0,0,0,1234,1600349884.0,1600349884.0,1600349884.0))
-        with patch('atomresponder.master_importer.MasterImportResponder.setup_pika_channel',
-                   return_value=(mocked_connection, mocked_channel)
-                   ):
+        with patch('atomresponder.master_importer.get_publisher', return_value=mocked_publisher):
             with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
                 with patch('atomresponder.pac_xml.PacXmlProcessor', return_value=pac_processor):
                     with patch('os.stat', return_value=mocked_statinfo):
@@ -401,13 +393,10 @@ class TestMasterImporter(django.test.TestCase):
 
     def test_update_pluto_record_noprojectid(self):
         from atomresponder.master_importer import MasterImportResponder
-        import os
         import atomresponder.constants as const
-        fake_connection = MagicMock(pika.connection.Connection)
-        fake_channel = MagicMock(pika.spec.Channel)
-        fake_channel.close = MagicMock()
-        fake_channel.basic_publish = MagicMock()
-        fake_connection.close = MagicMock()
+        import json
+        from rabbitmq.publisher import Publisher
+        fake_publisher = MagicMock(target=Publisher)
 
         content = {
             "type": const.MESSAGE_TYPE_MEDIA,
@@ -418,18 +407,17 @@ class TestMasterImporter(django.test.TestCase):
         }
 
         with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
-            with patch('atomresponder.master_importer.MasterImportResponder.setup_pika_channel',
-                       return_value=(fake_connection, fake_channel)):
+            with patch('atomresponder.master_importer.get_publisher', return_value=fake_publisher):
                 m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-0000")
                 m.update_pluto_record("VX-123", "VX-456", content, None)
+                m.update_pluto_record("VX-123", "VX-457", content, None)
 
-                fake_channel.basic_publish.assert_called_once()
-                if "CI" in os.environ:
-                    fake_channel.close.assert_called_once()
-                else:
-                    #if CI is not set then the connection is checked during initialization, so close is called twice
-                    self.assertEqual(fake_channel.close.call_count, 2)
-                fake_connection.close.assert_called_once()
+                #both messages go out through the shared publisher, rather than a new connection each
+                self.assertEqual(fake_publisher.publish.call_count, 2)
+                routing_key, body = fake_publisher.publish.call_args[0]
+                self.assertEqual(routing_key, "atomresponder.atom.video-upload")
+                self.assertEqual(json.loads(body.decode("UTF-8"))["jobId"], "VX-457")
+                self.assertIsNone(json.loads(body.decode("UTF-8"))["commissionId"])
 
     def test_check_for_old_finished_jobs(self):
         """
@@ -501,4 +489,352 @@ class TestMasterImporter(django.test.TestCase):
         with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials') as mock_refresh_creds:
             m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
             processing_job = m.check_for_processing('VX-99')
-            self.assertEqual(processing_job, False)
\ No newline at end of file
+            self.assertEqual(processing_job, False)
+
+    def test_import_checks(self):
+        """
+        import_checks should find out everything about earlier imports in one query
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder, ImportChecks
+
+        with self.assertNumQueries(1):
+            checks = MasterImportResponder.import_checks('VX-1', key='uploads/06636fe2-10f1-418f-b4df-91f5353931ac-3/complete',
+                                                         atom_id='CB05A372-DC89-4F55-82F6-0BF45B4688A3')
+        self.assertEqual(checks, ImportChecks(old_finished_jobs=True, old_key=True, processing=True, last_retry_number=0))
+
+        checks = MasterImportResponder.import_checks('VX-99', key='uploads/nothing-here', atom_id='52E6E8F2-37A8-4EAE-9A5B-55E4C0F0C4A5')
+        self.assertEqual(checks, ImportChecks(old_finished_jobs=False, old_key=False, processing=False, last_retry_number=None))
+
+    def test_import_new_item_query_count(self):
+        """
+        import_new_item should make one query about earlier imports, and no more queries than it needs in total
+        :return:
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.models import ImportJob
+        from gnmvidispine.vs_item import VSItem
+        from gnmvidispine.vs_job import VSJob
+        fake_data = {
+            'atomId': "F6ED398D-9C71-4DBE-A519-C90F901CEB2A",
+            's3Key': "path/to/s3data",
+            's3Bucket': "sandcastles",
+        }
+
+        import_job = MagicMock(target=VSJob)
+        import_job.name = "VX-557"
+        master_item = MagicMock(target=VSItem)
+        master_item.import_to_shape = MagicMock(return_value=import_job)
+        master_item.name = "VX-1234"
+        master_item.get = MagicMock(return_value=None)
+        mocked_statinfo = posix.stat_result((0,0,0,0,0,0,1234,1600349884.0,1600349884.0,1600349884.0))
+
+        with patch('atomresponder.master_importer.get_publisher'):
+            with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+                with patch('atomresponder.master_importer.get_storage_manager'):
+                    with patch('os.stat', return_value=mocked_statinfo):
+                        m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                        m.download_to_local_location = MagicMock(return_value="/path/to/local/file")
+                        with CaptureQueriesContext(connection) as queries:
+                            m.import_new_item(master_item, fake_data)
+
+        importjob_selects = [q for q in queries.captured_queries
+                             if q['sql'].startswith("SELECT") and ImportJob._meta.db_table in q['sql']]
+        self.assertEqual(len(importjob_selects), 1)
+        #the checks, saving the new ImportJob and looking for PAC data
+        self.assertEqual(len(queries.captured_queries), 3)
+        self.assertEqual(ImportJob.objects.get(job_id="VX-557").retry_number, 0)
+    def test_ordering_key(self):
+        """
+        ordering_key should return the atom ID from the message, or the partition key if the message can't be read
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials') as mock_refresh_creds:
+            m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+            self.assertEqual(m.ordering_key({'PartitionKey': 'pk', 'Data': '{"atomId": "some-atom", "type": "video-upload"}'}), "some-atom")
+            self.assertEqual(m.ordering_key({'PartitionKey': 'pk', 'Data': 'not json'}), "pk")
+            self.assertEqual(m.ordering_key({'PartitionKey': 'pk', 'Data': '{"type": "video-upload"}'}), "pk")
+
+    def test_process_repeated_message(self):
+        """
+        process should drop a repeat of a media message that it has just handled, before looking anything up
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        import atomresponder.constants as const
+        import json
+        from gnmvidispine.vs_item import VSItem
+
+        upload_message = json.dumps({
+            "type": const.MESSAGE_TYPE_MEDIA,
+            "s3Key": "path/to/some/media",
+            "title": "Fred",
+            "atomId": "530212A9-72D7-47CE-AFB5-224A5A90623F"
+        })
+        resync_message = json.dumps({
+            "type": const.MESSAGE_TYPE_RESYNC_MEDIA,
+            "s3Key": "path/to/some/media",
+            "title": "Fred",
+            "atomId": "530212A9-72D7-47CE-AFB5-224A5A90623F"
+        })
+        fakeMaster = MagicMock(target=VSItem)
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.master_importer.MasterImportResponder.import_new_item') as mock_vs_import:
+                with patch('atomresponder.master_importer.MasterImportResponder.get_item_for_atomid', return_value=fakeMaster) as mock_get_item:
+                    m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-0000")
+                    m.process(upload_message, 0)
+                    m.process(upload_message, 0)
+                    m.process(resync_message, 0)
+
+                    mock_get_item.assert_called_once()
+                    mock_vs_import.assert_called_once()
+                    self.assertEqual(m.message_cache.hit_rate(), 2.0/3)
+
+    def test_process_resend_after_failed_import(self):
+        """
+        process should not drop the resend that is requested when Vidispine fails an import, even though the import was
+        started for the same media only moments before
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.models import ImportJob
+        import atomresponder.constants as const
+        import json
+        from datetime import datetime
+        import pytz
+        from gnmvidispine.vs_item import VSItem
+
+        upload_message = json.dumps({
+            "type": const.MESSAGE_TYPE_MEDIA,
+            "s3Key": "path/to/some/media",
+            "title": "Fred",
+            "atomId": "DC1B6D1A-0F9A-4E1B-9C4D-6F0C3D8E2A71"
+        })
+        resync_message = json.dumps({
+            "type": const.MESSAGE_TYPE_RESYNC_MEDIA,
+            "s3Key": "path/to/some/media",
+            "title": "Fred",
+            "atomId": "DC1B6D1A-0F9A-4E1B-9C4D-6F0C3D8E2A71"
+        })
+        fakeMaster = MagicMock(target=VSItem)
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.master_importer.MasterImportResponder.import_new_item') as mock_vs_import:
+                with patch('atomresponder.master_importer.MasterImportResponder.get_item_for_atomid', return_value=fakeMaster):
+                    m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-0000")
+                    m.process(upload_message, 0)
+                    ImportJob(item_id="VX-901", job_id="VX-9001", atom_id="DC1B6D1A-0F9A-4E1B-9C4D-6F0C3D8E2A71",
+                              status="FAILED_TOTAL", started_at=datetime.now(tz=pytz.UTC)).save()
+                    m.process(resync_message, 0)
+
+                    self.assertEqual(mock_vs_import.call_count, 2)
+
+    def test_import_new_item_presigned(self):
+        """
+        with the presigned strategy, import_new_item should give Vidispine a presigned URL and not download anything
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.models import ImportJob
+        from gnmvidispine.vs_item import VSItem
+        from gnmvidispine.vs_job import VSJob
+        fake_data = {
+            'atomId': "F6ED398D-9C71-4DBE-A519-C90F901CEB2A",
+            's3Key': "path/to/s3data",
+            's3Bucket': "sandcastles",
+            'projectId': "VX-567"
+        }
+
+        import_job = MagicMock(target=VSJob)
+        import_job.name = "VX-555"
+        master_item = MagicMock(target=VSItem)
+        master_item.import_to_shape=MagicMock(return_value=import_job)
+        master_item.name = "VX-1234"
+        master_item.get = MagicMock(return_value=None)
+
+        with self.settings(ATOM_RESPONDER_INGEST_STRATEGY="presigned"):
+            with patch('atomresponder.master_importer.get_publisher'):
+                with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+                    m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                    m.get_s3_signed_url = MagicMock(return_value="https://bucket.s3.amazonaws.com/path/to/s3data?Signature=xxx")
+                    m.download_to_local_location = MagicMock()
+                    m.update_pluto_record = MagicMock()
+
+                    m.import_new_item(master_item, fake_data)
+                    m.download_to_local_location.assert_not_called()
+                    master_item.import_to_shape.assert_called_once_with(essence=True, jobMetadata={'gnm_source': 'media_atom'}, priority='HIGH', shape_tag='lowres', uri='https://bucket.s3.amazonaws.com/path/to/s3data?Signature=xxx')
+                    m.update_pluto_record.assert_called_once_with("VX-1234", "VX-555", fake_data, None)
+                    self.assertEqual(ImportJob.objects.get(job_id="VX-555").ingest_strategy, "presigned")
+
+    def test_import_new_item_auto_fallback(self):
+        """
+        with the auto strategy, import_new_item should download the media if Vidispine won't import the presigned URL
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.models import ImportJob
+        from gnmvidispine.vs_item import VSItem
+        from gnmvidispine.vs_job import VSJob
+        from gnmvidispine.vidispine_api import VSException
+        fake_data = {
+            'atomId': "F6ED398D-9C71-4DBE-A519-C90F901CEB2A",
+            's3Key': "path/to/s3data",
+            's3Bucket': "sandcastles",
+            'projectId': "VX-567"
+        }
+
+        import_job = MagicMock(target=VSJob)
+        import_job.name = "VX-556"
+        master_item = MagicMock(target=VSItem)
+        master_item.import_to_shape=MagicMock(side_effect=[VSException("could not read uri"), import_job])
+        master_item.name = "VX-1234"
+        master_item.get = MagicMock(return_value=None)
+        mocked_statinfo = posix.stat_result((0,0,0,0,0,0,1234,1600349884.0,1600349884.0,1600349884.0))
+
+        with self.settings(ATOM_RESPONDER_INGEST_STRATEGY="auto"):
+            with patch('atomresponder.master_importer.get_publisher'):
+                with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+                    with patch('os.stat', return_value=mocked_statinfo):
+                        m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                        m.get_s3_signed_url = MagicMock(return_value="https://bucket.s3.amazonaws.com/path/to/s3data?Signature=xxx")
+                        m.download_to_local_location = MagicMock(return_value="/path/to/local/file")
+                        m.update_pluto_record = MagicMock()
+
+                        m.import_new_item(master_item, fake_data)
+                        m.download_to_local_location.assert_called_once()
+                        self.assertEqual(master_item.import_to_shape.call_count, 2)
+                        self.assertEqual(master_item.import_to_shape.call_args[1]['uri'], 'file:///path/to/local/file')
+                        self.assertEqual(ImportJob.objects.get(job_id="VX-556").ingest_strategy, "download")
+
+    def test_choose_ingest_strategy_after_failure(self):
+        """
+        with the auto strategy, a retry after a failed import from a presigned URL should download instead
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.models import ImportJob
+        from datetime import datetime
+
+        ImportJob(item_id="VX-1234", job_id="VX-557", atom_id="EBD4A1C1-3B8A-4D7B-A4C6-5F7A1A7E2C0E", status="FAILED_TOTAL",
+                  started_at=datetime.now(), ingest_strategy="presigned").save()
+
+        with self.settings(ATOM_RESPONDER_INGEST_STRATEGY="auto"):
+            with patch('atomresponder.master_importer.get_publisher'):
+                with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+                    m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                    self.assertEqual(m.choose_ingest_strategy({'atomId': "EBD4A1C1-3B8A-4D7B-A4C6-5F7A1A7E2C0E"}), "download")
+                    self.assertEqual(m.choose_ingest_strategy({'atomId': "F6ED398D-9C71-4DBE-A519-C90F901CEB2A"}), "auto")
+
+    def test_process_staged(self):
+        """
+        with staged ingest on, process should save a StagedIngest and hand it off rather than importing straight away
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.models import StagedIngest
+        import atomresponder.constants as const
+        import json
+        from gnmvidispine.vs_item import VSItem
+
+        fakemessage = json.dumps({
+            "type": const.MESSAGE_TYPE_MEDIA,
+            "s3Key": "path/to/some/media",
+            "projectId": None,
+            "title": "Fred",
+            "atomId": "530212A9-72D7-47CE-AFB5-224A5A90623F"
+        })
+        fakeMaster = MagicMock(target=VSItem)
+        mock_stage = MagicMock()
+        with self.settings(ATOM_RESPONDER_STAGED_INGEST=True):
+            with patch('atomresponder.master_importer.get_ingest_stage', return_value=mock_stage):
+                with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+                    with patch('atomresponder.master_importer.MasterImportResponder.import_new_item') as mock_vs_import:
+                        with patch('atomresponder.master_importer.MasterImportResponder.get_item_for_atomid', return_value=fakeMaster):
+                            m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-0000")
+                            m.process(fakemessage, 0)
+
+                            mock_vs_import.assert_not_called()
+                            staged = StagedIngest.objects.get(atom_id="530212A9-72D7-47CE-AFB5-224A5A90623F")
+                            self.assertEqual(staged.record, fakemessage)
+                            self.assertEqual(staged.shard_id, "shard-0000")
+                            mock_stage.hand_off.assert_called_once_with(staged, m.run_staged_ingest)
+
+                            #the worker looks the item up again and does the import
+                            m.run_staged_ingest(staged)
+                            mock_vs_import.assert_called_once_with(fakeMaster, json.loads(fakemessage))
+
+    def test_run_staged_ingest_deleted_item(self):
+        """
+        if Vidispine says that the mapped master no longer exists, the mapping should be forgotten and the import tried
+        once more against the item that is found instead
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.models import StagedIngest, AtomItemMapping
+        import atomresponder.constants as const
+        import json
+        from gnmvidispine.vs_item import VSItem, VSNotFound
+
+        fakemessage = json.dumps({
+            "type": const.MESSAGE_TYPE_MEDIA,
+            "s3Key": "path/to/some/media",
+            "title": "Fred",
+            "atomId": "3F1C6E2B-8A4D-4C55-9E0B-2D7A9B6C1F30"
+        })
+        AtomItemMapping(atom_id="3F1C6E2B-8A4D-4C55-9E0B-2D7A9B6C1F30", item_id="VX-1").save()
+        goneMaster = MagicMock(target=VSItem)
+        goneMaster.name = "VX-1"
+        newMaster = MagicMock(target=VSItem)
+        newMaster.name = "VX-2"
+        staged = StagedIngest(stream_name="fake stream", shard_id="shard-0000",
+                              atom_id="3F1C6E2B-8A4D-4C55-9E0B-2D7A9B6C1F30", s3_key="path/to/some/media",
+                              record=fakemessage)
+
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.master_importer.MasterImportResponder.import_new_item', side_effect=[VSNotFound("VX-1"), None]) as mock_vs_import:
+                with patch('atomresponder.master_importer.MasterImportResponder.get_item_for_atomid', side_effect=[goneMaster, newMaster]):
+                    m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-0000")
+                    m.run_staged_ingest(staged)
+
+                    self.assertEqual(mock_vs_import.call_count, 2)
+                    mock_vs_import.assert_called_with(newMaster, json.loads(fakemessage))
+                    self.assertFalse(AtomItemMapping.objects.filter(item_id="VX-1").exists())
+
+    def test_process_waits_for_space(self):
+        """
+        without staged ingest, process should keep waiting for disk space rather than fail the record, unless it has
+        been asked to stop
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.storage_manager import InsufficientDiskSpace
+        from kinesisresponder.metrics import shard_metrics
+        import atomresponder.constants as const
+        import json
+        from gnmvidispine.vs_item import VSItem
+
+        fakemessage = json.dumps({
+            "type": const.MESSAGE_TYPE_MEDIA,
+            "s3Key": "path/to/some/media",
+            "title": "Fred",
+            "atomId": "9B0E7C54-2F1A-4D8E-B3C6-7A5D1E9F0C28"
+        })
+        full = InsufficientDiskSpace("/path/to/download", 1000, 10)
+        fakeMaster = MagicMock(target=VSItem)
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.master_importer.MasterImportResponder.import_new_item', side_effect=[full, full, "job"]) as mock_vs_import:
+                with patch('atomresponder.master_importer.MasterImportResponder.get_item_for_atomid', return_value=fakeMaster):
+                    m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-0000")
+                    self.assertEqual(m.process(fakemessage, 0), "job")
+                    self.assertEqual(mock_vs_import.call_count, 3)
+                    self.assertEqual(shard_metrics.get("fake stream", "shard-0000", "download_deferred"), 2)
+
+            with patch('atomresponder.master_importer.MasterImportResponder.import_new_item', side_effect=full):
+                with patch('atomresponder.master_importer.MasterImportResponder.get_item_for_atomid', return_value=fakeMaster):
+                    m = MasterImportResponder("fake role", "fake session", "fake stream", "shard-0001")
+                    m.request_stop()
+                    with self.assertRaises(InsufficientDiskSpace):
+                        m.process(fakemessage.replace("some/media", "other/media"), 0)
@@ -0,0 +1,65 @@
+import django.test
+
+
+class TestRecentMessageCache(django.test.SimpleTestCase):
+    def test_duplicates(self):
+        """
+        RecentMessageCache should spot exact duplicates and messages for media that has already been dealt with
+        :return:
+        """
+        from atomresponder.message_cache import RecentMessageCache, EXACT_DUPLICATE, SUPERSEDED
+
+        c = RecentMessageCache()
+        self.assertIsNone(c.check('{"type": "video-upload"}', "atom-1", "key-1"))
+        c.remember('{"type": "video-upload"}', "atom-1", "key-1")
+
+        self.assertEqual(c.check('{"type": "video-upload"}', "atom-1", "key-1"), EXACT_DUPLICATE)
+        self.assertEqual(c.check('{"type": "video-upload-resync"}', "atom-1", "key-1"), SUPERSEDED)
+        self.assertIsNone(c.check('{"type": "video-upload-resync"}', "atom-1", "key-2"))
+        self.assertEqual(c.hits, {EXACT_DUPLICATE: 1, SUPERSEDED: 1})
+        self.assertEqual(c.misses, 2)
+        self.assertEqual(c.hit_rate(), 0.5)
+
+    def test_expiry(self):
+        """
+        RecentMessageCache should forget messages after the ttl, and the least recently used ones once it is full
+        :return:
+        """
+        from atomresponder.message_cache import RecentMessageCache, EXACT_DUPLICATE
+
+        now = [100.0]
+        c = RecentMessageCache(max_entries=4, ttl=10, clock=lambda: now[0])
+        c.remember("first", "atom-1", "key-1")
+        now[0] += 11
+        self.assertIsNone(c.check("first", "atom-1", "key-1"))
+
+        c.remember("first", "atom-1", "key-1")
+        c.remember("second", "atom-2", "key-2")
+        self.assertEqual(c.check("first"), EXACT_DUPLICATE)  #makes "first" the most recently used
+        c.remember("third", "atom-3", "key-3")
+        self.assertEqual(c.check("first"), EXACT_DUPLICATE)
+        self.assertIsNone(c.check("second"))
+
+    def test_forget(self):
+        """
+        forget should remove both the content and the media entries for a message
+        :return:
+        """
+        from atomresponder.message_cache import RecentMessageCache
+
+        c = RecentMessageCache()
+        c.remember("first", "atom-1", "key-1")
+        c.forget("first", "atom-1", "key-1")
+        self.assertIsNone(c.check("first", "atom-1", "key-1"))
+        self.assertIsNone(c.check("other", "atom-1", "key-1"))
+
+    def test_disabled(self):
+        """
+        a ttl of 0 should turn the cache off
+        :return:
+        """
+        from atomresponder.message_cache import RecentMessageCache
+
+        c = RecentMessageCache(ttl=0)
+        c.remember("first", "atom-1", "key-1")
+        self.assertIsNone(c.check("first", "atom-1", "key-1"))
@@ -0,0 +1,41 @@
+import django.test
+import json
+
+
+class TestClassifyRecord(django.test.TestCase):
+    fixtures = [
+        "ImportJobs"
+    ]
+
+    def test_classify(self):
+        """
+        classify_record should say what the responder would do with a message, without doing it
+        :return:
+        """
+        from atomresponder.management.commands.replay_atom_stream import classify_record
+
+        self.assertEqual(classify_record("{not json"), "invalid_json")
+        self.assertEqual(classify_record(json.dumps({"type": "video-upload", "atomId": "fake"})), "invalid")
+        self.assertEqual(classify_record(json.dumps({"type": "project-assigned", "atomId": "fake", "projectId": "123"})),
+                         "project-assigned")
+        self.assertEqual(classify_record(json.dumps({"type": "video-upload", "atomId": "nonexistent", "s3Key": "path/to/file"})),
+                         "video-upload:new")
+
+    def test_classify_existing(self):
+        """
+        classify_record should spot media that has already been imported or is being imported
+        :return:
+        """
+        from atomresponder.management.commands.replay_atom_stream import classify_record
+        from atomresponder.models import ImportJob
+        from datetime import datetime
+
+        ImportJob(item_id="VX-100", job_id="VX-200", atom_id="done-atom", status="FINISHED", started_at=datetime.now(),
+                  s3_path="path/to/done").save()
+        ImportJob(item_id="VX-101", job_id="VX-201", atom_id="busy-atom", status="STARTED", started_at=datetime.now(),
+                  s3_path="path/to/busy", processing=True).save()
+
+        self.assertEqual(classify_record(json.dumps({"type": "video-upload", "atomId": "done-atom", "s3Key": "path/to/done"})),
+                         "video-upload:already_imported")
+        self.assertEqual(classify_record(json.dumps({"type": "video-upload-resync", "atomId": "busy-atom", "s3Key": "path/to/busy"})),
+                         "video-upload-resync:in_progress")
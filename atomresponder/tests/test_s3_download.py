@@ -0,0 +1,286 @@
+import django.test
+from threading import Lock
+import hashlib
+import os
+import re
+import tempfile
+
+
+class FakeKey(object):
+    """
+    Stands in for a boto Key, serving byte ranges of some data
+    """
+    range_re = re.compile(r'^bytes=(\d+)-(\d+)$')
+
+    name = "path/to/file.mp4"
+
+    def __init__(self, data, fail_ranges=None, truncate_ranges=None, corrupt_ranges=None, upload_part_size=None):
+        self.data = data
+        #part size that a HEAD request for partNumber=1 reports, or None if S3 refuses it
+        self.upload_part_size = upload_part_size
+        self.fail_ranges = fail_ranges if fail_ranges is not None else set()
+        self.truncate_ranges = truncate_ranges if truncate_ranges is not None else set()
+        #range -> number of times that it should come back with a different byte flipped
+        self.corrupt_ranges = corrupt_ranges if corrupt_ranges is not None else {}
+        self.requests = []
+        self.lock = Lock()
+
+    @property
+    def bucket(self):
+        return FakeBucket(self)
+
+    def get_file(self, fp, headers=None):
+        parts = self.range_re.match(headers['Range'])
+        start, end = int(parts.group(1)), int(parts.group(2))
+        with self.lock:
+            self.requests.append((start, end))
+            should_fail = (start, end) in self.fail_ranges
+            self.fail_ranges.discard((start, end))
+            should_truncate = (start, end) in self.truncate_ranges
+            self.truncate_ranges.discard((start, end))
+            corruptions = self.corrupt_ranges.get((start, end), 0)
+            if corruptions > 0:
+                self.corrupt_ranges[(start, end)] = corruptions - 1
+        if should_fail:
+            raise IOError("connection reset")
+        chunk = self.data[start:end+1]
+        if should_truncate:
+            chunk = chunk[:-1]
+        if corruptions > 0:
+            chunk = bytearray(chunk)
+            chunk[corruptions] ^= 0xff
+            chunk = bytes(chunk)
+        for n in range(0, len(chunk), 7):
+            fp.write(chunk[n:n+7])
+
+
+class FakeResponse(object):
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    def read(self):
+        return b''
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+class FakeBucket(object):
+    """
+    Stands in for a boto Bucket, with a connection that answers a HEAD request for the first part of an upload
+    """
+    name = "bucket"
+
+    def __init__(self, key):
+        self.key = key
+        self.connection = self
+
+    def make_request(self, method, bucket, key, query_args=None):
+        self.key.requests.append((method, query_args))
+        if self.key.upload_part_size is None:
+            return FakeResponse(400, {})
+        return FakeResponse(206, {'content-length': str(self.key.upload_part_size),
+                                  'x-amz-mp-parts-count': str(int((len(self.key.data) + self.key.upload_part_size - 1) / self.key.upload_part_size))})
+
+
+class TestRangedDownload(django.test.SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.data = os.urandom(1000)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def test_download(self):
+        """
+        RangedDownload should fetch every range and put it in the right place in the file
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+        key = FakeKey(self.data)
+        dest = os.path.join(self.tempdir, "file.mp4")
+
+        d = RangedDownload(lambda: key, len(self.data), dest, part_size=300, concurrency=3)
+        self.assertEqual(d.parts, [(0, 299), (300, 599), (600, 899), (900, 999)])
+        self.assertEqual(d.run(), dest)
+
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(sorted(key.requests), d.parts)
+
+    def test_resume(self):
+        """
+        after a failure RangedDownload should only fetch the ranges that did not complete
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+        key = FakeKey(self.data, fail_ranges={(300, 599)}, truncate_ranges={(900, 999)})
+        dest = os.path.join(self.tempdir, "file.mp4")
+
+        d = RangedDownload(lambda: key, len(self.data), dest, part_size=300, concurrency=2, retry_delay=0)
+        d.run()
+
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(sorted(key.requests), [(0, 299), (300, 599), (300, 599), (600, 899), (900, 999), (900, 999)])
+
+    def test_give_up(self):
+        """
+        RangedDownload should raise once it has run out of retries
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+
+        class BrokenKey(object):
+            def get_file(self, fp, headers=None):
+                raise IOError("connection reset")
+
+        d = RangedDownload(lambda: BrokenKey(), len(self.data), os.path.join(self.tempdir, "file.mp4"), part_size=300,
+                           retries=2, retry_delay=0)
+        with self.assertRaises(IOError):
+            d.run()
+
+    def test_empty(self):
+        """
+        RangedDownload should create an empty file for an empty object
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+        dest = os.path.join(self.tempdir, "empty.mp4")
+        RangedDownload(lambda: FakeKey(b''), 0, dest).run()
+        self.assertEqual(os.path.getsize(dest), 0)
+
+
+class TestVerifiedDownload(django.test.SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.data = os.urandom(1000)
+        self.dest = os.path.join(self.tempdir, "file.mp4")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def multipart_etag(self, part_size):
+        digests = b"".join([hashlib.md5(self.data[n:n+part_size]).digest() for n in range(0, len(self.data), part_size)])
+        return '"{0}-{1}"'.format(hashlib.md5(digests).hexdigest(), int((len(self.data) + part_size - 1) / part_size))
+
+    def test_parse_etag(self):
+        """
+        parse_etag should pick out the digest and the number of parts
+        :return:
+        """
+        from atomresponder.s3_download import parse_etag
+        self.assertEqual(parse_etag('"D41D8CD98F00B204E9800998ECF8427E"'), ("d41d8cd98f00b204e9800998ecf8427e", None))
+        self.assertEqual(parse_etag('"d41d8cd98f00b204e9800998ecf8427e-12"'), ("d41d8cd98f00b204e9800998ecf8427e", 12))
+        self.assertIsNone(parse_etag('"not-an-md5"'))
+        self.assertIsNone(parse_etag(None))
+
+    def test_multipart(self):
+        """
+        ranges should follow the upload's parts, as reported by S3, and a good download should be fetched once
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+        key = FakeKey(self.data, upload_part_size=300)
+        d = RangedDownload(lambda: key, len(self.data), self.dest, part_size=128, concurrency=3, retry_delay=0,
+                           etag=self.multipart_etag(300))
+        d.run()
+        self.assertEqual(d.parts, [(0, 299), (300, 599), (600, 899), (900, 999)])
+        self.assertEqual(key.requests[0], ('HEAD', 'partNumber=1'))
+        self.assertEqual(sorted(key.requests[1:]), d.parts)
+
+    def test_multipart_unknown_part_size(self):
+        """
+        if S3 won't tell us the part size, or it doesn't match the ETag, the download should be fetched once and not
+        checked
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+        for upload_part_size in (None, 128):
+            key = FakeKey(self.data, upload_part_size=upload_part_size)
+            dest = os.path.join(self.tempdir, "file{0}.mp4".format(upload_part_size))
+            d = RangedDownload(lambda: key, len(self.data), dest, part_size=500, retry_delay=0,
+                               etag=self.multipart_etag(300))
+            self.assertEqual(d.run(), dest)
+            self.assertIsNone(d.expected)
+            self.assertEqual(len(key.requests), 3)
+            with open(dest, "rb") as f:
+                self.assertEqual(f.read(), self.data)
+
+    def test_multipart_corrupt(self):
+        """
+        after a mismatch every range should be fetched again, and after that only the ranges that changed
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+        key = FakeKey(self.data, corrupt_ranges={(300, 599): 2}, upload_part_size=300)
+        d = RangedDownload(lambda: key, len(self.data), self.dest, concurrency=2, retry_delay=0,
+                           etag=self.multipart_etag(300))
+        d.run()
+
+        with open(self.dest, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(sorted(key.requests[1:]), [(0, 299), (0, 299), (300, 599), (300, 599), (300, 599), (600, 899),
+                                                (600, 899), (900, 999), (900, 999)])
+
+    def test_single_part(self):
+        """
+        the MD5 of the whole object should be worked out from ranges fetched in parallel, including one that was retried
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+        key = FakeKey(self.data, truncate_ranges={(0, 299)}, corrupt_ranges={(600, 899): 1})
+        d = RangedDownload(lambda: key, len(self.data), self.dest, part_size=300, concurrency=3, retry_delay=0,
+                           etag='"{0}"'.format(hashlib.md5(self.data).hexdigest()))
+        d.run()
+
+        with open(self.dest, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        #the truncated range is fetched twice, then the mismatch caused by the corrupt one means everything again
+        self.assertEqual(len(key.requests), 9)
+
+    def test_give_up(self):
+        """
+        a range that keeps coming back different should eventually raise ChecksumMismatch
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload, ChecksumMismatch
+        key = FakeKey(self.data, corrupt_ranges={(0, 299): 100})
+        d = RangedDownload(lambda: key, len(self.data), self.dest, part_size=300, retries=3, retry_delay=0,
+                           etag='"{0}"'.format(hashlib.md5(self.data).hexdigest()))
+        with self.assertRaises(ChecksumMismatch):
+            d.run()
+
+    def test_unverifiable(self):
+        """
+        if fetching everything again gives the same data, the ETag can't be checked and the download should be accepted
+        :return:
+        """
+        from atomresponder.s3_download import RangedDownload
+        key = FakeKey(self.data)
+        d = RangedDownload(lambda: key, len(self.data), self.dest, part_size=300, retry_delay=0,
+                           etag='"{0}"'.format("0"*32))
+        self.assertEqual(d.run(), self.dest)
+        self.assertEqual(len(key.requests), 8)
+
+    def test_streaming_md5(self):
+        """
+        StreamingMd5 should give the MD5 of the file whatever order the data arrives in, reading back what it couldn't hold
+        :return:
+        """
+        from atomresponder.s3_download import StreamingMd5
+        with open(self.dest, "wb") as f:
+            f.write(self.data)
+        fd = os.open(self.dest, os.O_RDONLY)
+        try:
+            stream_hash = StreamingMd5(fd, len(self.data), max_pending=200)
+            for offset in (800, 500, 0, 300, 200):
+                stream_hash.feed(offset, self.data[offset:offset+200])
+            self.assertEqual(stream_hash.position, 400)
+            self.assertTrue(stream_hash.valid)
+            self.assertEqual(stream_hash.hexdigest(), hashlib.md5(self.data).hexdigest())
+        finally:
+            os.close(fd)
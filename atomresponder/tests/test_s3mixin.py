@@ -1,6 +1,7 @@
 import django.test
 from mock import MagicMock,patch
-import re
+import os
+import tempfile
 
 
 class TestS3Mixin(django.test.TestCase):
@@ -31,48 +32,169 @@ class TestS3Mixin(django.test.TestCase):
         from atomresponder.master_importer import MasterImportResponder
         fake_key = MagicMock(target=boto.s3.key.Key)
         fake_key.generate_url = MagicMock(return_value="https://some/invalid/url")
+        fake_key.size = 1024
         mock_conn = self.MockS3Conn(fake_key,expected_bucketname="bucketname", expected_keyname="keyname")
 
+        fake_provider = MagicMock()
+        fake_provider.remaining_lifetime = MagicMock(return_value=7000.5)
+        signing_conn = fake_provider.make_connection.return_value
+        signing_conn.generate_url = MagicMock(return_value="https://some/invalid/url")
+
         with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials') as mock_refresh_creds:
             with patch('atomresponder.master_importer.MasterImportResponder.get_s3_connection', return_value = mock_conn):
-                r = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
-                mock_refresh_creds.assert_called_once()
-                result = r.get_s3_signed_url("bucketname","keyname")
-                fake_key.generate_url.assert_called_once_with(60,query_auth=True)
-                self.assertEqual(result, "https://some/invalid/url")
+                with patch('atomresponder.master_importer.MasterImportResponder.get_credential_provider', return_value=fake_provider):
+                    r = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                    mock_refresh_creds.assert_called_once()
+                    result = r.get_s3_signed_url("bucketname","keyname")
+                    fake_provider.get_credentials.assert_called_once_with(lifetime=3600)
+                    fake_provider.make_connection.assert_called_once_with('s3', fake_provider.get_credentials.return_value)
+                    signing_conn.generate_url.assert_called_once_with(3600, 'GET', bucket="bucketname", key="keyname", query_auth=True)
+                    self.assertEqual(result, "https://some/invalid/url")
+
+                    #the URL can't outlast the session that signs it
+                    fake_provider.remaining_lifetime.return_value = 600
+                    r.get_s3_signed_url("bucketname","keyname")
+                    signing_conn.generate_url.assert_called_with(600, 'GET', bucket="bucketname", key="keyname", query_auth=True)
+
+    def test_signed_url_expiry(self):
+        """
+        signed_url_expiry should allow long enough to read the whole object, within the minimum and the SigV4 limit
+        :return:
+        """
+        from atomresponder.s3_mixin import S3Mixin
+
+        with self.settings(ATOM_RESPONDER_PRESIGNED_URL_BYTES_PER_SECOND=1024*1024, ATOM_RESPONDER_PRESIGNED_URL_MARGIN=1800,
+                           ATOM_RESPONDER_PRESIGNED_URL_MIN_EXPIRY=3600):
+            self.assertEqual(S3Mixin.signed_url_expiry(0), 3600)
+            self.assertEqual(S3Mixin.signed_url_expiry(10*1024*1024*1024), 1800+10240)
+            self.assertEqual(S3Mixin.signed_url_expiry(1024*1024*1024*1024), 7*24*3600)
 
     def test_get_download_filename(self):
         from atomresponder.master_importer import MasterImportResponder
 
-        result = MasterImportResponder.get_download_filename("some/path/to/filename.xxx")
-        self.assertEqual(result, "/path/to/download/filename.xxx")
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(ATOM_RESPONDER_DOWNLOAD_PATH=tempdir):
+                result = MasterImportResponder.get_download_filename("some/path/to/filename.xxx", atom_id="57AF5F3B-A556-448B-98E1-0628FDE9A5AC")
+                self.assertEqual(result, os.path.join(tempdir, "57", "filename.xxx"))
+                self.assertTrue(os.path.exists(result))
+
+                result_with_spaces = MasterImportResponder.get_download_filename("some/path/to filename   with spaces and #^3!", atom_id="57AF5F3B-A556-448B-98E1-0628FDE9A5AC")
+                self.assertEqual(result_with_spaces, os.path.join(tempdir, "57", "to_filename_with_spaces_and_3_"))
 
-        result_with_spaces = MasterImportResponder.get_download_filename("some/path/to filename   with spaces and #^3!")
-        self.assertEqual(result_with_spaces, "/path/to/download/to_filename_with_spaces_and_3_")
+                #without an atom ID, the subdirectory comes from the key
+                result_no_atom = MasterImportResponder.get_download_filename("some/path/to/filename.xxx")
+                self.assertEqual(result_no_atom, os.path.join(tempdir, MasterImportResponder.download_subdirectory("some/path/to/filename.xxx"), "filename.xxx"))
 
     def test_get_download_filename_override(self):
         from atomresponder.master_importer import MasterImportResponder
 
-        result = MasterImportResponder.get_download_filename("some/path/to/filename.xxx", overridden_name="my overriden file.mp4")
-        self.assertEqual(result, "/path/to/download/my_overriden_file.mp4")
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(ATOM_RESPONDER_DOWNLOAD_PATH=tempdir):
+                result = MasterImportResponder.get_download_filename("some/path/to/filename.xxx", overridden_name="my overriden file.mp4", atom_id="ab0123")
+                self.assertEqual(result, os.path.join(tempdir, "ab", "my_overriden_file.mp4"))
 
     def test_get_download_filename_dedupe(self):
+        """
+        get_download_filename should never hand out the same path twice, even from several threads at once
+        :return:
+        """
         from atomresponder.master_importer import MasterImportResponder
+        from concurrent.futures import ThreadPoolExecutor
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(ATOM_RESPONDER_DOWNLOAD_PATH=tempdir):
+                first = MasterImportResponder.get_download_filename("unrelated/path/for/a/filename.xxx", atom_id="ab0123")
+                self.assertEqual(first, os.path.join(tempdir, "ab", "filename.xxx"))
+
+                with ThreadPoolExecutor(max_workers=8) as pool:
+                    results = list(pool.map(lambda n: MasterImportResponder.get_download_filename("unrelated/path/for/a/filename.xxx", atom_id="ab0123"),
+                                            range(50)))
+
+                self.assertEqual(len(set(results + [first])), 51)
+                for result in results:
+                    self.assertRegex(os.path.basename(result), r'^filename-[0-9a-f]{8}\.xxx$')
+                    self.assertTrue(os.path.exists(result))
+
+    def test_download_to_local_location(self):
+        """
+        download_to_local_location should fetch the object with a ranged download, sized from the key
+        :return:
+        """
+        import boto.s3.key
+        from atomresponder.master_importer import MasterImportResponder
+        fake_key = MagicMock(target=boto.s3.key.Key)
+        fake_key.size = 12345
+        mock_conn = self.MockS3Conn(fake_key,expected_bucketname="bucketname", expected_keyname="path/to/keyname.mp4")
+        mock_download = MagicMock()
+        mock_storage = MagicMock()
+
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.master_importer.MasterImportResponder.get_s3_connection', return_value=mock_conn):
+                with patch('atomresponder.s3_mixin.RangedDownload', return_value=mock_download) as mock_download_class:
+                    with patch('atomresponder.s3_mixin.get_storage_manager', return_value=mock_storage):
+                        with patch('atomresponder.master_importer.MasterImportResponder.get_download_filename', return_value="/path/to/download/keyname.mp4"):
+                            with self.settings(ATOM_RESPONDER_DOWNLOAD_CACHE_MAX_BYTES=0):
+                                r = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                                result = r.download_to_local_location("bucketname", "path/to/keyname.mp4")
+
+        self.assertEqual(result, "/path/to/download/keyname.mp4")
+        self.assertEqual(mock_download_class.call_args[0][1], 12345)
+        self.assertEqual(mock_download_class.call_args[0][2], "/path/to/download/keyname.mp4")
+        mock_download.run.assert_called_once()
+        mock_storage.reserve.assert_called_once_with(12345)
+        mock_storage.register.assert_called_once_with("/path/to/download/keyname.mp4", 12345)
+
+    def test_should_verify(self):
+        """
+        should_verify should be False for SSE-KMS objects, whose ETag is not an MD5, or if verification is turned off
+        :return:
+        """
+        from atomresponder.s3_mixin import S3Mixin
+        self.assertTrue(S3Mixin.should_verify(MagicMock(encrypted=None)))
+        self.assertTrue(S3Mixin.should_verify(MagicMock(encrypted="AES256")))
+        self.assertFalse(S3Mixin.should_verify(MagicMock(encrypted="aws:kms")))
+        with self.settings(ATOM_RESPONDER_VERIFY_DOWNLOADS=False):
+            self.assertFalse(S3Mixin.should_verify(MagicMock(encrypted=None)))
+
+    def test_download_to_local_location_missing(self):
+        """
+        download_to_local_location should raise FileDoesNotExist if there is no such key
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.s3_mixin import FileDoesNotExist
+        mock_conn = self.MockS3Conn(None)
+
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.master_importer.MasterImportResponder.get_s3_connection', return_value=mock_conn):
+                r = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                with self.assertRaises(FileDoesNotExist):
+                    r.download_to_local_location("bucketname", "path/to/keyname.mp4")
+
+    def test_download_to_local_location_cached(self):
+        """
+        download_to_local_location should not download an object that is already in the download cache
+        :return:
+        """
+        import boto.s3.key
+        from atomresponder.master_importer import MasterImportResponder
+        fake_key = MagicMock(target=boto.s3.key.Key)
+        fake_key.size = 12345
+        fake_key.etag = '"8a5e4b0c1e3f"'
+        mock_conn = self.MockS3Conn(fake_key,expected_bucketname="bucketname", expected_keyname="path/to/keyname.mp4")
+        mock_cache = MagicMock()
+        mock_cache.fetch = MagicMock(return_value=True)
+
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.master_importer.MasterImportResponder.get_s3_connection', return_value=mock_conn):
+                with patch('atomresponder.master_importer.MasterImportResponder.get_download_cache', return_value=mock_cache):
+                    with patch('atomresponder.s3_mixin.RangedDownload') as mock_download_class:
+                        with patch('atomresponder.s3_mixin.get_storage_manager'):
+                            with patch('atomresponder.master_importer.MasterImportResponder.get_download_filename', return_value="/path/to/download/keyname.mp4"):
+                                r = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                                result = r.download_to_local_location("bucketname", "path/to/keyname.mp4")
 
-        def mock_exists(path):
-            """
-            fake the os.path.exists to pretend files do exist, up to a given number
-            :param path:
-            :return:
-            """
-            number_part = re.search(r'-(\d+).[^\.]+$', path)
-            if number_part:
-                number = int(number_part.group(1))
-                if number<3: return True
-                return False
-            else:
-                return True
-
-        with patch("os.path.exists", mock_exists):
-            result = MasterImportResponder.get_download_filename("unrelated/path/for/a/filename.xxx")
-            self.assertEqual("/path/to/download/filename-3.xxx", result)
\ No newline at end of file
+        self.assertEqual(result, "/path/to/download/keyname.mp4")
+        mock_cache.fetch.assert_called_once_with("bucketname", "path/to/keyname.mp4", '"8a5e4b0c1e3f"', "/path/to/download/keyname.mp4", size=12345)
+        mock_download_class.assert_not_called()
+        mock_cache.store.assert_not_called()
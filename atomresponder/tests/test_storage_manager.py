@@ -0,0 +1,194 @@
+import django.test
+from collections import namedtuple
+from datetime import timedelta
+from django.utils import timezone
+import os
+import shutil
+import tempfile
+
+DiskUsage = namedtuple("DiskUsage", "total used free")
+
+
+class FakeDisk(object):
+    """
+    Pretends to be a disk of the given size, with everything in the directory counting towards the space used
+    """
+    def __init__(self, root, total, other_usage=0):
+        self.root = root
+        self.total = total
+        self.other_usage = other_usage
+
+    def __call__(self, path):
+        used = self.other_usage + sum([os.path.getsize(os.path.join(self.root, name)) for name in os.listdir(self.root)])
+        return DiskUsage(self.total, used, self.total - used)
+
+
+class FakeLinkedDisk(object):
+    """
+    Pretends to be a disk of the given size, counting every file under the directory once however many links it has
+    """
+    def __init__(self, root, total):
+        self.root = root
+        self.total = total
+
+    def __call__(self, path):
+        inodes = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                statinfo = os.stat(os.path.join(dirpath, name))
+                inodes[statinfo.st_ino] = statinfo.st_size
+        used = sum(inodes.values())
+        return DiskUsage(self.total, used, self.total - used)
+
+
+class TestStorageManager(django.test.TestCase):
+    fixtures = [
+        'ImportJobs.yaml',
+    ]
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_file(self, manager, name, size, last_used_seconds_ago=0):
+        path = os.path.join(self.tempdir, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        entry = manager.register(path, size)
+        entry.last_used_at = timezone.now() - timedelta(seconds=last_used_seconds_ago)
+        entry.save()
+        return path
+
+    def test_job_finished(self):
+        """
+        job_completed should delete the files for a job that finished, and leave those for a failed job to be evicted
+        :return:
+        """
+        from atomresponder.storage_manager import StorageManager
+        from atomresponder.models import ImportJob, DownloadedFile
+
+        m = StorageManager(self.tempdir, disk_usage=FakeDisk(self.tempdir, 10000))
+        finished_path = self.make_file(m, "finished.mp4", 100)
+        failed_path = self.make_file(m, "failed.mp4", 100)
+        finished_job = ImportJob.objects.get(job_id="VX-22")
+        failed_job = ImportJob.objects.get(job_id="VX-43")
+        m.assign(finished_path, finished_job)
+        m.assign(failed_path, failed_job)
+
+        finished_job.status = "FINISHED"
+        self.assertEqual(m.job_completed(finished_job), 100)
+        failed_job.status = "FAILED_TOTAL"
+        self.assertEqual(m.job_completed(failed_job), 0)
+
+        self.assertFalse(os.path.exists(finished_path))
+        self.assertTrue(os.path.exists(failed_path))
+        self.assertFalse(DownloadedFile.objects.filter(path=finished_path).exists())
+        self.assertFalse(DownloadedFile.objects.get(path=failed_path).in_use)
+
+    def test_evicts_least_recently_used(self):
+        """
+        ensure_space should evict files that are not in use, oldest first, until the new file fits under the
+        high-water mark
+        :return:
+        """
+        from atomresponder.storage_manager import StorageManager
+        from atomresponder.models import ImportJob, DownloadedFile
+
+        m = StorageManager(self.tempdir, high_water_mark=0.5, reserve_bytes=0, disk_usage=FakeDisk(self.tempdir, 1000))
+        oldest = self.make_file(m, "oldest.mp4", 150, last_used_seconds_ago=300)
+        older = self.make_file(m, "older.mp4", 150, last_used_seconds_ago=200)
+        newer = self.make_file(m, "newer.mp4", 150, last_used_seconds_ago=100)
+        active = self.make_file(m, "active.mp4", 50, last_used_seconds_ago=400)
+        m.assign(active, ImportJob.objects.get(job_id="VX-22"))
+        DownloadedFile.objects.filter(path__in=[oldest, older, newer]).update(in_use=False)
+
+        #500 bytes used, so fitting 200 more under 500 means freeing 200
+        with m.reserve(200):
+            self.assertEqual(m._reserved, 200)
+        self.assertEqual(m._reserved, 0)
+
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(newer))
+        self.assertTrue(os.path.exists(active))
+
+    def test_orphans(self):
+        """
+        a file that never got an import job should only be evicted once it is older than orphan_age
+        :return:
+        """
+        from atomresponder.storage_manager import StorageManager
+        from atomresponder.models import DownloadedFile
+
+        m = StorageManager(self.tempdir, orphan_age=3600, disk_usage=FakeDisk(self.tempdir, 1000))
+        old_orphan = self.make_file(m, "old.mp4", 10)
+        new_orphan = self.make_file(m, "new.mp4", 10)
+        DownloadedFile.objects.filter(path=old_orphan).update(downloaded_at=timezone.now() - timedelta(hours=2))
+
+        self.assertEqual([entry.path for entry in m.evictable()], [old_orphan])
+
+    def test_defers_when_full(self):
+        """
+        ensure_space should wait for space to be freed, and give up after wait_timeout
+        :return:
+        """
+        from atomresponder.storage_manager import StorageManager, InsufficientDiskSpace
+
+        disk = FakeDisk(self.tempdir, 1000, other_usage=900)
+        now = [0]
+        sleeps = []
+
+        def fake_sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+            if len(sleeps) == 2:
+                #something else frees up space while we wait
+                disk.other_usage = 0
+
+        m = StorageManager(self.tempdir, high_water_mark=0.9, reserve_bytes=0, wait_timeout=120, poll_interval=30,
+                           disk_usage=disk, clock=lambda: now[0], sleep=fake_sleep)
+        m.ensure_space(100)
+        self.assertEqual(sleeps, [30, 30])
+        m.release(100)
+
+        disk.other_usage = 900
+        with self.assertRaises(InsufficientDiskSpace):
+            m.ensure_space(100)
+        self.assertEqual(now[0], 180)
+        self.assertEqual(m._reserved, 0)
+
+    def test_evicts_download_cache(self):
+        """
+        ensure_space should evict download cache entries as well as downloads, and only count a file as freed once its
+        last link has gone
+        :return:
+        """
+        from atomresponder.storage_manager import StorageManager
+        from atomresponder.download_cache import DownloadCache
+        from atomresponder.models import DownloadedFile
+
+        cache = DownloadCache(os.path.join(self.tempdir, ".cache"), max_bytes=100000)
+        m = StorageManager(self.tempdir, high_water_mark=0.5, reserve_bytes=0, cache=cache,
+                           disk_usage=FakeLinkedDisk(self.tempdir, 1000))
+        failed = self.make_file(m, "failed.mp4", 300, last_used_seconds_ago=300)
+        cache.store("bucket", "failed.mp4", "etag-1", failed)
+        DownloadedFile.objects.filter(path=failed).update(in_use=False)
+        active = self.make_file(m, "active.mp4", 100)
+        cache.store("bucket", "active.mp4", "etag-2", active)
+        os.makedirs(cache.root, exist_ok=True)
+        with open(os.path.join(cache.root, "unlinked"), "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(cache.entry_path("bucket", "failed.mp4", "etag-1"), (1000, 1000))
+        os.utime(cache.entry_path("bucket", "active.mp4", "etag-2"), (2000, 2000))
+
+        #500 bytes used, so fitting 200 more under 500 means freeing 200. Removing failed.mp4 on its own frees
+        #nothing, because the cache still has it.
+        self.assertEqual(m.evict(200), 300)
+        self.assertFalse(os.path.exists(failed))
+        self.assertIsNone(cache.lookup("bucket", "failed.mp4", "etag-1"))
+        #the more recently used unlinked entry isn't needed, and the entry for the file that is in use would free nothing
+        self.assertTrue(os.path.exists(os.path.join(cache.root, "unlinked")))
+        self.assertIsNotNone(cache.lookup("bucket", "active.mp4", "etag-2"))
+        self.assertTrue(os.path.exists(active))
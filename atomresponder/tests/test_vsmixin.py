@@ -21,6 +21,12 @@ class TestVsMixin(django.test.TestCase):
         def execute(self):
             pass
 
+    def setUp(self):
+        from atomresponder.item_mapping import get_item_mapping
+        #the in-memory mapping outlives each test's database transaction
+        get_item_mapping().clear()
+
+    @django.test.override_settings(ATOM_RESPONDER_ITEM_LOOKUP="full")
     def test_get_item_for_atomid(self):
         """
         get_item_for_atomid should look up  atom id as an external ID
@@ -28,7 +34,10 @@ class TestVsMixin(django.test.TestCase):
         """
         from atomresponder.master_importer import MasterImportResponder
 
+        from atomresponder.models import AtomItemMapping
+
         mock_item = MagicMock(target=VSItem)
+        mock_item.name = "VX-1234"
 
         with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials') as mock_refresh_creds:
             with patch('atomresponder.vs_mixin.VSItem', return_value = mock_item):
@@ -40,7 +49,34 @@ class TestVsMixin(django.test.TestCase):
                 mock_item.populate.assert_called_once_with("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2")
 
                 self.assertEqual(result, mock_item)
+        self.assertEqual(AtomItemMapping.objects.get(atom_id="f6ba9036-3f53-4850-9c75-fe3bcfbae4b2").item_id, "VX-1234")
 
+    def test_get_item_for_atomid_mapped(self):
+        """
+        get_item_for_atomid should return a handle for an atom that we already know about without talking to Vidispine
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.item_mapping import get_item_mapping
+
+        get_item_mapping().remember("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2", "VX-1234")
+        get_item_mapping().clear()
+        mock_item = MagicMock(target=VSItem)
+
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.vs_mixin.VSItem', return_value = mock_item):
+                with patch('atomresponder.vs_mixin.VSItemSearch') as mock_search_class:
+                    r = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                    #the first lookup comes from the database, the second from memory
+                    for n in range(2):
+                        result = r.get_item_for_atomid("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2")
+                        self.assertEqual(result, mock_item)
+                        self.assertEqual(result.name, "VX-1234")
+
+        mock_item.populate.assert_not_called()
+        mock_search_class.assert_not_called()
+
+    @django.test.override_settings(ATOM_RESPONDER_ITEM_LOOKUP="full")
     def test_get_item_for_atomid_idnotfound(self):
         """
         get_item_for_atomid should make a search for the provided atom id if it is not found as an external ID
@@ -51,6 +87,7 @@ class TestVsMixin(django.test.TestCase):
         from mock import call
 
         mock_item = MagicMock(target=VSItem)
+        mock_item.name = "VX-1234"
         mock_item.populate = MagicMock(side_effect=[VSNotFound,None])
         mock_search = MagicMock(target=VSItemSearch)
         mock_search.addCriterion = MagicMock()
@@ -72,6 +109,7 @@ class TestVsMixin(django.test.TestCase):
                     ])
                 self.assertEqual(result, mock_item)
 
+    @django.test.override_settings(ATOM_RESPONDER_ITEM_LOOKUP="full")
     def test_get_item_for_atomid_notfound(self):
         """
         get_item_for_atomid should return None if no item exists
@@ -100,6 +138,7 @@ class TestVsMixin(django.test.TestCase):
 
                 self.assertEqual(result, None)
 
+    @django.test.override_settings(ATOM_RESPONDER_ITEM_LOOKUP="full")
     def test_get_item_for_atomid_multiple(self):
         """
         get_item_for_atomid should return the first item if multiple records match
@@ -109,6 +148,7 @@ class TestVsMixin(django.test.TestCase):
         from gnmvidispine.vidispine_api import VSNotFound
 
         mock_item = MagicMock(target=VSItem)
+        mock_item.name = "VX-1234"
         #populate is also called when we have found the item via vs search - hence second one succeeds
         #test is only relevant if the initial lookup fails, as VS ensures that external IDs are unique
         mock_item.populate = MagicMock(side_effect=[VSNotFound,None])
@@ -129,6 +169,88 @@ class TestVsMixin(django.test.TestCase):
 
                     self.assertEqual(result, mock_item)
 
+    sample_metadata = b"""<?xml version="1.0"?>
+<MetadataListDocument xmlns="http://xml.vidispine.com/schema/vidispine">
+  <item id="VX-1234">
+    <metadata>
+      <timespan start="-INF" end="+INF">
+        <field><name>itemId</name><value>VX-1234</value></field>
+        <group><name>Asset</name>
+          <field><name>gnm_category</name><value>Deliverable</value></field>
+        </group>
+      </timespan>
+    </metadata>
+  </item>
+</MetadataListDocument>"""
+
+    def test_fetch_item_fields(self):
+        """
+        fetch_item_fields should ask for just the given fields and read them out of the response
+        :return:
+        """
+        from atomresponder.vs_mixin import VSMixin
+        mock_response = MagicMock(status_code=200, content=self.sample_metadata)
+
+        with patch('atomresponder.vs_mixin.requests.get', return_value=mock_response) as mock_get:
+            with self.settings(VIDISPINE_URL="http://vidispine.local:8080"):
+                result = VSMixin.fetch_item_fields("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2", ["itemId", "gnm_category"])
+
+        self.assertEqual(mock_get.call_args[0][0], "http://vidispine.local:8080/API/item/f6ba9036-3f53-4850-9c75-fe3bcfbae4b2/metadata")
+        self.assertEqual(mock_get.call_args[1]["params"], {"field": "itemId,gnm_category"})
+        self.assertEqual(mock_get.call_args[1]["timeout"], 30)
+        self.assertEqual(result.item_id, "VX-1234")
+        self.assertEqual(result.fields, {"itemId": "VX-1234", "gnm_category": "Deliverable"})
+        self.assertEqual(result.bytes, len(self.sample_metadata))
+
+        with patch('atomresponder.vs_mixin.requests.get', return_value=MagicMock(status_code=404)):
+            self.assertIsNone(VSMixin.fetch_item_fields("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2", ["itemId"]))
+
+    def test_get_item_for_atomid_fields(self):
+        """
+        in the default lookup mode get_item_for_atomid should fetch only the lookup fields and not populate the item
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+        from atomresponder.vs_mixin import ItemFields
+        from kinesisresponder.metrics import shard_metrics
+
+        shard_metrics.clear()
+        mock_item = MagicMock(target=VSItem)
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.vs_mixin.VSItem', return_value=mock_item):
+                with patch('atomresponder.vs_mixin.VSMixin.fetch_item_fields', return_value=ItemFields("VX-1234", {}, 100, 0.01)) as mock_fetch:
+                    r = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                    result = r.get_item_for_atomid("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2")
+
+        mock_fetch.assert_called_once_with("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2", r.lookup_fields)
+        mock_item.populate.assert_not_called()
+        self.assertEqual(result.name, "VX-1234")
+        #the size and latency of the lookup go into the shard's metrics
+        self.assertEqual(shard_metrics.get("fake stream", "shard-00000", "item_lookups"), 1)
+        self.assertEqual(shard_metrics.get("fake stream", "shard-00000", "item_lookup_bytes"), 100)
+
+    def test_get_item_for_atomid_fields_search(self):
+        """
+        in the default lookup mode the search fallback should not populate its results
+        :return:
+        """
+        from atomresponder.master_importer import MasterImportResponder
+
+        found_item = MagicMock(target=VSItem)
+        found_item.name = "VX-1234"
+        mock_search = MagicMock(target=VSItemSearch)
+        mock_search.execute = MagicMock(return_value=self.MockSearchResult([found_item]))
+        mock_item = MagicMock(target=VSItem)
+        with patch('atomresponder.master_importer.MasterImportResponder.refresh_access_credentials'):
+            with patch('atomresponder.vs_mixin.VSItem', return_value=mock_item):
+                with patch('atomresponder.vs_mixin.VSItemSearch', return_value=mock_search):
+                    with patch('atomresponder.vs_mixin.VSMixin.fetch_item_fields', return_value=None):
+                        r = MasterImportResponder("fake role", "fake session", "fake stream", "shard-00000")
+                        result = r.get_item_for_atomid("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2")
+
+        found_item.populate.assert_not_called()
+        self.assertEqual(result.name, "VX-1234")
+
     @staticmethod
     def assertXmlContainsValue(xmlContent, key, value):
         ns = {"vs": "http://xml.vidispine.com/schema/vidispine"}
@@ -153,7 +275,9 @@ class TestVsMixin(django.test.TestCase):
         from gnmvidispine.vs_item import VSMetadataBuilder
         from atomresponder.master_importer import MasterImportResponder
 
+        from atomresponder.item_mapping import get_item_mapping
         mock_item = MagicMock(target=VSItem)
+        mock_item.name = "VX-1234"
         mock_item.host="localhost"
         mock_item.port=8080
         mock_item.createPlaceholder = MagicMock()
@@ -193,6 +317,7 @@ class TestVsMixin(django.test.TestCase):
 
                 mock_item.createPlaceholder.assert_called_once_with(builder.as_xml("UTF-8").decode("UTF-8"))
                 mock_item.add_external_id.assert_called_once_with("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2")
+                self.assertEqual(get_item_mapping().get("f6ba9036-3f53-4850-9c75-fe3bcfbae4b2"), "VX-1234")
 
     def test_get_collection_for_projectid(self):
         from atomresponder.master_importer import MasterImportResponder
@@ -5,19 +5,136 @@ from django.conf import settings
 import logging
 from . import constants as const
 from atomresponder.exceptions import NotAProjectError
+from atomresponder.item_mapping import get_item_mapping
+from kinesisresponder.metrics import shard_metrics
 from gnmvidispine.vs_item import VSItem
+from collections import namedtuple
+from time import perf_counter
+import lxml.etree as ET
+import requests
 import datetime
 logger = logging.getLogger(__name__)
 
+xmlns = "{http://xml.vidispine.com/schema/vidispine}"
+
+#result of fetch_item_fields: the item ID, a dictionary of field name -> value, and what the request cost
+ItemFields = namedtuple("ItemFields", ["item_id", "fields", "bytes", "seconds"])
+
 
 class VSMixin(object):
     """
     Mixin class that abstracts vidispine operations
 
     """
+    #the only metadata fields that we need when looking an item up
+    lookup_fields = ["itemId", const.GNM_ASSET_CATEGORY, const.GNM_DELIVERABLE_ATOM_ID]
+
+    @staticmethod
+    def item_handle(item_id):
+        """
+        Returns an unpopulated VSItem for the given item ID, without talking to Vidispine. It can be used for anything
+        that only needs the item ID, such as starting an import; call populate() on it if you need its metadata.
+        :param item_id: Vidispine item ID
+        :return: VSItem object
+        """
+        item = VSItem(url=settings.VIDISPINE_URL, user=settings.VIDISPINE_USERNAME,passwd=settings.VIDISPINE_PASSWORD)
+        item.name = item_id
+        return item
+
     def get_item_for_atomid(self, atomid):
         """
-        Returns a populated VSItem object for the master, or None if no such item exists
+        Returns a VSItem object for the master, or None if no such item exists.  If we already know the item ID for the
+        atom (see item_mapping.py) then this is an unpopulated handle from item_handle(); otherwise the item is looked up
+        in Vidispine and its ID is remembered for next time.  The lookup fetches just lookup_fields and returns a handle,
+        unless ATOM_RESPONDER_ITEM_LOOKUP is "full", when the item is returned populated.
+        :param atomid:
+        :return:
+        """
+        mapping = get_item_mapping()
+        item_id = mapping.get(atomid)
+        if item_id is not None:
+            return self.item_handle(item_id)
+
+        if getattr(settings, "ATOM_RESPONDER_ITEM_LOOKUP", const.ITEM_LOOKUP_FIELDS) == const.ITEM_LOOKUP_FULL:
+            item = self.find_item_for_atomid(atomid)
+        else:
+            item = self.lookup_item_for_atomid(atomid)
+        if item is not None:
+            mapping.remember(atomid, item.name)
+        return item
+
+    @staticmethod
+    def fetch_item_fields(item_id, fields=None):
+        """
+        Fetches the metadata of an item, asking Vidispine for only the given fields
+        :param item_id: Vidispine item ID, or an external ID
+        :param fields: list of field names, or None to fetch the whole metadata document as populate() does
+        :return: an ItemFields, or None if there is no such item
+        """
+        url = "{0}/API/item/{1}/metadata".format(settings.VIDISPINE_URL, item_id)
+        params = {"field": ",".join(fields)} if fields is not None else None
+        start = perf_counter()
+        response = requests.get(url, params=params, auth=(settings.VIDISPINE_USERNAME,settings.VIDISPINE_PASSWORD),
+                                headers={"Accept":"application/xml"},
+                                timeout=getattr(settings, "VIDISPINE_REQUEST_TIMEOUT", 30))
+        seconds = perf_counter() - start
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise Exception("could not get metadata for {0}, server returned {1}".format(item_id, response.status_code))
+
+        doc = ET.fromstring(response.content)
+        item_node = doc.find("{0}item".format(xmlns))
+        if item_node is None:
+            return None
+        values = {}
+        for field_node in item_node.iter("{0}field".format(xmlns)):
+            name = field_node.findtext("{0}name".format(xmlns))
+            if name is not None and name not in values:
+                values[name] = field_node.findtext("{0}value".format(xmlns))
+        return ItemFields(item_node.get("id"), values, len(response.content), seconds)
+
+    def record_lookup(self, atomid, found):
+        """
+        Logs how big and how slow an item lookup was, and adds it to the shard's metrics if we are reading a shard
+        :param atomid: atom ID that was looked up
+        :param found: ItemFields from fetch_item_fields
+        :return: None
+        """
+        logger.debug("Looked up item {0} for atom {1}: {2} bytes in {3:.3f}s".format(found.item_id, atomid, found.bytes, found.seconds))
+        stream_name = getattr(self, "stream_name", None)
+        shard_id = getattr(self, "shard_id", None)
+        if stream_name is None or shard_id is None:
+            return
+        shard_metrics.increment(stream_name, shard_id, "item_lookups")
+        shard_metrics.increment(stream_name, shard_id, "item_lookup_bytes", found.bytes)
+        shard_metrics.increment(stream_name, shard_id, "item_lookup_seconds", found.seconds)
+
+    def lookup_item_for_atomid(self, atomid):
+        """
+        Looks up the master for an atom in Vidispine without populating it
+        :param atomid:
+        :return: an unpopulated VSItem from item_handle(), or None if no such item exists
+        """
+        found = self.fetch_item_fields(atomid, self.lookup_fields)   #external ID, as set in `create_placeholder_for_atomid`
+        if found is not None:
+            self.record_lookup(atomid, found)
+            return self.item_handle(found.item_id)
+
+        s = VSItemSearch(url=settings.VIDISPINE_URL,user=settings.VIDISPINE_USERNAME,passwd=settings.VIDISPINE_PASSWORD)
+        s.addCriterion({const.GNM_DELIVERABLE_ATOM_ID: atomid, const.GNM_ASSET_CATEGORY: 'Deliverable'})
+        result = s.execute()
+        if result.totalItems==0:
+            return None
+        potential_master_ids = [item.name for item in result.results(shouldPopulate=False)]
+        if len(potential_master_ids)>1:
+            logger.warning("Multiple masters returned for atom ID {0}: {1}. Using the first.".format(atomid, potential_master_ids))
+        return self.item_handle(potential_master_ids[0])
+
+    @staticmethod
+    def find_item_for_atomid(atomid):
+        """
+        Looks up the master for an atom in Vidispine and returns a populated VSItem object, or None if no such item exists
         :param atomid:
         :return:
         """
@@ -44,7 +161,7 @@ class VSMixin(object):
     @staticmethod
     def create_placeholder_for_atomid(atomid, filename, project_id, title="unknown video", user="unknown_user"):
         """
-        Creates a placeholder and returns a VSItem object for it
+        Creates a placeholder and returns a VSItem object for it. The new item ID is remembered for the atom.
         :param atomid: atom ID string
         :param filename: path of the file to import
         :param project_id: ID number of the project that the video is associated with
@@ -73,6 +190,7 @@ class VSMixin(object):
         mdbytes:bytes = builder.as_xml("UTF-8")
         item.createPlaceholder(mdbytes.decode("UTF-8"))
         item.add_external_id(atomid)
+        get_item_mapping().remember(atomid, item.name)
         return item
 
     def get_collection_for_id(self, projectid, expected_type="Project"):
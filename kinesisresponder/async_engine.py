@@ -0,0 +1,314 @@
+from boto import kinesis
+import boto.exception
+from django.db import close_old_connections
+from .kinesis_responder import get_shard_iterator, AFTER_SEQUENCE_NUMBER
+from .credentials import get_credential_provider
+from .record_decoder import decode_records
+from .metrics import shard_metrics
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import signal
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncConsumerEngine(object):
+    """
+    Runs every shard of a stream from a single asyncio event loop, instead of one thread per shard.
+    Each shard is a coroutine that fetches, waits and sleeps on the loop; only the actual boto calls go out to a small
+    I/O executor, and process() and the checkpoint writes (which use the ORM, Vidispine and S3) go out to a separate
+    executor of worker_count threads that all shards share.  The next get_records call for a shard is made while its
+    current batch is processed, so there is always one batch read ahead.
+    The responders are built on the I/O executor, because that can block (e.g. on fetching credentials), and are
+    never started as threads; the engine just uses their checkpointer, poll_controller, read_scheduler and
+    handle_record.
+    If a lease_manager is given then only the shards that we hold leases on are run.  The leases are renewed and
+    taken every lease_interval seconds; a shard whose lease has gone is asked to stop (as it is if its checkpointer
+    finds that out first) and is not started again until its old consumer has finished.
+    stop() (or SIGINT/SIGTERM) is the one shutdown path for every shard: each one finishes the batch it is on,
+    flushes its checkpoint and returns, and then the executors are shut down.
+    """
+    def __init__(self, stream_name, make_responder, list_ready_shards, worker_count=8, io_worker_count=4,
+                 reshard_check_interval=300, metrics=shard_metrics, lease_manager=None, lease_interval=10):
+        """
+        Initialise
+        :param stream_name: name of the stream
+        :param make_responder: callable that takes a shard information dictionary and returns a KinesisResponder
+        :param list_ready_shards: callable that returns the shard information dictionaries for the shards that can be
+        processed now. It is called from the I/O executor every reshard_check_interval seconds.
+        :param worker_count: number of threads to run process() and the checkpoint writes on, across all shards
+        :param io_worker_count: number of threads to make Kinesis calls on
+        :param lease_manager: LeaseManager to share the shards with other processes, or None to run every ready shard
+        :param lease_interval: seconds between renewing our leases
+        """
+        self.stream_name = stream_name
+        self.make_responder = make_responder
+        self.list_ready_shards = list_ready_shards
+        self.reshard_check_interval = reshard_check_interval
+        self.metrics = metrics
+        self.lease_manager = lease_manager
+        self.lease_interval = lease_interval
+        self._work = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="kinesis-work")
+        self._io = ThreadPoolExecutor(max_workers=io_worker_count, thread_name_prefix="kinesis-io")
+        self._loop = None
+        self._stop = None
+        self._tasks = {}
+        self._responders = {}
+        self._ready = []
+        self._held = set()
+        self.ended_shards = set()
+
+    def stop(self):
+        """
+        Asks every shard to stop. This can be called from any thread.
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    @property
+    def stopping(self):
+        return self._stop is not None and self._stop.is_set()
+
+    def _halted(self, responder):
+        """
+        :return: True if the whole engine is stopping, or this shard has been asked to stop
+        """
+        return self.stopping or responder.stop_requested
+
+    async def _in_executor(self, executor, fn, *args):
+        def wrapper():
+            #executor threads are long-lived, so make sure that they don't hang on to stale database connections
+            close_old_connections()
+            return fn(*args)
+        return await self._loop.run_in_executor(executor, wrapper)
+
+    async def _wait_or_stop(self, delay):
+        """
+        Sleeps for the given time, or until we are asked to stop
+        :return: True if we are stopping
+        """
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping
+
+    @staticmethod
+    def _provider_for(responder):
+        return get_credential_provider(responder.role_name, responder.session_name,
+                                       aws_access_key_id=responder._aws_access_key_id,
+                                       aws_secret_access_key=responder._aws_secret_access_key)
+
+    async def _fetch(self, responder, position, iterator):
+        """
+        Makes one get_records call, dealing with the errors that we can recover from
+        :return: tuple of (response or None, iterator to use next time, position to renew the iterator from)
+        """
+        provider = self._provider_for(responder)
+        shard_id = responder.shard_id
+        backoff = 1
+        while not self._halted(responder):
+            delay = responder.read_scheduler.read_delay(shard_id)
+            if delay > 0:
+                self.metrics.increment(self.stream_name, shard_id, "throttle_avoided")
+                await self._wait_or_stop(delay)
+                continue
+            try:
+                if iterator is None:
+                    iterator = await self._in_executor(self._io, lambda: get_shard_iterator(provider.connection('kinesis'),
+                                                                                            self.stream_name, shard_id,
+                                                                                            position[0],
+                                                                                            sequence_number=position[1],
+                                                                                            timestamp=position[2]))
+                result = await self._in_executor(self._io, lambda: provider.connection('kinesis').get_records(
+                    iterator, limit=responder.poll_controller.limit, b64_decode=False))
+            except kinesis.exceptions.ExpiredIteratorException:
+                logger.warning("{0}: iterator expired, getting a new one".format(shard_id))
+                self.metrics.increment(self.stream_name, shard_id, "iterator_expired")
+                iterator = None
+                continue
+            except kinesis.exceptions.ProvisionedThroughputExceededException:
+                responder.read_scheduler.record_throttled(shard_id)
+                await self._wait_or_stop(backoff)
+                backoff = min(backoff*2, 30)
+                continue
+            except boto.exception.JSONResponseError as e:
+                if e.error_code != 'ExpiredTokenException':
+                    raise
+                logger.warning("Access credentials expired, refreshing...")
+                provider.expire_connection('kinesis')
+                continue
+
+            responder.read_scheduler.after_read(shard_id, result['Records'])
+            if len(result['Records']) > 0:
+                position = (AFTER_SEQUENCE_NUMBER, result['Records'][-1]['SequenceNumber'], None)
+            return result, result['NextShardIterator'], position
+        return None, iterator, position
+
+    @staticmethod
+    def _process_batch(responder, records, millis_behind_latest):
+        for rec in records:
+            responder.handle_record(rec, millis_behind_latest)
+        responder.checkpointer.batch_completed()
+
+    async def consume_shard(self, responder):
+        """
+        Reads a shard until it ends or we are asked to stop
+        :param responder: KinesisResponder for the shard
+        :return: None
+        """
+        shard_id = responder.shard_id
+        logger.info("Starting up consumer for shard {0}".format(shard_id))
+        await self._in_executor(self._work, responder.startup)
+        position = await self._in_executor(self._work, responder.start_position)
+        pending = asyncio.ensure_future(self._fetch(responder, position, None))
+        try:
+            while True:
+                result, iterator, position = await pending
+                pending = None
+                if result is None:
+                    break
+
+                records = decode_records(result['Records'])
+                responder.poll_controller.record_batch(len(result['Records']), result['MillisBehindLatest'])
+                if iterator is not None and not self._halted(responder):
+                    #read ahead while this batch is processed
+                    pending = asyncio.ensure_future(self._fetch(responder, position, iterator))
+                if len(records) > 0:
+                    await self._in_executor(self._work, self._process_batch, responder, records, result['MillisBehindLatest'])
+                else:
+                    await self._in_executor(self._work, responder.checkpointer.batch_completed)
+
+                if pending is None:
+                    break
+                delay = responder.poll_controller.next_delay()
+                if delay > 0 and await self._wait_or_stop(delay):
+                    break
+        finally:
+            if pending is not None:
+                pending.cancel()
+            await self._in_executor(self._work, responder.wait_for_outstanding)
+            await self._in_executor(self._work, responder.checkpointer.flush)
+
+        if self._halted(responder):
+            logger.info("Stopped processing shard {0} on request".format(shard_id))
+        else:
+            logger.info("Shard {0} has been closed and there are no more records to read".format(shard_id))
+            await self._in_executor(self._work, responder.checkpointer.mark_shard_end)
+            responder.shard_ended = True
+            self.ended_shards.add(shard_id)
+            if self.lease_manager is not None:
+                await self._in_executor(self._io, self.lease_manager.retire_shard, shard_id)
+
+    async def run_shard(self, shardinfo):
+        """
+        Builds the responder for a shard and reads the shard with it
+        :param shardinfo: shard information dictionary
+        :return: None
+        """
+        shard_id = shardinfo['ShardId']
+        responder = await self._in_executor(self._io, self.make_responder, shardinfo)
+        if self.stopping or (self.lease_manager is not None and shard_id not in self._held):
+            return
+        self._responders[shard_id] = responder
+        try:
+            await self.consume_shard(responder)
+        finally:
+            del self._responders[shard_id]
+
+    def _start_shards(self, shardlist):
+        self._ready = shardlist
+        for shardinfo in shardlist:
+            shard_id = shardinfo['ShardId']
+            if shard_id in self._tasks or shard_id in self.ended_shards:
+                continue
+            if self.lease_manager is not None and shard_id not in self._held:
+                continue
+            self._tasks[shard_id] = asyncio.ensure_future(self.run_shard(shardinfo))
+
+    def _cycle_leases(self):
+        """
+        Renews our leases and takes any more that we are due. This is called on the I/O executor.
+        :return: set of the shard IDs that we hold
+        """
+        self.lease_manager.renew_leases()
+        self.lease_manager.acquire_leases(eligible_shards=set([shardinfo['ShardId'] for shardinfo in self._ready]))
+        return self.lease_manager.held_shards
+
+    async def update_leases(self):
+        """
+        Brings our leases up to date, stops the shards that we have lost and starts the ones that we have gained
+        """
+        self._held = await self._in_executor(self._io, self._cycle_leases)
+        for shard_id, responder in list(self._responders.items()):
+            if shard_id not in self._held and not responder.stop_requested:
+                logger.info("No longer hold shard {0}, stopping it".format(shard_id))
+                responder.request_stop()
+        self._start_shards(self._ready)
+
+    async def run_async(self, initial_shards):
+        self._loop = asyncio.get_event_loop()
+        self._stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(signum, self._stop.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                #not available off the main thread or on some platforms
+                pass
+
+        self._start_shards(initial_shards)
+        last_check = self._loop.time()
+        last_lease_update = None
+        stop_waiter = asyncio.ensure_future(self._stop.wait())
+        try:
+            while not self.stopping:
+                if self.lease_manager is not None and \
+                        (last_lease_update is None or self._loop.time() - last_lease_update >= self.lease_interval):
+                    await self.update_leases()
+                    last_lease_update = self._loop.time()
+                next_check = last_check + self.reshard_check_interval
+                if last_lease_update is not None:
+                    next_check = min(next_check, last_lease_update + self.lease_interval)
+                timeout = max(0, next_check - self._loop.time())
+                await asyncio.wait(list(self._tasks.values()) + [stop_waiter], timeout=timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                retired = 0
+                for shard_id, task in list(self._tasks.items()):
+                    if not task.done():
+                        continue
+                    del self._tasks[shard_id]
+                    if task.exception() is not None:
+                        logger.error("Consumer for shard {0} failed: {1}".format(shard_id, task.exception()))
+                        raise task.exception()
+                    if shard_id in self.ended_shards:
+                        retired += 1
+                if self.stopping:
+                    break
+                if retired > 0 or self._loop.time() - last_check >= self.reshard_check_interval:
+                    #children of a shard that has just ended may be ready now
+                    self.metrics.log_summary()
+                    self._start_shards(await self._in_executor(self._io, self.list_ready_shards))
+                    last_check = self._loop.time()
+        finally:
+            self._stop.set()
+            if len(self._tasks) > 0:
+                await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            stop_waiter.cancel()
+            if self.lease_manager is not None:
+                await self._in_executor(self._io, self.lease_manager.release_all)
+
+    def run(self, initial_shards):
+        """
+        Runs the engine until it is stopped
+        :param initial_shards: shard information dictionaries for the shards to start with
+        :return: None
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run_async(initial_shards))
+        finally:
+            self._work.shutdown(wait=True)
+            self._io.shutdown(wait=True)
+            loop.close()
@@ -0,0 +1,240 @@
+from django.db.models import Exists
+from django.utils import timezone
+from .models import KinesisTracker, ShardCheckpoint, ShardLease
+from .metrics import shard_metrics
+from datetime import datetime
+from threading import RLock
+import logging
+
+logger = logging.getLogger(__name__)
+
+MODE_PER_RECORD = 'record'
+MODE_BATCHED = 'batched'
+
+
+class Checkpointer(object):
+    """
+    Base class for recording our progress through a shard in the KinesisTracker table.
+    KinesisResponder calls record_seen() for every record it gets from the stream, then record_done() or record_error()
+    once process() has returned, and batch_completed() once it has worked through a whole get_records batch.
+    Subclasses decide when these are actually written to the database.
+    The point to resume from is kept in ShardCheckpoint, which save_checkpoint() updates in place.
+    If lease_owner is set then the checkpoint is only moved while that worker still holds a live ShardLease on the
+    shard, so that a worker that has lost its lease can't move the new owner's checkpoint backwards. When that happens
+    on_lease_lost is called, so that the responder can stop.
+    """
+    def __init__(self, stream_name, shard_id, should_save=True, lease_owner=None, on_lease_lost=None):
+        self.stream_name = stream_name
+        self.shard_id = shard_id
+        self.should_save = should_save
+        self.lease_owner = lease_owner
+        self.on_lease_lost = on_lease_lost
+
+    def record_seen(self, rec, millis_behind_latest):
+        """
+        Builds a tracker record for the given kinesis record
+        :param rec: dictionary of the record, as returned in the Records list from get_records
+        :param millis_behind_latest: MillisBehindLatest value from the get_records response
+        :return: an unsaved KinesisTracker instance
+        """
+        dbrec = KinesisTracker()
+        dbrec.stream_name = self.stream_name
+        dbrec.shard_id = self.shard_id
+        dbrec.created = datetime.now()
+        dbrec.updated = datetime.now()
+        dbrec.sequence_number = rec['SequenceNumber']
+        dbrec.status = KinesisTracker.ST_SEEN
+        dbrec.processing_host = "myhost"
+        dbrec.millis_behind_latest = millis_behind_latest
+        #sub-records of an aggregated record share its sequence number, which we can only checkpoint after the last one
+        dbrec.completes_record = rec.get('LastSubRecord', True)
+        return dbrec
+
+    def record_done(self, dbrec):
+        raise NotImplementedError("record_done must be implemented in a subclass")
+
+    def record_error(self, dbrec, exception, trace):
+        raise NotImplementedError("record_error must be implemented in a subclass")
+
+    def batch_completed(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def save_checkpoint(self, sequence_number):
+        """
+        Records that we should resume processing after the given sequence number
+        :param sequence_number: sequence number of the last record that we have finished with
+        :return:
+        """
+        if not self.should_save:
+            return
+        checkpoints = ShardCheckpoint.objects.filter(stream_name=self.stream_name, shard_id=self.shard_id)
+        if self.lease_owner is not None:
+            #a single conditional update, so the lease can't change hands between checking it and moving the checkpoint
+            checkpoints = checkpoints.filter(Exists(self._held_lease()))
+        updated = checkpoints.update(sequence_number=sequence_number, updated=datetime.now())
+        if updated == 0 and self.lease_is_held():
+            ShardCheckpoint.objects.update_or_create(stream_name=self.stream_name, shard_id=self.shard_id,
+                                                     defaults={'sequence_number': sequence_number,
+                                                               'updated': datetime.now()})
+
+    def mark_shard_end(self):
+        """
+        Records that the shard has been closed and we have read everything in it, so that child shards can be started
+        """
+        self.flush()
+        if not self.should_save or not self.lease_is_held():
+            return
+        ShardCheckpoint.objects.update_or_create(stream_name=self.stream_name, shard_id=self.shard_id,
+                                                 defaults={'finished': True, 'updated': datetime.now()})
+
+    def _held_lease(self):
+        return ShardLease.objects.filter(stream_name=self.stream_name, shard_id=self.shard_id, owner=self.lease_owner,
+                                         lease_expiry__gt=timezone.now())
+
+    def lease_is_held(self):
+        """
+        Checks that we still hold the lease on the shard, calling on_lease_lost if we don't
+        :return: True if we hold the lease, or aren't using leases at all
+        """
+        if self.lease_owner is None:
+            return True
+        if self._held_lease().exists():
+            return True
+        logger.warning("{0} no longer holds the lease on shard {1}, not moving its checkpoint".format(self.lease_owner, self.shard_id))
+        shard_metrics.increment(self.stream_name, self.shard_id, "checkpoint_lease_lost")
+        if self.on_lease_lost is not None:
+            self.on_lease_lost()
+        return False
+
+    @staticmethod
+    def _mark_error(dbrec, exception, trace):
+        dbrec.status = KinesisTracker.ST_ERROR
+        dbrec.updated = datetime.now()
+        dbrec.last_exception = str(exception)
+        dbrec.exception_trace = trace
+
+
+class PerRecordCheckpointer(Checkpointer):
+    """
+    Writes every state change of every record straight to the database. This costs several writes per record but means
+    that the table always shows exactly what is going on.
+    """
+    def record_seen(self, rec, millis_behind_latest):
+        dbrec = super(PerRecordCheckpointer, self).record_seen(rec, millis_behind_latest)
+        if self.should_save:
+            dbrec.save()
+
+        dbrec.status = KinesisTracker.ST_PROCESSING
+        if self.should_save:
+            dbrec.save()
+        return dbrec
+
+    def record_done(self, dbrec):
+        dbrec.status = KinesisTracker.ST_DONE
+        if self.should_save:
+            dbrec.save()
+        if getattr(dbrec, "completes_record", True):
+            self.save_checkpoint(dbrec.sequence_number)
+
+    def record_error(self, dbrec, exception, trace):
+        self._mark_error(dbrec, exception, trace)
+        if self.should_save:
+            dbrec.save()
+        if getattr(dbrec, "completes_record", True):
+            self.save_checkpoint(dbrec.sequence_number)
+
+
+class BatchedCheckpointer(Checkpointer):
+    """
+    Keeps completed records in memory and writes them out with a single bulk insert. By default this happens once per
+    get_records batch; if flush_every_records and/or flush_every_seconds are set then we flush whenever either limit is
+    reached instead.
+    Errors are always written out immediately, along with anything that completed before them so that the table order
+    (and hence the resume point) stays correct.
+    If the process dies before a flush, the unwritten records are processed again on restart.
+    This is safe to call from several threads at once, which happens when records are processed in parallel.
+    """
+    def __init__(self, stream_name, shard_id, should_save=True, flush_every_records=None, flush_every_seconds=None,
+                 lease_owner=None, on_lease_lost=None):
+        super(BatchedCheckpointer, self).__init__(stream_name, shard_id, should_save=should_save,
+                                                  lease_owner=lease_owner, on_lease_lost=on_lease_lost)
+        self.flush_every_records = flush_every_records
+        self.flush_every_seconds = flush_every_seconds
+        self._pending = []
+        self._last_flush = datetime.now()
+        self._lock = RLock()
+
+    @property
+    def flushes_per_batch(self):
+        return self.flush_every_records is None and self.flush_every_seconds is None
+
+    def record_done(self, dbrec):
+        dbrec.status = KinesisTracker.ST_DONE
+        dbrec.updated = datetime.now()
+        with self._lock:
+            self._pending.append(dbrec)
+            self._maybe_flush()
+
+    def record_error(self, dbrec, exception, trace):
+        self._mark_error(dbrec, exception, trace)
+        with self._lock:
+            self._pending.append(dbrec)
+            self.flush()
+
+    def batch_completed(self):
+        with self._lock:
+            if self.flushes_per_batch:
+                self.flush()
+            else:
+                self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self.flush_every_records is not None and len(self._pending) >= self.flush_every_records:
+            self.flush()
+        elif self.flush_every_seconds is not None and \
+                (datetime.now() - self._last_flush).total_seconds() >= self.flush_every_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes out everything that is pending in a single bulk insert and moves the shard checkpoint on to the last of them
+        :return: the number of records written
+        """
+        with self._lock:
+            to_write = self._pending
+            self._pending = []
+            self._last_flush = datetime.now()
+            if len(to_write) == 0 or not self.should_save:
+                return 0
+
+            KinesisTracker.objects.bulk_create(to_write)
+            completed = [dbrec for dbrec in to_write if getattr(dbrec, "completes_record", True)]
+            if len(completed) > 0:
+                self.save_checkpoint(completed[-1].sequence_number)
+        logger.debug("Checkpointed {0} records for shard {1}".format(len(to_write), self.shard_id))
+        return len(to_write)
+
+
+def make_checkpointer(mode, stream_name, shard_id, should_save=True, flush_every_records=None, flush_every_seconds=None,
+                      lease_owner=None, on_lease_lost=None):
+    """
+    Returns a checkpointer instance for the given mode
+    :param mode: either MODE_PER_RECORD or MODE_BATCHED
+    :param lease_owner: if set, only checkpoint while this worker holds the lease on the shard
+    :param on_lease_lost: called if a checkpoint is refused because the lease has gone
+    :return: a Checkpointer subclass instance
+    """
+    if mode is None or mode == MODE_PER_RECORD:
+        return PerRecordCheckpointer(stream_name, shard_id, should_save=should_save, lease_owner=lease_owner,
+                                     on_lease_lost=on_lease_lost)
+    elif mode == MODE_BATCHED:
+        return BatchedCheckpointer(stream_name, shard_id, should_save=should_save,
+                                   flush_every_records=flush_every_records,
+                                   flush_every_seconds=flush_every_seconds,
+                                   lease_owner=lease_owner,
+                                   on_lease_lost=on_lease_lost)
+    else:
+        raise ValueError("Unrecognised checkpoint mode: {0}".format(mode))
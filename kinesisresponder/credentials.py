@@ -0,0 +1,142 @@
+from boto import kinesis, s3, sts
+import boto.utils
+from datetime import datetime
+from threading import Lock, RLock, local
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REGION = 'eu-west-1'
+
+connection_factories = {
+    'kinesis': kinesis.connect_to_region,
+    's3': s3.connect_to_region,
+}
+
+
+class CredentialProvider(object):
+    """
+    Process-wide, thread-safe cache of the temporary credentials for an assumed role.  The role is only assumed again
+    when the credentials are within refresh_margin seconds of expiring, rather than every time that we need to talk to AWS.
+    connection() also hands out boto connections built from the current credentials.  These are cached per thread,
+    because boto connections are not safe to share between threads, and rebuilt whenever the credentials change.
+    Anything signed with the credentials, like a presigned URL, stops working when they expire.  get_credentials() can
+    be asked for credentials that last a given time, and assumes the role for a longer session if the current one won't,
+    up to max_session_duration (which must not be more than the role's own maximum session duration).
+    """
+    def __init__(self, role_name, session_name, aws_access_key_id=None, aws_secret_access_key=None, region=DEFAULT_REGION,
+                 refresh_margin=300, max_session_duration=3600):
+        self.role_name = role_name
+        self.session_name = session_name
+        self.region = region
+        self.refresh_margin = refresh_margin
+        self.max_session_duration = max_session_duration
+        self._aws_access_key_id = aws_access_key_id
+        self._aws_secret_access_key = aws_secret_access_key
+
+        self._lock = RLock()
+        self._credentials = None
+        self._generation = 0
+        self._local = local()
+
+    def _needs_refresh(self):
+        return self._credentials is None or self._credentials.is_expired(time_offset_seconds=self.refresh_margin)
+
+    def _refresh(self, duration=None):
+        logger.info("Assuming role {0} for session {1}".format(self.role_name, self.session_name))
+        sts_conn = sts.connect_to_region(self.region,
+                                         aws_access_key_id=self._aws_access_key_id,
+                                         aws_secret_access_key=self._aws_secret_access_key)
+        if duration is None:
+            self._credentials = sts_conn.assume_role(self.role_name, self.session_name).credentials
+        else:
+            self._credentials = sts_conn.assume_role(self.role_name, self.session_name, duration_seconds=duration).credentials
+        self._generation += 1
+
+    @staticmethod
+    def remaining_lifetime(credentials):
+        """
+        :param credentials: boto.sts.credentials.Credentials instance
+        :return: number of seconds until the credentials expire
+        """
+        return (boto.utils.parse_ts(credentials.expiration) - datetime.utcnow()).total_seconds()
+
+    def get_credentials(self, lifetime=None):
+        """
+        Returns temporary credentials for the role, assuming it again first if they are about to expire
+        :param lifetime: if given, the credentials should still be valid after this many seconds. If the current ones
+        won't be, the role is assumed again for a session long enough to cover it, or max_session_duration if that is
+        shorter; check remaining_lifetime() to see what you actually got.
+        :return: boto.sts.credentials.Credentials instance
+        """
+        if lifetime is None:
+            return self._current()[0]
+        with self._lock:
+            if self._needs_refresh() or self.remaining_lifetime(self._credentials) < lifetime:
+                #never ask for less than a default session, which is an hour
+                self._refresh(duration=int(min(max(lifetime + self.refresh_margin, 3600), self.max_session_duration)))
+            return self._credentials
+
+    def make_connection(self, service, credentials):
+        """
+        Builds a new boto connection from the given credentials. Use connection() unless you need particular credentials.
+        """
+        return connection_factories[service](self.region, aws_access_key_id=credentials.access_key,
+                                             aws_secret_access_key=credentials.secret_key,
+                                             security_token=credentials.session_token)
+
+    def _current(self):
+        with self._lock:
+            if self._needs_refresh():
+                self._refresh()
+            return self._credentials, self._generation
+
+    def connection(self, service):
+        """
+        Returns a boto connection to the given service for the calling thread, using the current credentials
+        :param service: 'kinesis' or 's3'
+        :return: boto connection object
+        """
+        credentials, generation = self._current()
+        cache = getattr(self._local, "connections", None)
+        if cache is None:
+            cache = self._local.connections = {}
+
+        cached = cache.get(service)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        conn = self.make_connection(service, credentials)
+        cache[service] = (generation, conn)
+        return conn
+
+    def expire_connection(self, service):
+        """
+        Call this when AWS has told us that our token has expired.  If the calling thread's connection was built from
+        the current credentials then they are thrown away; either way, the next call to connection() gets a new one.
+        Only the first thread to report a given set of credentials causes a refresh, so a burst of errors from several
+        threads results in one new AssumeRole call.
+        """
+        cache = getattr(self._local, "connections", {})
+        cached = cache.pop(service, None)
+        with self._lock:
+            if cached is None or cached[0] == self._generation:
+                self._credentials = None
+
+
+_providers = {}
+_providers_lock = Lock()
+
+
+def get_credential_provider(role_name, session_name, aws_access_key_id=None, aws_secret_access_key=None):
+    """
+    Returns the shared CredentialProvider for the given role and session, creating it if necessary
+    """
+    from django.conf import settings
+    key = (role_name, session_name, aws_access_key_id)
+    with _providers_lock:
+        if key not in _providers:
+            _providers[key] = CredentialProvider(role_name, session_name, aws_access_key_id=aws_access_key_id,
+                                                 aws_secret_access_key=aws_secret_access_key,
+                                                 max_session_duration=getattr(settings, "AWS_ROLE_MAX_SESSION_DURATION", 3600))
+        return _providers[key]
@@ -1,27 +1,73 @@
 from boto import kinesis
 from boto.kinesis import exceptions, layer1 as kl1
 import boto.exception
-from boto import sts
-from .models import KinesisTracker
-from datetime import datetime, timedelta
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from .models import ShardCheckpoint
+from .checkpointer import make_checkpointer
+from .poll_controller import PollController, KINESIS_MAX_RECORDS_LIMIT
+from .ordered_executor import OrderedKeyExecutor
+from .credentials import get_credential_provider
+from .prefetcher import RecordPrefetcher
+from .read_scheduler import get_read_scheduler
+from datetime import datetime, timedelta, timezone
 import logging
 from time import sleep
-from threading import Thread
+from threading import Thread, Event
 import traceback
+import json
+import calendar
 from random import Random
 logger = logging.getLogger(__name__)
 
 TRIM_HORIZON = 'TRIM_HORIZON'
+LATEST = 'LATEST'
+AT_TIMESTAMP = 'AT_TIMESTAMP'
+AT_SEQUENCE_NUMBER = 'AT_SEQUENCE_NUMBER'
 AFTER_SEQUENCE_NUMBER = 'AFTER_SEQUENCE_NUMBER'
 
 
+def get_shard_iterator(conn, stream_name, shard_id, iterator_type, sequence_number=None, timestamp=None):
+    """
+    Gets a shard iterator of any type.  boto's get_shard_iterator does not know about AT_TIMESTAMP, so for that we make
+    the GetShardIterator request ourselves.
+    :param conn: kinesis layer1 connection
+    :param stream_name: name of the stream
+    :param shard_id: shard to get the iterator for
+    :param iterator_type: one of TRIM_HORIZON, LATEST, AT_TIMESTAMP, AT_SEQUENCE_NUMBER or AFTER_SEQUENCE_NUMBER
+    :param sequence_number: sequence number for AT_SEQUENCE_NUMBER and AFTER_SEQUENCE_NUMBER
+    :param timestamp: UTC datetime for AT_TIMESTAMP
+    :return: shard iterator string
+    """
+    if iterator_type == AT_TIMESTAMP:
+        if timestamp is None:
+            raise ValueError("AT_TIMESTAMP needs a timestamp")
+        params = {
+            'StreamName': stream_name,
+            'ShardId': shard_id,
+            'ShardIteratorType': AT_TIMESTAMP,
+            'Timestamp': calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond/1000000.0,
+        }
+        rtn = conn.make_request(action='GetShardIterator', body=json.dumps(params))
+    elif iterator_type in (AT_SEQUENCE_NUMBER, AFTER_SEQUENCE_NUMBER):
+        if sequence_number is None:
+            raise ValueError("{0} needs a sequence number".format(iterator_type))
+        rtn = conn.get_shard_iterator(stream_name, shard_id, iterator_type, starting_sequence_number=sequence_number)
+    else:
+        rtn = conn.get_shard_iterator(stream_name, shard_id, iterator_type)
+    return rtn['ShardIterator']
+
+
 class KinesisResponder(Thread):
     """
     Kinesis responder class that deals with getting stuff from a stream shard.  You can subclass this to do interesting
     things with the messages - simply over-ride the process() method to get called whenever something comes in from the stream.
     """
 
-    def __init__(self, role_name, session_name, stream_name, shard_id, aws_access_key_id=None, aws_secret_access_key=None, should_save=True, **kwargs):
+    def __init__(self, role_name, session_name, stream_name, shard_id, aws_access_key_id=None, aws_secret_access_key=None, should_save=True,
+                 checkpoint_mode=None, checkpoint_every_records=None, checkpoint_every_seconds=None, worker_pool_size=None,
+                 initial_position=None, initial_timestamp=None, skip_older_than=None, prefetch_batches=None, lease_owner=None,
+                 parent_shard_ids=None, **kwargs):
         """
         Initialise
         :param role_name: ARN of role to assume
@@ -30,6 +76,26 @@ class KinesisResponder(Thread):
         :param shard_id: Shard to connect to
         :param aws_access_key_id: access key to use in order to assume the role given by role_name
         :param aws_secret_access_key: secret key to use in order to assume the role given by role_name
+        :param should_save: if False, don't write anything to the KinesisTracker table
+        :param checkpoint_mode: 'record' to write every state change of every record, or 'batched' to write progress
+        out in bulk. Defaults to the KINESIS_CHECKPOINT_MODE setting.
+        :param checkpoint_every_records: in batched mode, flush after this many records rather than once per batch
+        :param checkpoint_every_seconds: in batched mode, flush after this many seconds rather than once per batch
+        :param worker_pool_size: number of records to process in parallel. Records with the same ordering_key() are
+        still processed in order. Defaults to the KINESIS_SHARD_WORKER_POOL_SIZES setting for this shard, or
+        KINESIS_WORKER_POOL_SIZE if the shard is not listed there.
+        :param initial_position: where to start if the shard has no checkpoint yet: TRIM_HORIZON, LATEST or AT_TIMESTAMP.
+        Defaults to the KINESIS_INITIAL_POSITION setting.
+        :param initial_timestamp: datetime (or ISO string), in UTC, to start at when initial_position is AT_TIMESTAMP.
+        Defaults to the KINESIS_INITIAL_TIMESTAMP setting.
+        :param skip_older_than: if set, a shard with no checkpoint never starts further back than this many seconds ago,
+        whatever initial_position says. Defaults to the KINESIS_SKIP_RECORDS_OLDER_THAN setting.
+        :param prefetch_batches: number of batches to read ahead while the current one is being processed. Defaults to
+        the KINESIS_PREFETCH_BATCHES setting.
+        :param lease_owner: worker ID of the LeaseManager that holds this shard, if leases are in use. The checkpoint is
+        only moved while that worker holds the lease, and the thread stops if it finds that it has lost it.
+        :param parent_shard_ids: IDs of the shards that this one was created from by resharding, if any. The base command
+        fills this in from describe_stream.
         """
         super(KinesisResponder, self).__init__(**kwargs)
         self.role_name = role_name
@@ -38,51 +104,121 @@ class KinesisResponder(Thread):
         self.stream_name = stream_name
         self.shard_id = shard_id
         self.should_save = should_save
+        self.checkpointer = make_checkpointer(
+            checkpoint_mode if checkpoint_mode is not None else getattr(settings, "KINESIS_CHECKPOINT_MODE", "record"),
+            stream_name,
+            shard_id,
+            should_save=should_save,
+            flush_every_records=checkpoint_every_records if checkpoint_every_records is not None else getattr(settings, "KINESIS_CHECKPOINT_EVERY_RECORDS", None),
+            flush_every_seconds=checkpoint_every_seconds if checkpoint_every_seconds is not None else getattr(settings, "KINESIS_CHECKPOINT_EVERY_SECONDS", None),
+            lease_owner=lease_owner,
+            on_lease_lost=self.request_stop
+        )
+        self.poll_controller = PollController(stream_name, shard_id,
+                                              max_limit=getattr(settings, "KINESIS_MAX_BATCH_LIMIT", KINESIS_MAX_RECORDS_LIMIT),
+                                              min_idle_delay=getattr(settings, "KINESIS_MIN_IDLE_DELAY", 1),
+                                              max_idle_delay=getattr(settings, "KINESIS_MAX_IDLE_DELAY", 10))
+        self.read_scheduler = get_read_scheduler(stream_name)
+
+        if worker_pool_size is None:
+            worker_pool_size = getattr(settings, "KINESIS_SHARD_WORKER_POOL_SIZES", {})\
+                .get(shard_id, getattr(settings, "KINESIS_WORKER_POOL_SIZE", 1))
+        if worker_pool_size > 1:
+            self.executor = OrderedKeyExecutor(worker_pool_size, thread_name_prefix=shard_id)
+        else:
+            self.executor = None
+
+        self.initial_position = initial_position if initial_position is not None else getattr(settings, "KINESIS_INITIAL_POSITION", TRIM_HORIZON)
+        if self.initial_position not in (TRIM_HORIZON, LATEST, AT_TIMESTAMP):
+            raise ValueError("Invalid initial position {0}, expected TRIM_HORIZON, LATEST or AT_TIMESTAMP".format(self.initial_position))
+        if initial_timestamp is None:
+            initial_timestamp = getattr(settings, "KINESIS_INITIAL_TIMESTAMP", None)
+        if isinstance(initial_timestamp, str):
+            initial_timestamp = parse_datetime(initial_timestamp)
+            if initial_timestamp is None:
+                raise ValueError("Initial timestamp is not a valid timestamp")
+        self.initial_timestamp = initial_timestamp
+        if self.initial_position == AT_TIMESTAMP and self.initial_timestamp is None:
+            raise ValueError("An initial position of AT_TIMESTAMP needs an initial timestamp")
+        self.prefetch_batches = prefetch_batches if prefetch_batches is not None else getattr(settings, "KINESIS_PREFETCH_BATCHES", 1)
+        self.skip_older_than = skip_older_than if skip_older_than is not None else getattr(settings, "KINESIS_SKIP_RECORDS_OLDER_THAN", None)
+        self.parent_shard_ids = list(parent_shard_ids) if parent_shard_ids is not None else []
 
         self._aws_access_key_id = aws_access_key_id
         self._aws_secret_access_key = aws_secret_access_key
 
+        self._stop_requested = Event()
+        self.shard_ended = False
         self._random = Random()
         self._random.seed()
         self.refresh_access_credentials()
 
-    def refresh_access_credentials(self):
-        sts_conn = sts.connect_to_region('eu-west-1',
-                                         aws_access_key_id=self._aws_access_key_id,
-                                         aws_secret_access_key=self._aws_secret_access_key)
-
-        credentials = sts_conn.assume_role(self.role_name, self.session_name)
-        self._conn = kinesis.connect_to_region('eu-west-1', aws_access_key_id=credentials.credentials.access_key,
-                                               aws_secret_access_key=credentials.credentials.secret_key,
-                                               security_token=credentials.credentials.session_token)
+    def refresh_access_credentials(self, expired=False):
+        """
+        Gets a kinesis connection for the calling thread from the shared credential provider
+        :param expired: set this if AWS has just told us that our current token has expired
+        """
+        provider = get_credential_provider(self.role_name, self.session_name,
+                                           aws_access_key_id=self._aws_access_key_id,
+                                           aws_secret_access_key=self._aws_secret_access_key)
+        if expired:
+            provider.expire_connection('kinesis')
+        self._conn = provider.connection('kinesis')
 
     def most_recent_message_id(self):
         """
-        Scans the data model to find the most recent message ID, where we want to resume processing from
+        Looks up the checkpoint for this shard to find the most recent message ID, where we want to resume processing from
         :return: String of the sequence number or None of nothing was found
         """
         try:
-            record = KinesisTracker.objects.filter(stream_name=self.stream_name).filter(shard_id=self.shard_id).order_by('-created')[0]
-            return record.sequence_number
-
-        except IndexError:
+            return ShardCheckpoint.objects.get(stream_name=self.stream_name, shard_id=self.shard_id).sequence_number
+        except ShardCheckpoint.DoesNotExist:
             logger.warning("No tracked messages in database yet?")
             return None
 
-    def new_shard_iterator(self):
+    def cold_start_position(self):
         """
-        Return a shard iterator either pointing to just after the last message we processed (based on our data model)
-        or the earliest available point in the stream if no message is available
-        :return: Shard iterator
+        Works out where to start reading a shard that we have no checkpoint for, applying the skip_older_than guard.
+        A shard that came from resharding always starts at the trim horizon: it is only started once its parents are
+        finished, so anything written to it before then is still waiting for us and must not be skipped.
+        :return: tuple of (iterator type, UTC datetime or None)
+        """
+        if len(self.parent_shard_ids) > 0:
+            return TRIM_HORIZON, None
+        position = self.initial_position
+        timestamp = self.initial_timestamp if position == AT_TIMESTAMP else None
+        if self.skip_older_than is not None and position != LATEST:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.skip_older_than)
+            if timestamp is not None and timestamp.tzinfo is not None:
+                cutoff = cutoff.replace(tzinfo=timezone.utc)
+            if timestamp is None or timestamp < cutoff:
+                position, timestamp = AT_TIMESTAMP, cutoff
+        return position, timestamp
+
+    def start_position(self):
+        """
+        Works out where we should start reading: just after the last message we processed (based on our data model) or,
+        if there is no checkpoint yet, the position given by cold_start_position
+        :return: tuple of (iterator type, sequence number or None, UTC datetime or None)
         """
         last_seq_number = self.most_recent_message_id()
 
         if last_seq_number is None or last_seq_number=='':
-            rtn= self._conn.get_shard_iterator(self.stream_name,self.shard_id,TRIM_HORIZON)
-            return rtn['ShardIterator']
+            position, timestamp = self.cold_start_position()
+            logger.warning("No checkpoint for shard {0}, starting from {1}{2}".format(self.shard_id, position,
+                                                                                     " " + timestamp.isoformat() if timestamp is not None else ""))
+            return position, None, timestamp
         else:
-            rtn= self._conn.get_shard_iterator(self.stream_name,self.shard_id,AFTER_SEQUENCE_NUMBER,starting_sequence_number=last_seq_number)
-            return rtn['ShardIterator']
+            return AFTER_SEQUENCE_NUMBER, last_seq_number, None
+
+    def new_shard_iterator(self):
+        """
+        Return a shard iterator for the position given by start_position
+        :return: Shard iterator
+        """
+        position, sequence_number, timestamp = self.start_position()
+        return get_shard_iterator(self._conn, self.stream_name, self.shard_id, position, sequence_number=sequence_number,
+                                  timestamp=timestamp)
 
     def process(self,record, approx_arrival):
         """
@@ -97,6 +233,82 @@ class KinesisResponder(Thread):
         print("Message posted at approximately: " + str(approx_arrival))
         pprint(json.loads(record))
 
+    def startup(self):
+        """
+        Called once, before the shard is read. Override this to do any setup that needs to happen for the shard.
+        :return: None
+        """
+        pass
+
+    def ordering_key(self, rec):
+        """
+        When processing in parallel, records with the same ordering key are processed one at a time in stream order.
+        By default this is the record's partition key; subclasses can override it to use something from the content.
+        :param rec: dictionary of the record, as returned in the Records list from get_records
+        :return: a hashable key, or None if the record can be processed in any order
+        """
+        return rec.get('PartitionKey')
+
+    def handle_record(self, rec, millis_behind_latest):
+        """
+        Processes a single record from the stream, either straight away or on the worker pool if we have one
+        :param rec: dictionary of the record, as returned in the Records list from get_records
+        :param millis_behind_latest: MillisBehindLatest value from the get_records response
+        :return: None
+        """
+        dbrec = self.checkpointer.record_seen(rec, millis_behind_latest)
+        if self.executor is None:
+            self.record_completed(dbrec, self.run_process(rec, dbrec))
+        else:
+            self.executor.submit(self.ordering_key(rec),
+                                 lambda: self.run_process(rec, dbrec),
+                                 lambda failure: self.record_completed(dbrec, failure))
+
+    def run_process(self, rec, dbrec):
+        """
+        Calls process() for the given record, catching and reporting any exception
+        :return: None on success, or a tuple of (exception, traceback string) on failure
+        """
+        from .sentry import inform_sentry_exception
+        try:
+            self.process(rec['Data'], datetime.fromtimestamp(rec['ApproximateArrivalTimestamp']))
+            return None
+        except Exception as e:
+            trace = traceback.format_exc()
+            logger.error(trace)
+            inform_sentry_exception(extra_ctx={
+                "record": dbrec.__dict__
+            })
+            return e, trace
+
+    def record_completed(self, dbrec, failure):
+        """
+        Tells the checkpointer that a record has been dealt with. When processing in parallel this is called in stream
+        order, once everything before the record has also completed.
+        """
+        if failure is None:
+            self.checkpointer.record_done(dbrec)
+        else:
+            self.checkpointer.record_error(dbrec, *failure)
+
+    def wait_for_outstanding(self):
+        """
+        Blocks until any records being processed on the worker pool have completed
+        """
+        if self.executor is not None:
+            self.executor.wait_idle()
+
+    def request_stop(self):
+        """
+        Asks the thread to stop once it has finished with the records it already has, e.g. because we lost the lease
+        on the shard. Anything outstanding is checkpointed before the thread exits.
+        """
+        self._stop_requested.set()
+
+    @property
+    def stop_requested(self):
+        return self._stop_requested.is_set()
+
     def run(self):
         """
         This is called to start up the processing. We delegate to the mainloop() method and use this for exception handling
@@ -109,77 +321,44 @@ class KinesisResponder(Thread):
             logger.error("An uncaught exception occurred when handling shard {}: {}".format(self.shard_id, str(e)))
             logger.exception("Exception details: ", exc_info=e)
             exit(255)   #this only exits the thread, BUT we catch that again higher up...
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.checkpointer.flush()
 
     def mainloop(self):
         """
-        Main loop for processing the stream
+        Main loop for processing the stream. Fetching happens on a RecordPrefetcher thread, so that the next batch is
+        on its way while we process this one.
         :return:
         """
         from pprint import pformat
-        from .sentry import inform_sentry_exception
-        sleep_delay = 1
 
         logger.info("Starting up responder thread for shard {0}".format(self.shard_id))
-        iterator = self.new_shard_iterator()
-        logger.debug("shard iterator is {0}".format(iterator))
-        while iterator is not None:
-            try:
-                record = self._conn.get_records(iterator,limit=10)
-                if sleep_delay>1:
-                    sleep_delay /= 2
-            except kinesis.exceptions.ExpiredIteratorException as e:
-                logger.warning("Received expired iterator exception, getting new iterator: {0}".format(str(e)))
-                iterator = self.new_shard_iterator()
-                continue
-            except kinesis.exceptions.ProvisionedThroughputExceededException:
-                sleep(sleep_delay)
-                sleep_delay*=2
-                continue
-            except boto.exception.JSONResponseError as e:
-                if e.error_code=='ExpiredTokenException':
-                    logger.warning("Access credentials expired, refreshing...")
-                    self.refresh_access_credentials()
-                continue
-
-            time_lag = timedelta(seconds=record['MillisBehindLatest']/1000)
-            logger.debug("Time lag to this record set is {0}".format(time_lag))
-            logger.debug("Record set is dated {0}".format(datetime.now() - time_lag))
-
-            logger.debug(pformat(record))
-            for rec in record['Records']:
-                dbrec = KinesisTracker()
-                dbrec.stream_name = self.stream_name
-                dbrec.shard_id = self.shard_id
-                dbrec.created = datetime.now()
-                dbrec.updated = datetime.now()
-                dbrec.sequence_number = rec['SequenceNumber']
-                dbrec.status = KinesisTracker.ST_SEEN
-                dbrec.processing_host = "myhost"
-                dbrec.millis_behind_latest = record['MillisBehindLatest']
-                if self.should_save:
-                    dbrec.save()
-
-                dbrec.status = KinesisTracker.ST_PROCESSING
-                if self.should_save:
-                    dbrec.save()
-                try:
-                    self.process(rec['Data'], datetime.fromtimestamp(rec['ApproximateArrivalTimestamp']))
-                    dbrec.status = KinesisTracker.ST_DONE
-                    if self.should_save:
-                        dbrec.save()
-                except Exception as e:
-                    logger.error(traceback.format_exc())
-                    inform_sentry_exception(extra_ctx={
-                        "record": dbrec.__dict__
-                    })
-
-                    dbrec.status = KinesisTracker.ST_ERROR
-                    dbrec.last_exception = str(e)
-                    dbrec.exception_trace = traceback.format_exc()
-                    if self.should_save:
-                        dbrec.save()
-
-            iterator = record['NextShardIterator']
-            if len(record['Records'])==0 and record['MillisBehindLatest']==0:
-                sleep(10)
-        logger.info("Ran out of shard records to read")
+        self.startup()
+        prefetcher = RecordPrefetcher(self, self.start_position(), buffer_size=self.prefetch_batches)
+        prefetcher.start()
+        try:
+            while not self.stop_requested:
+                record = prefetcher.next_batch(self._stop_requested, on_idle=self.checkpointer.batch_completed)
+                if record is None:
+                    break
+
+                time_lag = timedelta(seconds=record['MillisBehindLatest']/1000)
+                logger.debug("Time lag to this record set is {0}".format(time_lag))
+                logger.debug("Record set is dated {0}".format(datetime.now() - time_lag))
+
+                logger.debug(pformat(record))
+                for rec in record['Records']:
+                    self.handle_record(rec, record['MillisBehindLatest'])
+                self.checkpointer.batch_completed()
+        finally:
+            prefetcher.request_stop()
+            prefetcher.join()
+        self.wait_for_outstanding()
+        if self.stop_requested:
+            logger.info("Stopped processing shard {0} on request".format(self.shard_id))
+        else:
+            logger.info("Shard {0} has been closed and there are no more records to read".format(self.shard_id))
+            self.checkpointer.mark_shard_end()
+            self.shard_ended = True
@@ -0,0 +1,151 @@
+from django.db.models import F
+from django.utils import timezone
+from .models import ShardLease
+from .metrics import shard_metrics
+from datetime import timedelta
+from random import Random
+import logging
+import math
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id():
+    """
+    Returns an identifier for this process that is unique across replicas
+    """
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+
+class LeaseManager(object):
+    """
+    Shares the shards of a stream between several responder processes, in a similar way to the leases in the Kinesis
+    Client Library.  Each shard has a ShardLease row; a process owns the shard for as long as it keeps renewing the
+    lease, and every change is made with a conditional update on lease_counter so that two processes can never both
+    think they got the same lease.
+    On each cycle a process renews what it holds, then takes expired or unowned leases until it has its fair share
+    (shards divided by live processes, rounded up).  If there is nothing free and another process holds more than its
+    share, one lease is stolen from the busiest process per cycle so that load evens out without thrashing.
+    """
+    def __init__(self, stream_name, worker_id=None, lease_duration=30, metrics=shard_metrics):
+        self.stream_name = stream_name
+        self.worker_id = worker_id if worker_id is not None else default_worker_id()
+        self.lease_duration = timedelta(seconds=lease_duration)
+        self.metrics = metrics
+        self._held = {}   #shard_id -> lease_counter that we last set
+        self._random = Random()
+        self._random.seed()
+
+    @property
+    def held_shards(self):
+        return set(self._held.keys())
+
+    def sync_shards(self, shard_ids):
+        """
+        Make sure that there is a lease row for every one of the given shards
+        :param shard_ids: iterable of shard ID strings
+        :return: None
+        """
+        ShardLease.objects.bulk_create([ShardLease(stream_name=self.stream_name, shard_id=shard_id) for shard_id in shard_ids],
+                                       ignore_conflicts=True)
+
+    def _take(self, lease, now):
+        """
+        Try to take over the given lease, as long as nobody else has changed it since we read it
+        :return: True if we now hold the lease
+        """
+        updated = ShardLease.objects.filter(pk=lease.pk, lease_counter=lease.lease_counter)\
+            .update(owner=self.worker_id, lease_expiry=now + self.lease_duration, lease_counter=F('lease_counter') + 1)
+        if updated == 1:
+            self._held[lease.shard_id] = lease.lease_counter + 1
+            return True
+        return False
+
+    def renew_leases(self):
+        """
+        Heartbeat: push out the expiry time on every lease that we hold
+        :return: set of shard IDs whose leases we have lost to another process
+        """
+        now = timezone.now()
+        lost = set()
+        for shard_id, counter in list(self._held.items()):
+            updated = ShardLease.objects.filter(stream_name=self.stream_name, shard_id=shard_id, owner=self.worker_id,
+                                                lease_counter=counter)\
+                .update(lease_expiry=now + self.lease_duration, lease_counter=F('lease_counter') + 1)
+            if updated == 1:
+                self._held[shard_id] = counter + 1
+            else:
+                logger.warning("{0}: lost lease on shard {1}".format(self.worker_id, shard_id))
+                del self._held[shard_id]
+                lost.add(shard_id)
+        return lost
+
+    def acquire_leases(self, eligible_shards=None):
+        """
+        Take as many leases as we need to have our fair share of the stream
+        :param eligible_shards: if given, only consider these shard IDs
+        :return: set of shard IDs that we took on this call
+        """
+        now = timezone.now()
+        leases = list(ShardLease.objects.filter(stream_name=self.stream_name))
+        if eligible_shards is not None:
+            leases = [lease for lease in leases if lease.shard_id in eligible_shards]
+
+        live = [lease for lease in leases if lease.owner is not None and lease.lease_expiry is not None and lease.lease_expiry > now]
+        by_owner = {}
+        for lease in live:
+            by_owner.setdefault(lease.owner, []).append(lease)
+        owner_count = len(set(by_owner.keys()) | {self.worker_id})
+        target = int(math.ceil(len(leases) / float(owner_count))) if owner_count > 0 else 0
+
+        mine = len(by_owner.get(self.worker_id, []))
+        needed = target - mine
+        taken = set()
+        if needed <= 0:
+            return taken
+
+        available = [lease for lease in leases if lease not in live]
+        self._random.shuffle(available)
+        for lease in available:
+            if len(taken) >= needed:
+                break
+            if self._take(lease, now):
+                logger.info("{0}: took lease on shard {1}".format(self.worker_id, lease.shard_id))
+                taken.add(lease.shard_id)
+
+        if len(taken) == 0 and len(available) == 0:
+            busiest_owner = max([owner for owner in by_owner.keys() if owner != self.worker_id],
+                                key=lambda owner: len(by_owner[owner]), default=None)
+            if busiest_owner is not None and len(by_owner[busiest_owner]) > target:
+                victim = self._random.choice(by_owner[busiest_owner])
+                if self._take(victim, now):
+                    logger.info("{0}: stole lease on shard {1} from {2}".format(self.worker_id, victim.shard_id, busiest_owner))
+                    self.metrics.increment(self.stream_name, victim.shard_id, "lease_stolen")
+                    taken.add(victim.shard_id)
+
+        for shard_id in taken:
+            self.metrics.increment(self.stream_name, shard_id, "lease_taken")
+        return taken
+
+    def release_lease(self, shard_id):
+        """
+        Give up a lease that we hold, so that another process can take it straight away
+        """
+        counter = self._held.pop(shard_id, None)
+        if counter is None:
+            return
+        ShardLease.objects.filter(stream_name=self.stream_name, shard_id=shard_id, owner=self.worker_id, lease_counter=counter)\
+            .update(owner=None, lease_expiry=None, lease_counter=F('lease_counter') + 1)
+
+    def retire_shard(self, shard_id):
+        """
+        Removes the lease for a shard that has been closed and read to the end, so that nobody picks it up again
+        """
+        self._held.pop(shard_id, None)
+        ShardLease.objects.filter(stream_name=self.stream_name, shard_id=shard_id).delete()
+
+    def release_all(self):
+        for shard_id in list(self._held.keys()):
+            self.release_lease(shard_id)
@@ -1,8 +1,14 @@
 # coding: utf-8
 from django.core.management.base import BaseCommand
-from boto import kinesis, sts
+from django.conf import settings
+import boto.exception
+from kinesisresponder.credentials import get_credential_provider
+from kinesisresponder.metrics import shard_metrics
+from kinesisresponder.lease_manager import LeaseManager
+from kinesisresponder.async_engine import AsyncConsumerEngine
+from kinesisresponder.models import ShardCheckpoint
 from pprint import pprint
-from time import sleep
+from time import sleep, time
 import logging
 import sys
 
@@ -13,7 +19,10 @@ class KinesisResponderBaseCommand(BaseCommand):
     """
     Base class for a Django command to run the responder.  Subclass this and:
      - set stream_name, role_name and session_name attributes
-     - override startup_thread to provide an instance of your responder
+     - override startup_thread to provide an instance of your responder, passing it **self.responder_options
+    The stream is re-described every KINESIS_RESHARD_CHECK_INTERVAL seconds, so that shards created by resharding are
+    picked up without a restart. A child shard is only started once its parents have been read to the end, and threads
+    for closed shards are retired once they have finished.
     """
     args = ''
     help = 'runs the test kinesis responder'
@@ -31,38 +40,295 @@ class KinesisResponderBaseCommand(BaseCommand):
         """
         raise RuntimeError("startup_thread must be implemented in your subclass!")
 
-    def handle(self, *args, **options):
-        if 'aws_access_key_id' in options and 'aws_secret_access_key' in options:
-            sts_conn = sts.connect_to_region('eu-west-1',
-                                             aws_access_key_id=options['aws_access_key_id'],
-                                             aws_secret_access_key=options['aws_secret_access_key'])
-        else:
-            sts_conn = sts.connect_to_region('eu-west-1')
+    def make_responder(self, shardinfo):
+        """
+        Calls startup_thread for a shard, and tells the responder about the shard's parents so that a child shard is
+        always read from the start
+        :param shardinfo: dictionary of information about the shard, returned from describe_stream
+        :return: the responder
+        """
+        responder = self.startup_thread(self._credentials, shardinfo)
+        responder.parent_shard_ids = [parent_id for parent_id in (shardinfo.get('ParentShardId'), shardinfo.get('AdjacentParentShardId'))
+                                      if parent_id is not None]
+        return responder
 
-        credentials = sts_conn.assume_role(self.role_name, self.session_name)
+    def add_arguments(self, parser):
+        parser.add_argument("--use-leases", action="store_true", default=getattr(settings, "KINESIS_USE_LEASES", False),
+                            help="Coordinate with other replicas via the ShardLease table so that each shard is only processed once")
+        parser.add_argument("--engine", choices=["threads", "asyncio"], default=getattr(settings, "KINESIS_ENGINE", "threads"),
+                            help="Run a thread per shard, or drive every shard from one asyncio event loop")
+        parser.add_argument("--initial-position", choices=["TRIM_HORIZON", "LATEST", "AT_TIMESTAMP"], default=None,
+                            help="Where to start reading shards that have no checkpoint yet. Defaults to the KINESIS_INITIAL_POSITION setting.")
+        parser.add_argument("--initial-timestamp", type=str, default=None,
+                            help="UTC time to start at for --initial-position AT_TIMESTAMP, in ISO format")
+        parser.add_argument("--skip-older-than", type=int, default=None,
+                            help="Never start a shard with no checkpoint further back than this many seconds ago")
 
-        conn = kinesis.connect_to_region('eu-west-1', aws_access_key_id=credentials.credentials.access_key,
-                                         aws_secret_access_key=credentials.credentials.secret_key,
-                                         security_token=credentials.credentials.session_token)
+    @staticmethod
+    def get_responder_options(options):
+        """
+        Picks out the command options that are passed on to each responder
+        :param options: command options
+        :return: dictionary of keyword arguments for the responder's constructor
+        """
+        return {key: options[key] for key in ("initial_position", "initial_timestamp", "skip_older_than")
+                if options.get(key) is not None}
 
-        streaminfo = conn.describe_stream(self.stream_name)
+    def connect(self, options, expired=False):
+        """
+        Gets credentials for our role and a connection to Kinesis from the shared credential provider
+        :param options: command options, which can contain aws_access_key_id and aws_secret_access_key
+        :param expired: set this if AWS has just told us that our current token has expired
+        :return: tuple of (credentials, kinesis connection)
+        """
+        provider = get_credential_provider(self.role_name, self.session_name,
+                                           aws_access_key_id=options.get('aws_access_key_id'),
+                                           aws_secret_access_key=options.get('aws_secret_access_key'))
+        if expired:
+            provider.expire_connection('kinesis')
+        conn = provider.connection('kinesis')
+        return provider.get_credentials(), conn
 
-        threadlist = [self.startup_thread(credentials.credentials, shardinfo) for shardinfo in streaminfo['StreamDescription']['Shards']]
+    def describe_shards(self, conn):
+        """
+        Gets the full list of shards in the stream, following describe_stream's paging
+        :param conn: kinesis connection
+        :return: list of shard information dictionaries
+        """
+        shardlist = []
+        exclusive_start_shard_id = None
+        while True:
+            streaminfo = conn.describe_stream(self.stream_name, exclusive_start_shard_id=exclusive_start_shard_id)
+            shardlist += streaminfo['StreamDescription']['Shards']
+            if not streaminfo['StreamDescription'].get('HasMoreShards', False) or len(shardlist) == 0:
+                return shardlist
+            exclusive_start_shard_id = shardlist[-1]['ShardId']
 
-        logger.info("Stream {0} has {1} shards".format(self.stream_name,len(threadlist)))
+    def refresh_shards(self, options):
+        """
+        Re-describes the stream, reconnecting first if our credentials have expired
+        :return: list of shard information dictionaries
+        """
+        try:
+            return self.describe_shards(self._conn)
+        except boto.exception.JSONResponseError as e:
+            if e.error_code != 'ExpiredTokenException':
+                raise
+            logger.warning("Access credentials expired, refreshing...")
+            self._credentials, self._conn = self.connect(options, expired=True)
+            return self.describe_shards(self._conn)
 
-        for t in threadlist:
+    def finished_shards(self):
+        """
+        :return: set of the IDs of shards in our stream that have been read to the end
+        """
+        return set(ShardCheckpoint.objects.filter(stream_name=self.stream_name, finished=True).values_list('shard_id', flat=True))
+
+    def ready_shards(self, shardlist):
+        """
+        Works out which shards can be processed now. Finished shards are never ready, and a shard that came from
+        resharding is only ready once its parents are finished (or have aged out of the stream altogether) so that
+        records for the same partition key are still processed in order.
+        :param shardlist: list of shard information dictionaries from describe_stream
+        :return: list of shard information dictionaries for the shards that can be started
+        """
+        finished = self.finished_shards()
+        known = set([shardinfo['ShardId'] for shardinfo in shardlist])
+
+        def parent_done(parent_id):
+            return parent_id is None or parent_id in finished or parent_id not in known
+
+        return [shardinfo for shardinfo in shardlist
+                if shardinfo['ShardId'] not in finished and
+                parent_done(shardinfo.get('ParentShardId')) and
+                parent_done(shardinfo.get('AdjacentParentShardId'))]
+
+    def check_threads(self, threads, on_retired=None):
+        """
+        Removes threads that have finished their shards from the dictionary, and exits the process if any other thread
+        has died
+        :param threads: dictionary of shard ID -> thread. This is updated in place
+        :param on_retired: optional callable that is passed the shard ID of every retired thread
+        :return: number of threads retired
+        """
+        retired = 0
+        for shard_id, t in list(threads.items()):
+            if t.is_alive():
+                continue
+            if getattr(t, "shard_ended", False):
+                logger.info("Shard {0} has been closed and fully read, retiring its thread".format(shard_id))
+                del threads[shard_id]
+                retired += 1
+                if on_retired is not None:
+                    on_retired(shard_id)
+            elif getattr(t, "stop_requested", False):
+                #it stopped because it found that it had lost its lease, and will be started again if we get it back
+                logger.info("Thread for shard {0} has stopped".format(shard_id))
+                del threads[shard_id]
+            else:
+                logger.error("A processing thread failed, exiting responder")
+                sys.exit(255)
+        return retired
+
+    def start_threads(self, shardlist, threads, allowed=None):
+        """
+        Starts a thread for every shard in the list that does not already have one
+        :param shardlist: list of shard information dictionaries for the shards to run
+        :param threads: dictionary of shard ID -> thread. This is updated in place
+        :param allowed: if given, only start shards whose ID is in this set
+        :return: None
+        """
+        for shardinfo in shardlist:
+            shard_id = shardinfo['ShardId']
+            if shard_id in threads or (allowed is not None and shard_id not in allowed):
+                continue
+            logger.info("Starting thread for shard {0}".format(shard_id))
+            t = self.make_responder(shardinfo)
             t.daemon = True
             t.start()
+            threads[shard_id] = t
+
+    def handle(self, *args, **options):
+        self.responder_options = self.get_responder_options(options)
+        self._credentials, self._conn = self.connect(options)
+
+        shardlist = self.describe_shards(self._conn)
+        logger.info("Stream {0} has {1} shards".format(self.stream_name,len(shardlist)))
+
+        if options.get("engine") == "asyncio":
+            return self.run_async_engine(options, shardlist)
+
+        if options.get("use_leases"):
+            return self.run_with_leases(options, shardlist)
+
+        threads = {}
+        self.start_threads(self.ready_shards(shardlist), threads)
+
+        reshard_check_interval = getattr(settings, "KINESIS_RESHARD_CHECK_INTERVAL", 300)
+        last_describe = time()
 
         print("Started up and processing. Hit CTRL-C to stop.", flush=True)
         #simplest way to allow ctrl-C when dealing with threads
         try:
             while True:
                 sleep(60)
-                for t in threadlist:
-                    if not t.is_alive():
-                        logger.error("A processing thread failed, exiting responder")
-                        sys.exit(255)
+                shard_metrics.log_summary()
+                retired = self.check_threads(threads)
+                described = False
+                if time() - last_describe >= reshard_check_interval:
+                    shardlist = self.refresh_shards(options)
+                    last_describe = time()
+                    described = True
+                if retired > 0 or described:
+                    self.start_threads(self.ready_shards(shardlist), threads)
+        except KeyboardInterrupt:
+            print("CTRL-C caught, cleaning up", flush=True)
+
+    def run_lease_cycle(self, lease_manager, credentials, shardlist, threads, stopping=None):
+        """
+        Renews our leases, takes any more that we are due, then makes sure that we are running a thread for exactly the
+        shards that we hold.
+        Threads for shards that we no longer hold are asked to stop but not waited for, because one that is part way
+        through a long download would hold up the renewal of every other lease. They are moved into stopping and
+        reaped on a later cycle; a shard isn't started again here until its old thread has gone.
+        :param lease_manager: LeaseManager instance
+        :param credentials: credentials object to pass on to startup_thread
+        :param shardlist: list of shard information dictionaries from describe_stream
+        :param threads: dictionary of shard ID -> running thread. This is updated in place.
+        :param stopping: dictionary of shard ID -> thread that has been asked to stop. This is updated in place.
+        :return: None
+        """
+        if stopping is None:
+            stopping = {}
+        self._credentials = credentials
+        lease_manager.renew_leases()
+        self.check_threads(threads, on_retired=lease_manager.retire_shard)
+        for shard_id in [shard_id for shard_id, t in stopping.items() if not t.is_alive()]:
+            logger.info("Thread for shard {0} has stopped".format(shard_id))
+            del stopping[shard_id]
+
+        ready = self.ready_shards(shardlist)
+        lease_manager.acquire_leases(eligible_shards=set([shardinfo['ShardId'] for shardinfo in ready]))
+        held = lease_manager.held_shards
+
+        for shard_id in list(threads.keys()):
+            if shard_id not in held:
+                logger.info("No longer hold shard {0}, stopping its thread".format(shard_id))
+                threads[shard_id].request_stop()
+                stopping[shard_id] = threads.pop(shard_id)
+
+        self.start_threads(ready, threads, allowed=held - set(stopping.keys()))
+
+    def run_with_leases(self, options, shardlist):
+        """
+        Runs the responder, only processing the shards that we hold leases on
+        :param options: command options
+        :param shardlist: list of shard information dictionaries from describe_stream
+        :return: None
+        """
+        lease_duration = getattr(settings, "KINESIS_LEASE_DURATION", 30)
+        reshard_check_interval = getattr(settings, "KINESIS_RESHARD_CHECK_INTERVAL", 300)
+        lease_manager = LeaseManager(self.stream_name, lease_duration=lease_duration)
+        lease_manager.sync_shards([shardinfo['ShardId'] for shardinfo in shardlist])
+        self.responder_options['lease_owner'] = lease_manager.worker_id
+        last_describe = time()
+        threads = {}
+        stopping = {}
+
+        logger.info("Coordinating shards as worker {0}".format(lease_manager.worker_id))
+        print("Started up and processing. Hit CTRL-C to stop.", flush=True)
+        try:
+            n = 0
+            while True:
+                if time() - last_describe >= reshard_check_interval:
+                    shardlist = self.refresh_shards(options)
+                    lease_manager.sync_shards([shardinfo['ShardId'] for shardinfo in shardlist])
+                    last_describe = time()
+                self.run_lease_cycle(lease_manager, self._credentials, shardlist, threads, stopping)
+                #renew well within the lease duration so that a slow cycle doesn't lose us our leases
+                sleep(lease_duration/3.0)
+                n += 1
+                if n % 6 == 0:
+                    shard_metrics.log_summary()
         except KeyboardInterrupt:
             print("CTRL-C caught, cleaning up", flush=True)
+            for t in threads.values():
+                t.request_stop()
+            for t in list(threads.values()) + list(stopping.values()):
+                t.join()
+            lease_manager.release_all()
+
+    def run_async_engine(self, options, shardlist):
+        """
+        Runs every shard from a single event loop, see AsyncConsumerEngine. With --use-leases, only the shards that we
+        hold leases on are run.
+        :param options: command options
+        :param shardlist: list of shard information dictionaries from describe_stream
+        :return: None
+        """
+        lease_manager = None
+        lease_duration = getattr(settings, "KINESIS_LEASE_DURATION", 30)
+        if options.get("use_leases"):
+            lease_manager = LeaseManager(self.stream_name, lease_duration=lease_duration)
+            lease_manager.sync_shards([shardinfo['ShardId'] for shardinfo in shardlist])
+            self.responder_options['lease_owner'] = lease_manager.worker_id
+            logger.info("Coordinating shards as worker {0}".format(lease_manager.worker_id))
+
+        def list_ready_shards():
+            refreshed = self.refresh_shards(options)
+            if lease_manager is not None:
+                lease_manager.sync_shards([shardinfo['ShardId'] for shardinfo in refreshed])
+            return self.ready_shards(refreshed)
+
+        engine = AsyncConsumerEngine(self.stream_name,
+                                     make_responder=self.make_responder,
+                                     list_ready_shards=list_ready_shards,
+                                     worker_count=getattr(settings, "KINESIS_ASYNC_WORKERS", 8),
+                                     io_worker_count=getattr(settings, "KINESIS_ASYNC_IO_WORKERS", 4),
+                                     reshard_check_interval=getattr(settings, "KINESIS_RESHARD_CHECK_INTERVAL", 300),
+                                     lease_manager=lease_manager,
+                                     #renew well within the lease duration, as the threaded engine does
+                                     lease_interval=lease_duration/3.0)
+        print("Started up and processing with the asyncio engine. Hit CTRL-C to stop.", flush=True)
+        engine.run(self.ready_shards(shardlist))
+        print("Stopped cleanly", flush=True)
@@ -0,0 +1,53 @@
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ShardMetrics(object):
+    """
+    Simple thread-safe registry of per-shard gauges and counters.  The responder threads update this as they go and
+    the base command logs a summary out periodically.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}
+
+    def _shard_values(self, stream_name, shard_id):
+        key = (stream_name, shard_id)
+        if key not in self._values:
+            self._values[key] = {}
+        return self._values[key]
+
+    def set(self, stream_name, shard_id, name, value):
+        with self._lock:
+            self._shard_values(stream_name, shard_id)[name] = value
+
+    def increment(self, stream_name, shard_id, name, amount=1):
+        with self._lock:
+            values = self._shard_values(stream_name, shard_id)
+            values[name] = values.get(name, 0) + amount
+
+    def get(self, stream_name, shard_id, name, default=None):
+        with self._lock:
+            return self._values.get((stream_name, shard_id), {}).get(name, default)
+
+    def snapshot(self):
+        """
+        Returns a copy of everything that has been recorded
+        :return: dictionary of (stream_name, shard_id) -> dictionary of metric name -> value
+        """
+        with self._lock:
+            return {key: dict(values) for key, values in self._values.items()}
+
+    def log_summary(self):
+        for (stream_name, shard_id), values in sorted(self.snapshot().items()):
+            logger.info("{0}/{1}: {2}".format(stream_name, shard_id,
+                                              ", ".join(["{0}={1}".format(k, v) for k, v in sorted(values.items())])))
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+
+shard_metrics = ShardMetrics()
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+from django.db.models import Max
+from datetime import datetime
+
+
+def populate_checkpoints(apps, schema_editor):
+    """
+    Fill in ShardCheckpoint from the most recent KinesisTracker entry for every shard. Entries are written in order, so
+    the most recent one is the one with the highest id; the database picks those out in a single query.
+    """
+    KinesisTracker = apps.get_model('kinesisresponder', 'KinesisTracker')
+    ShardCheckpoint = apps.get_model('kinesisresponder', 'ShardCheckpoint')
+
+    latest_ids = KinesisTracker.objects.values('stream_name', 'shard_id').annotate(latest_id=Max('id')).values('latest_id')
+    latest = KinesisTracker.objects.filter(id__in=latest_ids).values_list('stream_name', 'shard_id', 'sequence_number')
+
+    now = datetime.now()
+    ShardCheckpoint.objects.bulk_create([
+        ShardCheckpoint(stream_name=stream_name, shard_id=shard_id, sequence_number=sequence_number, updated=now)
+        for stream_name, shard_id, sequence_number in latest
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kinesisresponder', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stream_name', models.CharField(max_length=255)),
+                ('shard_id', models.CharField(max_length=255)),
+                ('sequence_number', models.CharField(max_length=255, null=True)),
+                ('updated', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('stream_name', 'shard_id')},
+            },
+        ),
+        migrations.RunPython(populate_checkpoints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kinesisresponder', '0002_shardcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stream_name', models.CharField(max_length=255)),
+                ('shard_id', models.CharField(max_length=255)),
+                ('owner', models.CharField(db_index=True, max_length=255, null=True)),
+                ('lease_expiry', models.DateTimeField(null=True)),
+                ('lease_counter', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('stream_name', 'shard_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kinesisresponder', '0003_shardlease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shardcheckpoint',
+            name='finished',
+            field=models.BooleanField(default=False),
+        ),
+    ]
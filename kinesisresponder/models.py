@@ -18,3 +18,34 @@ class KinesisTracker(Model):
     exception_trace = CharField(max_length=32768, null=True)
     created = DateTimeField()
     updated = DateTimeField()
+
+
+class ShardCheckpoint(Model):
+    """
+    One row per shard, holding the sequence number that we should resume processing after.  This is updated in place
+    so that looking up where to start from does not depend on how much history is in KinesisTracker.
+    """
+    stream_name = CharField(max_length=255)
+    shard_id = CharField(max_length=255)
+    sequence_number = CharField(max_length=255, null=True)
+    updated = DateTimeField()
+    finished = BooleanField(default=False)   #set once a closed shard has been read to the end
+
+    class Meta:
+        unique_together = [('stream_name', 'shard_id')]
+
+
+class ShardLease(Model):
+    """
+    Records which responder process currently owns each shard, so that several replicas can split a stream between
+    them.  The owner has to keep renewing lease_expiry; once it lapses any other replica can take the shard over.
+    lease_counter is bumped on every change so that updates can be made conditional on nobody else having got there first.
+    """
+    stream_name = CharField(max_length=255)
+    shard_id = CharField(max_length=255)
+    owner = CharField(max_length=255, null=True, db_index=True)
+    lease_expiry = DateTimeField(null=True)
+    lease_counter = BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('stream_name', 'shard_id')]
@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from threading import Condition, Semaphore
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class _WorkItem(object):
+    def __init__(self, position, key, fn, on_done):
+        self.position = position
+        self.key = key
+        self.fn = fn
+        self.on_done = on_done
+        self.done = False
+        self.queued = False
+        self.result = None
+
+
+class OrderedKeyExecutor(object):
+    """
+    Runs work on a bounded pool of threads.  Items that share a key are run one at a time, in the order that they
+    were submitted; items with different keys (or a key of None) can run in parallel.
+    Whatever order the work actually finishes in, the on_done callbacks are called strictly in submission order, and
+    only once everything before them has finished.  This means that a caller that checkpoints from on_done never moves
+    past something that is still running.
+    submit() blocks once max_in_flight items are outstanding, so a fast producer can't run away from the pool.
+    With ordered_callbacks=False each on_done is called as soon as its own item finishes instead, so that one slow
+    item doesn't hold on to the slots of everything submitted after it.
+    The callbacks are called one at a time, but outside of the executor's lock, so that slow ones (e.g. checkpoint
+    writes) don't hold up the workers or submit().
+    """
+    def __init__(self, pool_size, max_in_flight=None, thread_name_prefix="", ordered_callbacks=True):
+        self.pool_size = pool_size
+        self.ordered_callbacks = ordered_callbacks
+        self._pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix=thread_name_prefix)
+        self._slots = Semaphore(max_in_flight if max_in_flight is not None else pool_size * 2)
+        self._cond = Condition()
+        self._next_position = 0
+        self._outstanding = OrderedDict()
+        self._busy_keys = set()
+        self._waiting = {}
+        #items whose on_done is due, in the order that it should be called
+        self._completions = deque()
+        self._completing = False
+        self._failure = None
+
+    def submit(self, key, fn, on_done):
+        """
+        Queue up a piece of work
+        :param key: items with the same key are run in order, one at a time. None means "no ordering required".
+        :param fn: callable to run on the pool. Its return value is passed to on_done; if it raises then on_done is
+        given a tuple of (exception, traceback string) instead.
+        :param on_done: callable that receives the result of fn, called in submission order
+        :return: None
+        """
+        self._raise_failure()
+        self._slots.acquire()
+        with self._cond:
+            item = _WorkItem(self._next_position, key, fn, on_done)
+            self._next_position += 1
+            self._outstanding[item.position] = item
+
+            if key is not None and key in self._busy_keys:
+                self._waiting.setdefault(key, deque()).append(item)
+            else:
+                if key is not None:
+                    self._busy_keys.add(key)
+                self._pool.submit(self._run, item)
+
+    def _run(self, item):
+        try:
+            item.result = item.fn()
+        except Exception as e:
+            logger.exception("Unhandled exception in worker for key {0}".format(item.key), exc_info=e)
+            item.result = (e, traceback.format_exc())
+        finally:
+            self._finished(item)
+
+    def _finished(self, item):
+        with self._cond:
+            item.done = True
+            if item.key is not None:
+                waiting = self._waiting.get(item.key)
+                if waiting:
+                    self._pool.submit(self._run, waiting.popleft())
+                else:
+                    self._waiting.pop(item.key, None)
+                    self._busy_keys.discard(item.key)
+
+            if self.ordered_callbacks:
+                for first in self._outstanding.values():
+                    if not first.done:
+                        break
+                    if not first.queued:
+                        first.queued = True
+                        self._completions.append(first)
+            else:
+                item.queued = True
+                self._completions.append(item)
+
+            if self._completing:
+                #another thread is already calling the callbacks, and will get to these
+                return
+            self._completing = True
+        self._drain_completions()
+
+    def _drain_completions(self):
+        """
+        Calls on_done for everything that is due, in order, without holding the lock while each one runs
+        """
+        while True:
+            with self._cond:
+                if len(self._completions) == 0:
+                    self._completing = False
+                    return
+                item = self._completions.popleft()
+            self._complete(item)
+
+    def _complete(self, item):
+        failure = None
+        try:
+            if self._failure is None:
+                item.on_done(item.result)
+        except Exception as e:
+            logger.exception("Completion callback failed", exc_info=e)
+            failure = e
+        with self._cond:
+            if failure is not None:
+                self._failure = failure
+            del self._outstanding[item.position]
+            self._slots.release()
+            self._cond.notify_all()
+
+    def _raise_failure(self):
+        if self._failure is not None:
+            raise self._failure
+
+    @property
+    def in_flight(self):
+        with self._cond:
+            return len(self._outstanding)
+
+    def wait_idle(self):
+        """
+        Blocks until everything that has been submitted has finished and had its on_done called.
+        Re-raises the exception if an on_done callback failed.
+        """
+        with self._cond:
+            while len(self._outstanding) > 0:
+                self._cond.wait()
+        self._raise_failure()
+
+    def shutdown(self):
+        try:
+            self.wait_idle()
+        finally:
+            self._pool.shutdown(wait=True)
@@ -0,0 +1,67 @@
+from .metrics import shard_metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+#GetRecords will not return more than this many records in one call
+KINESIS_MAX_RECORDS_LIMIT = 10000
+
+
+class PollController(object):
+    """
+    Decides how many records to ask for in each get_records call and how long to wait when the shard is idle.
+    While the shard is behind and we are getting full batches, the limit doubles (up to max_limit) so that we catch up
+    quickly; once we are caught up it halves again back down to min_limit.
+    When a poll comes back empty and we are caught up we back off by doubling the idle delay up to max_idle_delay, but
+    as soon as something arrives we drop straight back to min_idle_delay so that bursts of traffic are picked up fast.
+    Every decision is recorded against the shard in shard_metrics.
+    """
+    def __init__(self, stream_name, shard_id, min_limit=10, max_limit=KINESIS_MAX_RECORDS_LIMIT, min_idle_delay=1,
+                 max_idle_delay=10, metrics=shard_metrics):
+        self.stream_name = stream_name
+        self.shard_id = shard_id
+        self.min_limit = min_limit
+        self.max_limit = min(max_limit, KINESIS_MAX_RECORDS_LIMIT)
+        self.min_idle_delay = min_idle_delay
+        self.max_idle_delay = max_idle_delay
+        self.metrics = metrics
+
+        self.limit = min_limit
+        self.idle_delay = max_idle_delay
+        self._next_delay = 0
+
+    def record_batch(self, num_records, millis_behind_latest):
+        """
+        Update our state from the result of a get_records call
+        :param num_records: number of records that were returned
+        :param millis_behind_latest: MillisBehindLatest value that was returned
+        :return: None
+        """
+        if millis_behind_latest > 0 and num_records >= self.limit and self.limit < self.max_limit:
+            self.limit = min(self.limit * 2, self.max_limit)
+            self._count_decision("limit_grow")
+        elif millis_behind_latest == 0 and self.limit > self.min_limit:
+            self.limit = max(self.limit // 2, self.min_limit)
+            self._count_decision("limit_shrink")
+
+        if num_records == 0 and millis_behind_latest == 0:
+            self._next_delay = self.idle_delay
+            self.idle_delay = min(self.idle_delay * 2, self.max_idle_delay)
+            self._count_decision("idle_sleep")
+        else:
+            self._next_delay = 0
+            self.idle_delay = self.min_idle_delay
+
+        self.metrics.set(self.stream_name, self.shard_id, "millis_behind_latest", millis_behind_latest)
+        self.metrics.set(self.stream_name, self.shard_id, "last_batch_size", num_records)
+        self.metrics.set(self.stream_name, self.shard_id, "batch_limit", self.limit)
+        self.metrics.set(self.stream_name, self.shard_id, "idle_delay", self._next_delay)
+
+    def next_delay(self):
+        """
+        Returns the number of seconds to wait before making the next get_records call
+        """
+        return self._next_delay
+
+    def _count_decision(self, name):
+        self.metrics.increment(self.stream_name, self.shard_id, name)
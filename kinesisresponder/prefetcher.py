@@ -0,0 +1,169 @@
+from boto import kinesis
+import boto.exception
+from .metrics import shard_metrics
+from .record_decoder import decode_records
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+from time import monotonic
+import logging
+
+logger = logging.getLogger(__name__)
+
+AFTER_SEQUENCE_NUMBER = 'AFTER_SEQUENCE_NUMBER'
+
+#shard iterators are only valid for five minutes, so renew them a bit before that
+ITERATOR_MAX_AGE = 270
+
+
+class ShardEnd(object):
+    """
+    Put on the queue when the shard has been closed and there is nothing more to read
+    """
+    pass
+
+
+class FetchFailed(object):
+    """
+    Put on the queue when the fetch thread dies, so that the exception is raised in the processing thread
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class RecordPrefetcher(Thread):
+    """
+    Reads ahead from a shard on its own thread, so that the next get_records call is already in flight while the
+    responder is processing the current batch.  Up to buffer_size batches are held; after that we wait for the
+    responder to catch up.
+    The prefetcher owns the shard iterator.  It keeps track of the last record that it fetched, so if the iterator
+    expires (or gets close to expiring while we are waiting for a slow batch) it can get a new one just after that
+    record without having to stop and consult the checkpoint table.
+    """
+    def __init__(self, responder, start_position, buffer_size=1, metrics=shard_metrics, **kwargs):
+        """
+        Initialise
+        :param responder: the KinesisResponder that we are fetching for. Its connection, poll_controller,
+        read_scheduler and refresh_access_credentials are used from this thread.
+        :param start_position: tuple of (iterator type, sequence number, timestamp) to start reading at
+        :param buffer_size: maximum number of fetched batches to hold that have not been processed yet
+        """
+        super(RecordPrefetcher, self).__init__(name="{0}-prefetch".format(responder.shard_id), **kwargs)
+        self.daemon = True
+        self.responder = responder
+        self.metrics = metrics
+        self._position = start_position
+        self._queue = Queue(maxsize=max(buffer_size, 1))
+        self._stop_requested = Event()
+        self._iterator = None
+        self._iterator_time = None
+
+    def request_stop(self):
+        self._stop_requested.set()
+
+    def _count(self, name):
+        self.metrics.increment(self.responder.stream_name, self.responder.shard_id, name)
+
+    def _renew_iterator(self):
+        from .kinesis_responder import get_shard_iterator
+        iterator_type, sequence_number, timestamp = self._position
+        self._iterator = get_shard_iterator(self.responder._conn, self.responder.stream_name, self.responder.shard_id,
+                                            iterator_type, sequence_number=sequence_number, timestamp=timestamp)
+        self._iterator_time = monotonic()
+
+    def _put(self, item):
+        """
+        Waits for room in the buffer, renewing the iterator if it gets stale while we wait
+        :return: False if we were asked to stop while waiting
+        """
+        while not self._stop_requested.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except Full:
+                if self._iterator is not None and monotonic() - self._iterator_time > ITERATOR_MAX_AGE:
+                    logger.debug("{0}: renewing iterator while waiting for the responder".format(self.responder.shard_id))
+                    self._renew_iterator()
+                    self._count("iterator_renewed")
+        return False
+
+    def run(self):
+        try:
+            self.fetch_loop()
+        except Exception as e:
+            logger.exception("Fetching from shard {0} failed".format(self.responder.shard_id), exc_info=e)
+            self._queue.put(FetchFailed(e))
+
+    def fetch_loop(self):
+        #boto connections should not be shared between threads, so get one for this thread
+        self.responder.refresh_access_credentials()
+        self._renew_iterator()
+        poll_controller = self.responder.poll_controller
+        sleep_delay = 1
+        read_scheduler = self.responder.read_scheduler
+        shard_id = self.responder.shard_id
+        while self._iterator is not None and not self._stop_requested.is_set():
+            if not read_scheduler.before_read(shard_id, stop_event=self._stop_requested):
+                break
+            try:
+                #ask for the raw data, because boto's decoding assumes it is UTF-8 text
+                result = self.responder._conn.get_records(self._iterator, limit=poll_controller.limit, b64_decode=False)
+                read_scheduler.after_read(shard_id, result['Records'])
+                if sleep_delay>1:
+                    sleep_delay /= 2
+            except kinesis.exceptions.ExpiredIteratorException as e:
+                logger.warning("Received expired iterator exception, getting new iterator: {0}".format(str(e)))
+                self._count("iterator_expired")
+                self._renew_iterator()
+                continue
+            except kinesis.exceptions.ProvisionedThroughputExceededException:
+                read_scheduler.record_throttled(shard_id)
+                self._stop_requested.wait(sleep_delay)
+                sleep_delay*=2
+                continue
+            except boto.exception.JSONResponseError as e:
+                if e.error_code=='ExpiredTokenException':
+                    logger.warning("Access credentials expired, refreshing...")
+                    self.responder.refresh_access_credentials(expired=True)
+                continue
+
+            self._iterator = result['NextShardIterator']
+            self._iterator_time = monotonic()
+            if len(result['Records']) > 0:
+                self._position = (AFTER_SEQUENCE_NUMBER, result['Records'][-1]['SequenceNumber'], None)
+            poll_controller.record_batch(len(result['Records']), result['MillisBehindLatest'])
+            result['Records'] = decode_records(result['Records'], on_error=self._count)
+
+            if len(result['Records']) > 0 and not self._put(result):
+                return
+
+            delay = poll_controller.next_delay()
+            if delay>0 and self._iterator is not None:
+                self._stop_requested.wait(delay)
+
+        if self._iterator is None:
+            self._put(ShardEnd())
+
+    def next_batch(self, stop_event, on_idle=None):
+        """
+        Gets the next batch of records, waiting for it to arrive if necessary
+        :param stop_event: threading.Event that stops the wait when it is set
+        :param on_idle: optional callable that is called every second or so while there is nothing to process
+        :return: get_records response dictionary, or None if the shard has ended or we were asked to stop
+        """
+        waited = False
+        while not stop_event.is_set():
+            try:
+                item = self._queue.get(timeout=1)
+            except Empty:
+                waited = True
+                if on_idle is not None:
+                    on_idle()
+                continue
+            if waited:
+                self._count("prefetch_wait")
+            if isinstance(item, ShardEnd):
+                return None
+            if isinstance(item, FetchFailed):
+                raise item.exception
+            return item
+        return None
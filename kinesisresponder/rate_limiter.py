@@ -0,0 +1,80 @@
+from threading import Condition
+from time import monotonic
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket.  Tokens are added at `rate` per second up to `capacity`, and acquire() blocks until there
+    are enough for the caller.  One bucket can be shared between several threads to put a single limit on all of them.
+    """
+    def __init__(self, rate, capacity=None, clock=monotonic):
+        if rate <= 0:
+            raise ValueError("Token bucket rate must be positive, got {0}".format(rate))
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._last = clock()
+        self._cond = Condition()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, amount=1):
+        """
+        Takes tokens if they are available right now
+        :param amount: number of tokens wanted
+        :return: True if the tokens were taken, False if the caller would have had to wait
+        """
+        with self._cond:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return True
+            return False
+
+    def time_until(self, amount=1):
+        """
+        Returns how long it would be before acquire(amount) could go ahead, without taking anything
+        :return: number of seconds, 0 if the tokens are available now
+        """
+        with self._cond:
+            self._refill()
+            return max(0.0, (min(amount, self.capacity) - self._tokens) / self.rate)
+
+    def debit(self, amount):
+        """
+        Takes tokens without waiting, even if that leaves the bucket in debt.  Use this to account for usage that is
+        only known after the fact; later callers of acquire() wait until the debt has been paid off.
+        """
+        with self._cond:
+            self._refill()
+            self._tokens -= amount
+
+    def acquire(self, amount=1, stop_event=None):
+        """
+        Blocks until the given number of tokens can be taken.  Requests for more than the capacity are allowed, they
+        just wait until the bucket is full and then drive it negative so that later callers wait for it to refill.
+        :param amount: number of tokens wanted
+        :param stop_event: optional threading.Event; if it is set while we are waiting we give up
+        :return: number of seconds spent waiting, or None if we gave up because stop_event was set
+        """
+        waited = 0.0
+        with self._cond:
+            while True:
+                self._refill()
+                needed = min(amount, self.capacity)
+                if self._tokens >= needed:
+                    self._tokens -= amount
+                    return waited
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                delay = (needed - self._tokens) / self.rate
+                started = self._clock()
+                self._cond.wait(delay)
+                waited += self._clock() - started
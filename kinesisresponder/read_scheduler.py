@@ -0,0 +1,116 @@
+from django.conf import settings
+from .rate_limiter import TokenBucket
+from .metrics import shard_metrics
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+
+#Kinesis limits for reads from a single shard
+SHARD_READS_PER_SECOND = 5
+SHARD_READ_BYTES_PER_SECOND = 2*1024*1024
+
+
+class ReadScheduler(object):
+    """
+    Shared between all of the threads reading from a stream, this paces get_records calls so that we stay inside the
+    Kinesis read limits instead of finding them by being throttled.  Each shard gets buckets for calls per second and
+    bytes per second, and there can be stream-wide buckets as well.  The call buckets only hold one token, so calls are
+    spread out evenly rather than going out in bursts.
+    Reads that had to wait are counted as throttle_avoided, and ProvisionedThroughputExceeded errors that still got
+    through are counted as throttle_hit.
+    """
+    def __init__(self, stream_name, shard_reads_per_second=SHARD_READS_PER_SECOND,
+                 shard_bytes_per_second=SHARD_READ_BYTES_PER_SECOND, stream_reads_per_second=None,
+                 stream_bytes_per_second=None, metrics=shard_metrics):
+        self.stream_name = stream_name
+        self.shard_reads_per_second = shard_reads_per_second
+        self.shard_bytes_per_second = shard_bytes_per_second
+        self.metrics = metrics
+        self._stream_reads = TokenBucket(stream_reads_per_second, capacity=1) if stream_reads_per_second else None
+        self._stream_bytes = TokenBucket(stream_bytes_per_second) if stream_bytes_per_second else None
+        self._shard_buckets = {}
+        self._lock = Lock()
+
+    def _buckets_for(self, shard_id):
+        with self._lock:
+            if shard_id not in self._shard_buckets:
+                self._shard_buckets[shard_id] = (TokenBucket(self.shard_reads_per_second, capacity=1),
+                                                 TokenBucket(self.shard_bytes_per_second))
+            return self._shard_buckets[shard_id]
+
+    def before_read(self, shard_id, stop_event=None):
+        """
+        Blocks until the shard is allowed to make another get_records call
+        :param shard_id: shard that is about to be read
+        :param stop_event: optional threading.Event that cuts the wait short
+        :return: False if stop_event was set while we were waiting, otherwise True
+        """
+        reads, read_bytes = self._buckets_for(shard_id)
+        waited = 0.0
+        for bucket, amount in ((read_bytes, 0), (self._stream_bytes, 0), (reads, 1), (self._stream_reads, 1)):
+            if bucket is None:
+                continue
+            result = bucket.acquire(amount, stop_event=stop_event)
+            if result is None:
+                return False
+            waited += result
+        if waited > 0:
+            self.metrics.increment(self.stream_name, shard_id, "throttle_avoided")
+            self.metrics.increment(self.stream_name, shard_id, "throttle_wait_seconds", waited)
+        return True
+
+    def read_delay(self, shard_id):
+        """
+        Non-blocking version of before_read, for callers that do their own waiting such as the asyncio engine.
+        :param shard_id: shard that is about to be read
+        :return: 0 if the read can go ahead now, in which case it has been accounted for; otherwise the number of
+        seconds to wait before asking again
+        """
+        reads, read_bytes = self._buckets_for(shard_id)
+        buckets = [(bucket, amount) for bucket, amount in ((read_bytes, 0), (self._stream_bytes, 0), (reads, 1), (self._stream_reads, 1))
+                   if bucket is not None]
+        delay = max([bucket.time_until(amount) for bucket, amount in buckets])
+        if delay > 0:
+            return delay
+        for bucket, amount in buckets:
+            if amount > 0:
+                bucket.debit(amount)
+        return 0
+
+    def after_read(self, shard_id, records):
+        """
+        Accounts for the data that a get_records call returned
+        :param shard_id: shard that was read
+        :param records: the Records list from the response
+        """
+        size = sum([len(rec.get('Data', '')) + len(rec.get('PartitionKey', '')) for rec in records])
+        self._buckets_for(shard_id)[1].debit(size)
+        if self._stream_bytes is not None:
+            self._stream_bytes.debit(size)
+
+    def record_throttled(self, shard_id):
+        """
+        Call this when a read was throttled by Kinesis anyway
+        """
+        self.metrics.increment(self.stream_name, shard_id, "throttle_hit")
+
+
+_schedulers = {}
+_schedulers_lock = Lock()
+
+
+def get_read_scheduler(stream_name):
+    """
+    Returns the ReadScheduler shared by everything reading from the given stream in this process, configured from
+    the KINESIS_*_PER_SECOND settings
+    """
+    with _schedulers_lock:
+        if stream_name not in _schedulers:
+            _schedulers[stream_name] = ReadScheduler(
+                stream_name,
+                shard_reads_per_second=getattr(settings, "KINESIS_SHARD_READS_PER_SECOND", SHARD_READS_PER_SECOND),
+                shard_bytes_per_second=getattr(settings, "KINESIS_SHARD_READ_BYTES_PER_SECOND", SHARD_READ_BYTES_PER_SECOND),
+                stream_reads_per_second=getattr(settings, "KINESIS_STREAM_READS_PER_SECOND", None),
+                stream_bytes_per_second=getattr(settings, "KINESIS_STREAM_READ_BYTES_PER_SECOND", None))
+        return _schedulers[stream_name]
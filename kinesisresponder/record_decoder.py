@@ -0,0 +1,157 @@
+import base64
+import binascii
+import gzip
+import hashlib
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+#records written by the Kinesis Producer Library with aggregation turned on start with these bytes
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+KPL_DIGEST_SIZE = 16
+GZIP_MAGIC = b'\x1f\x8b'
+
+#protobuf wire types
+WIRE_VARINT = 0
+WIRE_64BIT = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_32BIT = 5
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("Truncated varint")
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _protobuf_fields(buf):
+    """
+    Yields (field number, value) for each field in a protobuf message. Varints are returned as integers and
+    length-delimited fields as bytes; fixed-width fields are skipped since the KPL format doesn't use them.
+    """
+    pos = 0
+    while pos < len(buf):
+        tag, pos = _read_varint(buf, pos)
+        field_number, wire_type = tag >> 3, tag & 0x07
+        if wire_type == WIRE_VARINT:
+            value, pos = _read_varint(buf, pos)
+            yield field_number, value
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = _read_varint(buf, pos)
+            if pos + length > len(buf):
+                raise ValueError("Truncated field {0}".format(field_number))
+            yield field_number, buf[pos:pos+length]
+            pos += length
+        elif wire_type == WIRE_64BIT:
+            pos += 8
+        elif wire_type == WIRE_32BIT:
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {0}".format(wire_type))
+
+
+def deaggregate(data):
+    """
+    Unpacks a KPL aggregated record:
+      magic bytes + AggregatedRecord protobuf + MD5 digest of the protobuf
+    where AggregatedRecord is {repeated string partition_key_table = 1; repeated string explicit_hash_key_table = 2;
+    repeated Record records = 3;} and Record is {uint64 partition_key_index = 1; uint64 explicit_hash_key_index = 2;
+    bytes data = 3; repeated Tag tags = 4;}
+    :param data: raw record bytes
+    :return: list of (partition key, data bytes) tuples, or None if this is not a valid aggregated record
+    """
+    if not data.startswith(KPL_MAGIC) or len(data) < len(KPL_MAGIC) + KPL_DIGEST_SIZE:
+        return None
+    message = data[len(KPL_MAGIC):-KPL_DIGEST_SIZE]
+    if hashlib.md5(message).digest() != data[-KPL_DIGEST_SIZE:]:
+        logger.warning("Record has the KPL magic number but its digest does not match, treating it as a normal record")
+        return None
+
+    partition_keys = []
+    records = []
+    for field_number, value in _protobuf_fields(message):
+        if field_number == 1:
+            partition_keys.append(value.decode("UTF-8"))
+        elif field_number == 3:
+            partition_key_index = 0
+            record_data = b''
+            for sub_field, sub_value in _protobuf_fields(value):
+                if sub_field == 1:
+                    partition_key_index = sub_value
+                elif sub_field == 3:
+                    record_data = sub_value
+            records.append((partition_key_index, record_data))
+
+    return [(partition_keys[index] if index < len(partition_keys) else None, record_data) for index, record_data in records]
+
+
+def decode_payload(data, on_error=None):
+    """
+    Turns the bytes of a single message into a string, un-gzipping them first if necessary.  If the gzip data is corrupt
+    or truncated then the raw bytes are passed on, for process() to reject.
+    :param on_error: optional callable that is passed the name of the error, for counting
+    """
+    if data.startswith(GZIP_MAGIC):
+        try:
+            data = gzip.decompress(data)
+        except (OSError, EOFError, zlib.error) as e:
+            logger.error("Could not un-gzip record, passing it on as it is: {0}".format(e))
+            if on_error is not None:
+                on_error("decode_error_gzip")
+    #anything that isn't valid UTF-8 is left for process() to reject, rather than stopping the whole shard here
+    return data.decode("UTF-8", errors="replace")
+
+
+def decode_records(records, base64_encoded=True, on_error=None):
+    """
+    Expands a Records list from get_records into the messages that it holds.  Aggregated records become one entry per
+    sub-record, with the sub-record's PartitionKey, a SubSequenceNumber and LastSubRecord set on the last one; the
+    checkpoint should only move on to a record's SequenceNumber once its last sub-record is done.
+    A record that can't be decoded is logged and passed on as it is, rather than raising: an exception here would stop
+    the shard, and it would stop again on the same record every time it was restarted.
+    :param records: Records list from get_records
+    :param base64_encoded: True if get_records was called with b64_decode=False, so Data is still base64
+    :param on_error: optional callable that is passed the name of each decoding error, for counting
+    :return: list of record dictionaries whose Data is a string
+    """
+    def report(name, rec, e):
+        logger.error("Could not decode record {0}, passing it on as it is: {1}".format(rec.get('SequenceNumber'), e))
+        if on_error is not None:
+            on_error(name)
+
+    result = []
+    for rec in records:
+        data = rec['Data']
+        if base64_encoded:
+            try:
+                data = base64.b64decode(data)
+            except (binascii.Error, ValueError) as e:
+                report("decode_error_base64", rec, e)
+        if isinstance(data, str):
+            data = data.encode("UTF-8")
+
+        try:
+            sub_records = deaggregate(data)
+        except ValueError as e:
+            #this includes UnicodeDecodeError from a partition key
+            report("decode_error_aggregate", rec, e)
+            sub_records = None
+        if sub_records is None:
+            result.append(dict(rec, Data=decode_payload(data, on_error=on_error)))
+            continue
+        for n, (partition_key, sub_data) in enumerate(sub_records):
+            result.append(dict(rec,
+                               Data=decode_payload(sub_data, on_error=on_error),
+                               PartitionKey=partition_key if partition_key is not None else rec.get('PartitionKey'),
+                               SubSequenceNumber=n,
+                               LastSubRecord=(n == len(sub_records)-1)))
+    return result
@@ -0,0 +1,150 @@
+from boto.kinesis import exceptions
+import boto.exception
+from .kinesis_responder import get_shard_iterator, AFTER_SEQUENCE_NUMBER
+from .credentials import get_credential_provider
+from .metrics import ShardMetrics
+from .record_decoder import decode_records
+from .read_scheduler import get_read_scheduler
+from threading import Thread, Event
+import calendar
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class ShardReplayer(Thread):
+    """
+    Reads a window of one shard again and passes every record to a handler, for reprocessing messages after a fix.
+    Unlike KinesisResponder this never reads or writes ShardCheckpoint or KinesisTracker, so a replay can run alongside
+    the live responder without moving its checkpoints.
+    The replay stops at the first record that arrived after end_timestamp, once we have caught up with the tip of the
+    shard, or when the shard is closed.
+    The handler is called as handler(rec) and returns a string describing what happened to the record (or None), which
+    is counted in the stats against the shard.  If it raises, the record is counted as an error and we carry on.
+    """
+    def __init__(self, role_name, session_name, stream_name, shard_id, handler, iterator_type, sequence_number=None,
+                 timestamp=None, end_timestamp=None, rate_limiter=None, stats=None, limit=1000,
+                 aws_access_key_id=None, aws_secret_access_key=None, **kwargs):
+        """
+        Initialise
+        :param role_name: ARN of role to assume
+        :param session_name: Descriptive name for the role session
+        :param stream_name: The name, not ARN, of the stream
+        :param shard_id: Shard to replay
+        :param handler: callable that is given each record dictionary from get_records
+        :param iterator_type: AT_TIMESTAMP, AT_SEQUENCE_NUMBER or TRIM_HORIZON
+        :param sequence_number: sequence number to start at, for AT_SEQUENCE_NUMBER
+        :param timestamp: UTC datetime to start at, for AT_TIMESTAMP
+        :param end_timestamp: optional UTC datetime, records that arrived after this are not replayed
+        :param rate_limiter: optional TokenBucket, one token is taken for each record. Share it between replayers to
+        limit the whole replay.
+        :param stats: ShardMetrics instance to count results in
+        :param limit: number of records to ask for in each get_records call
+        """
+        super(ShardReplayer, self).__init__(**kwargs)
+        self.role_name = role_name
+        self.session_name = session_name
+        self.stream_name = stream_name
+        self.shard_id = shard_id
+        self.handler = handler
+        self.iterator_type = iterator_type
+        self.sequence_number = sequence_number
+        self.timestamp = timestamp
+        self.end_epoch = calendar.timegm(end_timestamp.utctimetuple()) + end_timestamp.microsecond/1000000.0 \
+            if end_timestamp is not None else None
+        self.rate_limiter = rate_limiter
+        self.stats = stats if stats is not None else ShardMetrics()
+        self.limit = limit
+        self._provider = get_credential_provider(role_name, session_name, aws_access_key_id=aws_access_key_id,
+                                                 aws_secret_access_key=aws_secret_access_key)
+        self._conn = None
+        self._stop_requested = Event()
+
+    def request_stop(self):
+        self._stop_requested.set()
+
+    @property
+    def stop_requested(self):
+        return self._stop_requested.is_set()
+
+    def count(self, name):
+        self.stats.increment(self.stream_name, self.shard_id, name)
+
+    def replay_record(self, rec):
+        """
+        Passes one record to the handler and counts the outcome
+        :return: None
+        """
+        try:
+            outcome = self.handler(rec)
+            self.count(outcome if outcome is not None else "processed")
+        except Exception:
+            logger.error("{0}: replay of record {1} failed: {2}".format(self.shard_id, rec.get('SequenceNumber'),
+                                                                        traceback.format_exc()))
+            self.count("error")
+
+    def run(self):
+        try:
+            self.mainloop()
+        except Exception as e:
+            logger.exception("Replay of shard {0} failed".format(self.shard_id), exc_info=e)
+            self.count("failed")
+
+    def new_iterator(self, last_sequence_number=None):
+        """
+        Gets an iterator for the shard, following on from the last record that we replayed or at the start of the
+        replay if there hasn't been one yet
+        """
+        if last_sequence_number is not None:
+            return get_shard_iterator(self._conn, self.stream_name, self.shard_id, AFTER_SEQUENCE_NUMBER,
+                                      sequence_number=last_sequence_number)
+        return get_shard_iterator(self._conn, self.stream_name, self.shard_id, self.iterator_type,
+                                  sequence_number=self.sequence_number, timestamp=self.timestamp)
+
+    def mainloop(self):
+        self._conn = self._provider.connection('kinesis')
+        iterator = self.new_iterator()
+        last_sequence_number = None
+        sleep_delay = 1
+        read_scheduler = get_read_scheduler(self.stream_name)
+        while iterator is not None and not self.stop_requested:
+            if not read_scheduler.before_read(self.shard_id, stop_event=self._stop_requested):
+                break
+            try:
+                result = self._conn.get_records(iterator, limit=self.limit, b64_decode=False)
+                read_scheduler.after_read(self.shard_id, result['Records'])
+                sleep_delay = 1
+            except exceptions.ExpiredIteratorException as e:
+                #a slow handler or a low --rate can easily take longer than the iterator lasts
+                logger.warning("{0}: iterator expired, getting a new one: {1}".format(self.shard_id, e))
+                self.count("iterator_expired")
+                iterator = self.new_iterator(last_sequence_number)
+                continue
+            except exceptions.ProvisionedThroughputExceededException:
+                self.count("throttled")
+                self._stop_requested.wait(sleep_delay)
+                sleep_delay = min(sleep_delay*2, 30)
+                continue
+            except boto.exception.JSONResponseError as e:
+                if e.error_code != 'ExpiredTokenException':
+                    raise
+                self._provider.expire_connection('kinesis')
+                self._conn = self._provider.connection('kinesis')
+                continue
+
+            for rec in decode_records(result['Records']):
+                if self.end_epoch is not None and rec['ApproximateArrivalTimestamp'] > self.end_epoch:
+                    logger.info("{0}: reached the end of the replay window".format(self.shard_id))
+                    return
+                if self.rate_limiter is not None and self.rate_limiter.acquire(stop_event=self._stop_requested) is None:
+                    return
+                self.replay_record(rec)
+                last_sequence_number = rec['SequenceNumber']
+                self.stats.set(self.stream_name, self.shard_id, "last_sequence_number", last_sequence_number)
+
+            if len(result['Records']) == 0 and result.get('MillisBehindLatest', 0) == 0:
+                logger.info("{0}: caught up with the tip of the shard".format(self.shard_id))
+                return
+            iterator = result.get('NextShardIterator')
+        logger.info("{0}: replay finished".format(self.shard_id))
@@ -0,0 +1,135 @@
+import django.test
+from mock import MagicMock, patch
+from threading import Timer, current_thread
+import base64
+import json
+
+
+class TestAsyncConsumerEngine(django.test.TransactionTestCase):
+    @staticmethod
+    def make_records(first, count):
+        return [{
+            'SequenceNumber': str(n),
+            'PartitionKey': 'key',
+            'Data': base64.b64encode(json.dumps({"n": n}).encode("UTF-8")).decode("ASCII"),
+            'ApproximateArrivalTimestamp': 1600000000
+        } for n in range(first, first+count)]
+
+    def make_engine(self, conn, processed, list_ready_shards, built=None, **kwargs):
+        from kinesisresponder.async_engine import AsyncConsumerEngine
+        from kinesisresponder.kinesis_responder import KinesisResponder
+        from kinesisresponder.metrics import ShardMetrics
+
+        def make_responder(shardinfo):
+            #this runs on several I/O threads at once, so refresh_access_credentials is patched around engine.run
+            r = KinesisResponder("fake role", "fake session", "teststream", shardinfo['ShardId'])
+            r.process = MagicMock(side_effect=lambda record, arrival: processed.append((shardinfo['ShardId'], record)))
+            if built is not None:
+                built.append((r, current_thread().name))
+            return r
+
+        #one worker, because sqlite's in-memory test database can't take writes from two connections at once
+        return AsyncConsumerEngine("teststream", make_responder, list_ready_shards, worker_count=1, io_worker_count=2,
+                                   reshard_check_interval=60, metrics=ShardMetrics(), **kwargs)
+
+    def test_run_to_shard_end(self):
+        """
+        AsyncConsumerEngine should process every shard from one loop, checkpoint them and pick up newly ready shards
+        once others have ended
+        :return:
+        """
+        from kinesisresponder.models import ShardCheckpoint
+
+        def get_records(iterator, limit=None, b64_decode=True):
+            shard_id, n = iterator.split(":")
+            n = int(n)
+            if n < 2:
+                return {'Records': self.make_records(n*10, 3), 'MillisBehindLatest': 1000, 'NextShardIterator': "{0}:{1}".format(shard_id, n+1)}
+            return {'Records': [], 'MillisBehindLatest': 0, 'NextShardIterator': None}
+
+        conn = MagicMock()
+        conn.get_shard_iterator = MagicMock(side_effect=lambda stream, shard_id, iterator_type, **kwargs: {'ShardIterator': shard_id + ":0"})
+        conn.get_records = MagicMock(side_effect=get_records)
+        provider = MagicMock()
+        provider.connection = MagicMock(return_value=conn)
+        processed = []
+
+        def list_ready_shards():
+            if "shard-0002" in engine.ended_shards:
+                engine.stop()
+                return []
+            return [{'ShardId': 'shard-0002'}]
+
+        engine = self.make_engine(conn, processed, list_ready_shards)
+        with patch("kinesisresponder.async_engine.get_credential_provider", return_value=provider), \
+                patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            engine.run([{'ShardId': 'shard-0000'}, {'ShardId': 'shard-0001'}])
+
+        self.assertEqual(engine.ended_shards, {'shard-0000', 'shard-0001', 'shard-0002'})
+        for shard_id in ('shard-0000', 'shard-0001', 'shard-0002'):
+            self.assertEqual([record for s, record in processed if s == shard_id],
+                             [json.dumps({"n": n}) for n in (0, 1, 2, 10, 11, 12)])
+            checkpoint = ShardCheckpoint.objects.get(stream_name="teststream", shard_id=shard_id)
+            self.assertEqual(checkpoint.sequence_number, "12")
+            self.assertTrue(checkpoint.finished)
+
+    def test_graceful_stop(self):
+        """
+        stop() should bring every shard to a halt without marking it as ended
+        :return:
+        """
+        from kinesisresponder.models import ShardCheckpoint
+
+        conn = MagicMock()
+        conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'some-iterator'})
+        conn.get_records = MagicMock(return_value={'Records': [], 'MillisBehindLatest': 0, 'NextShardIterator': 'some-iterator'})
+        provider = MagicMock()
+        provider.connection = MagicMock(return_value=conn)
+        processed = []
+
+        engine = self.make_engine(conn, processed, lambda: [])
+        Timer(0.5, engine.stop).start()
+        with patch("kinesisresponder.async_engine.get_credential_provider", return_value=provider), \
+                patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            engine.run([{'ShardId': 'shard-0000'}, {'ShardId': 'shard-0001'}])
+
+        self.assertEqual(engine.ended_shards, set())
+        self.assertGreater(conn.get_records.call_count, 1)
+        self.assertEqual(ShardCheckpoint.objects.filter(finished=True).count(), 0)
+
+    def test_leases(self):
+        """
+        with a lease manager, only the shards that we hold should be run, and a shard whose lease we lose should be
+        stopped without being marked as ended. Responders should be built off the event loop's thread.
+        :return:
+        """
+        conn = MagicMock()
+        conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'some-iterator'})
+        conn.get_records = MagicMock(return_value={'Records': [], 'MillisBehindLatest': 0, 'NextShardIterator': 'some-iterator'})
+        provider = MagicMock()
+        provider.connection = MagicMock(return_value=conn)
+        built = []
+
+        lease_manager = MagicMock(held_shards={'shard-0000'})
+        renewals = []
+
+        def renew_leases():
+            renewals.append(1)
+            if len(renewals) == 3:
+                lease_manager.held_shards = set()
+            elif len(renewals) == 6:
+                engine.stop()
+
+        lease_manager.renew_leases = MagicMock(side_effect=renew_leases)
+        engine = self.make_engine(conn, [], lambda: [], built=built, lease_manager=lease_manager, lease_interval=0.1)
+        with patch("kinesisresponder.async_engine.get_credential_provider", return_value=provider), \
+                patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            engine.run([{'ShardId': 'shard-0000'}, {'ShardId': 'shard-0001'}])
+
+        self.assertEqual([r.shard_id for r, thread_name in built], ['shard-0000'])
+        responder, thread_name = built[0]
+        self.assertTrue(thread_name.startswith("kinesis-io"))
+        self.assertTrue(responder.stop_requested)
+        self.assertEqual(engine.ended_shards, set())
+        lease_manager.acquire_leases.assert_called_with(eligible_shards={'shard-0000', 'shard-0001'})
+        lease_manager.release_all.assert_called_once()
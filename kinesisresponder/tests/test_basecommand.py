@@ -0,0 +1,139 @@
+import django.test
+from mock import MagicMock
+
+
+class TestResharding(django.test.TestCase):
+    shardlist = [
+        {'ShardId': 'shardId-000'},
+        {'ShardId': 'shardId-001', 'ParentShardId': 'shardId-000'},
+        {'ShardId': 'shardId-002', 'ParentShardId': 'shardId-000'},
+        {'ShardId': 'shardId-003', 'ParentShardId': 'shardId-001', 'AdjacentParentShardId': 'shardId-002'},
+    ]
+
+    def make_command(self):
+        from kinesisresponder.management.kinesis_responder_basecommand import KinesisResponderBaseCommand
+
+        class FakeCommand(KinesisResponderBaseCommand):
+            stream_name = "teststream"
+
+            def startup_thread(self, conn, shardinfo):
+                t = MagicMock()
+                t.is_alive = MagicMock(return_value=True)
+                return t
+
+        cmd = FakeCommand()
+        cmd._credentials = None
+        return cmd
+
+    def finish(self, shard_id):
+        from kinesisresponder.checkpointer import PerRecordCheckpointer
+        PerRecordCheckpointer("teststream", shard_id).mark_shard_end()
+
+    def test_ready_shards(self):
+        """
+        ready_shards should only return shards whose parents have been read to the end
+        :return:
+        """
+        cmd = self.make_command()
+        ids = lambda shards: [s['ShardId'] for s in shards]
+
+        self.assertEqual(ids(cmd.ready_shards(self.shardlist)), ['shardId-000'])
+        self.finish('shardId-000')
+        self.assertEqual(ids(cmd.ready_shards(self.shardlist)), ['shardId-001', 'shardId-002'])
+        self.finish('shardId-001')
+        self.assertEqual(ids(cmd.ready_shards(self.shardlist)), ['shardId-002'])
+        self.finish('shardId-002')
+        self.assertEqual(ids(cmd.ready_shards(self.shardlist)), ['shardId-003'])
+        #parents that have aged out of the stream don't hold up their children
+        self.assertEqual(ids(cmd.ready_shards(self.shardlist[3:])), ['shardId-003'])
+
+    def test_check_threads(self):
+        """
+        check_threads should retire threads whose shards have ended and exit if any other thread has died
+        :return:
+        """
+        cmd = self.make_command()
+        ended = MagicMock(is_alive=MagicMock(return_value=False), shard_ended=True)
+        running = MagicMock(is_alive=MagicMock(return_value=True))
+        threads = {'shardId-000': ended, 'shardId-001': running}
+        retired = []
+
+        self.assertEqual(cmd.check_threads(threads, on_retired=retired.append), 1)
+        self.assertEqual(list(threads.keys()), ['shardId-001'])
+        self.assertEqual(retired, ['shardId-000'])
+
+        #a thread that stopped because it lost its lease is just removed
+        threads['shardId-002'] = MagicMock(is_alive=MagicMock(return_value=False), shard_ended=False, stop_requested=True)
+        self.assertEqual(cmd.check_threads(threads), 0)
+        self.assertEqual(list(threads.keys()), ['shardId-001'])
+
+        threads['shardId-002'] = MagicMock(is_alive=MagicMock(return_value=False), shard_ended=False, stop_requested=False)
+        with self.assertRaises(SystemExit):
+            cmd.check_threads(threads)
+
+    def test_make_responder(self):
+        """
+        make_responder should tell the responder which shards its shard came from
+        :return:
+        """
+        cmd = self.make_command()
+        self.assertEqual(cmd.make_responder(self.shardlist[0]).parent_shard_ids, [])
+        self.assertEqual(cmd.make_responder(self.shardlist[3]).parent_shard_ids, ['shardId-001', 'shardId-002'])
+
+    def test_lease_cycle_stops_without_waiting(self):
+        """
+        run_lease_cycle should ask the thread for a shard that we have lost to stop without waiting for it, and not start
+        the shard again until that thread has gone
+        :return:
+        """
+        cmd = self.make_command()
+        lease_manager = MagicMock(held_shards={'shardId-000'})
+        threads = {}
+        stopping = {}
+        cmd.run_lease_cycle(lease_manager, None, self.shardlist, threads, stopping)
+        old = threads['shardId-000']
+
+        lease_manager.held_shards = set()
+        cmd.run_lease_cycle(lease_manager, None, self.shardlist, threads, stopping)
+        old.request_stop.assert_called_once()
+        old.join.assert_not_called()
+        self.assertEqual(threads, {})
+        self.assertIs(stopping['shardId-000'], old)
+
+        #we get the lease back while the old thread is still busy
+        lease_manager.held_shards = {'shardId-000'}
+        cmd.run_lease_cycle(lease_manager, None, self.shardlist, threads, stopping)
+        self.assertEqual(threads, {})
+
+        old.is_alive = MagicMock(return_value=False)
+        cmd.run_lease_cycle(lease_manager, None, self.shardlist, threads, stopping)
+        self.assertEqual(stopping, {})
+        self.assertIsNot(threads['shardId-000'], old)
+
+    def test_describe_shards_paging(self):
+        """
+        describe_shards should follow HasMoreShards to get every shard
+        :return:
+        """
+        cmd = self.make_command()
+        conn = MagicMock()
+        conn.describe_stream = MagicMock(side_effect=[
+            {'StreamDescription': {'Shards': self.shardlist[0:2], 'HasMoreShards': True}},
+            {'StreamDescription': {'Shards': self.shardlist[2:], 'HasMoreShards': False}},
+        ])
+        self.assertEqual(cmd.describe_shards(conn), self.shardlist)
+        conn.describe_stream.assert_called_with("teststream", exclusive_start_shard_id='shardId-001')
+
+    def test_start_threads(self):
+        """
+        start_threads should only start shards that don't already have a thread
+        :return:
+        """
+        cmd = self.make_command()
+        threads = {}
+        cmd.start_threads(cmd.ready_shards(self.shardlist), threads)
+        self.assertEqual(list(threads.keys()), ['shardId-000'])
+        first = threads['shardId-000']
+        cmd.start_threads(cmd.ready_shards(self.shardlist), threads)
+        self.assertIs(threads['shardId-000'], first)
+        first.start.assert_called_once()
@@ -0,0 +1,278 @@
+import django.test
+from mock import MagicMock, patch
+
+
+class TestBatchedCheckpointer(django.test.TestCase):
+    @staticmethod
+    def fake_record(seqnum):
+        return {
+            'SequenceNumber': seqnum,
+            'Data': 'e30=',   #base64 of {}
+            'ApproximateArrivalTimestamp': 1600000000
+        }
+
+    def test_flush_per_batch(self):
+        """
+        BatchedCheckpointer should not write anything until the batch completes, then write everything in one go
+        :return:
+        """
+        from kinesisresponder.checkpointer import BatchedCheckpointer
+        from kinesisresponder.models import KinesisTracker
+
+        c = BatchedCheckpointer("teststream", "shard-0000")
+        c.save_checkpoint("initial")
+        for n in range(0, 5):
+            c.record_done(c.record_seen(self.fake_record(str(n)), 0))
+        self.assertEqual(KinesisTracker.objects.count(), 0)
+
+        #one bulk insert and one checkpoint update
+        with self.assertNumQueries(2):
+            c.batch_completed()
+        self.assertEqual(KinesisTracker.objects.filter(status=KinesisTracker.ST_DONE).count(), 5)
+
+    def test_flush_every_n(self):
+        """
+        BatchedCheckpointer should flush as soon as it has flush_every_records pending
+        :return:
+        """
+        from kinesisresponder.checkpointer import BatchedCheckpointer
+        from kinesisresponder.models import KinesisTracker
+
+        c = BatchedCheckpointer("teststream", "shard-0000", flush_every_records=3)
+        for n in range(0, 5):
+            c.record_done(c.record_seen(self.fake_record(str(n)), 0))
+        self.assertEqual(KinesisTracker.objects.count(), 3)
+        c.batch_completed()
+        self.assertEqual(KinesisTracker.objects.count(), 3)
+        c.flush()
+        self.assertEqual(KinesisTracker.objects.count(), 5)
+
+    def test_error_flushes(self):
+        """
+        BatchedCheckpointer should write out errors immediately, along with everything that came before
+        :return:
+        """
+        from kinesisresponder.checkpointer import BatchedCheckpointer
+        from kinesisresponder.models import KinesisTracker
+
+        c = BatchedCheckpointer("teststream", "shard-0000")
+        c.record_done(c.record_seen(self.fake_record("1"), 0))
+        c.record_error(c.record_seen(self.fake_record("2"), 0), ValueError("kaboom"), "trace goes here")
+
+        self.assertEqual(KinesisTracker.objects.count(), 2)
+        errored = KinesisTracker.objects.get(sequence_number="2")
+        self.assertEqual(errored.status, KinesisTracker.ST_ERROR)
+        self.assertEqual(errored.last_exception, "kaboom")
+
+    def test_should_save_false(self):
+        """
+        BatchedCheckpointer should not write anything if should_save is False
+        :return:
+        """
+        from kinesisresponder.checkpointer import BatchedCheckpointer
+        from kinesisresponder.models import KinesisTracker
+
+        c = BatchedCheckpointer("teststream", "shard-0000", should_save=False)
+        c.record_done(c.record_seen(self.fake_record("1"), 0))
+        c.batch_completed()
+        self.assertEqual(KinesisTracker.objects.count(), 0)
+
+
+class TestKinesisResponderCheckpointing(django.test.TestCase):
+    def test_mainloop_batched(self):
+        """
+        mainloop in batched mode should write one bulk insert per batch and resume from the last record in it
+        :return:
+        """
+        from kinesisresponder.kinesis_responder import KinesisResponder
+        from kinesisresponder.models import KinesisTracker
+
+        fake_conn = MagicMock()
+        fake_conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'first-iterator'})
+        fake_conn.get_records = MagicMock(return_value={
+            'Records': [TestBatchedCheckpointer.fake_record(str(n)) for n in range(10, 15)],
+            'MillisBehindLatest': 0,
+            'NextShardIterator': None
+        })
+
+        with patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            r = KinesisResponder("fake role", "fake session", "teststream", "shard-0000", checkpoint_mode="batched")
+            r._conn = fake_conn
+            r.process = MagicMock()
+            r.mainloop()
+
+        self.assertEqual(r.process.call_count, 5)
+        self.assertEqual(KinesisTracker.objects.filter(status=KinesisTracker.ST_DONE).count(), 5)
+        self.assertEqual(r.most_recent_message_id(), "14")
+
+
+class TestShardCheckpoint(django.test.TestCase):
+    def test_save_checkpoint(self):
+        """
+        save_checkpoint should keep a single row per shard and update it in place
+        :return:
+        """
+        from kinesisresponder.checkpointer import PerRecordCheckpointer
+        from kinesisresponder.models import ShardCheckpoint
+
+        c = PerRecordCheckpointer("teststream", "shard-0000")
+        c.save_checkpoint("1234")
+        c.save_checkpoint("5678")
+        PerRecordCheckpointer("teststream", "shard-0001").save_checkpoint("9999")
+
+        self.assertEqual(ShardCheckpoint.objects.count(), 2)
+        self.assertEqual(ShardCheckpoint.objects.get(stream_name="teststream", shard_id="shard-0000").sequence_number, "5678")
+
+    def test_save_checkpoint_needs_lease(self):
+        """
+        with a lease_owner, save_checkpoint should only move the checkpoint while that worker holds a live lease
+        :return:
+        """
+        from kinesisresponder.checkpointer import PerRecordCheckpointer
+        from kinesisresponder.models import ShardCheckpoint, ShardLease
+        from django.utils import timezone
+        from datetime import timedelta
+
+        lease = ShardLease(stream_name="teststream", shard_id="shard-0000", owner="worker-1",
+                           lease_expiry=timezone.now() + timedelta(seconds=30))
+        lease.save()
+        lost = MagicMock()
+        c = PerRecordCheckpointer("teststream", "shard-0000", lease_owner="worker-1", on_lease_lost=lost)
+        c.save_checkpoint("1234")
+        self.assertEqual(ShardCheckpoint.objects.get(stream_name="teststream", shard_id="shard-0000").sequence_number, "1234")
+
+        #another worker takes the lease over and moves on
+        lease.owner = "worker-2"
+        lease.save()
+        PerRecordCheckpointer("teststream", "shard-0000", lease_owner="worker-2").save_checkpoint("9999")
+        c.save_checkpoint("5678")
+        self.assertEqual(ShardCheckpoint.objects.get(stream_name="teststream", shard_id="shard-0000").sequence_number, "9999")
+        lost.assert_called_once()
+
+        #an expired lease doesn't count either
+        lease.owner = "worker-1"
+        lease.lease_expiry = timezone.now() - timedelta(seconds=1)
+        lease.save()
+        c.save_checkpoint("5678")
+        self.assertEqual(ShardCheckpoint.objects.get(stream_name="teststream", shard_id="shard-0000").sequence_number, "9999")
+
+    def test_new_shard_iterator(self):
+        """
+        new_shard_iterator should start after the checkpointed sequence number, or at the trim horizon if there is none
+        :return:
+        """
+        from kinesisresponder.kinesis_responder import KinesisResponder
+        from kinesisresponder.models import ShardCheckpoint
+        from datetime import datetime
+
+        fake_conn = MagicMock()
+        fake_conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'some-iterator'})
+
+        with patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            r = KinesisResponder("fake role", "fake session", "teststream", "shard-0000")
+            r._conn = fake_conn
+
+            self.assertEqual(r.new_shard_iterator(), "some-iterator")
+            fake_conn.get_shard_iterator.assert_called_once_with("teststream", "shard-0000", "TRIM_HORIZON")
+
+            ShardCheckpoint(stream_name="teststream", shard_id="shard-0000", sequence_number="1234", updated=datetime.now()).save()
+            fake_conn.get_shard_iterator.reset_mock()
+            r.new_shard_iterator()
+            fake_conn.get_shard_iterator.assert_called_once_with("teststream", "shard-0000", "AFTER_SEQUENCE_NUMBER",
+                                                                 starting_sequence_number="1234")
+
+    def test_shard_end(self):
+        """
+        when a shard runs out of records, mainloop should mark it as finished and flag that the shard ended
+        :return:
+        """
+        from kinesisresponder.kinesis_responder import KinesisResponder
+        from kinesisresponder.models import ShardCheckpoint
+
+        fake_conn = MagicMock()
+        fake_conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'first-iterator'})
+        fake_conn.get_records = MagicMock(return_value={
+            'Records': [],
+            'MillisBehindLatest': 0,
+            'NextShardIterator': None
+        })
+
+        with patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            r = KinesisResponder("fake role", "fake session", "teststream", "shard-0000")
+            r._conn = fake_conn
+            r.mainloop()
+
+        self.assertTrue(r.shard_ended)
+        self.assertTrue(ShardCheckpoint.objects.get(stream_name="teststream", shard_id="shard-0000").finished)
+
+
+class TestColdStart(django.test.TestCase):
+    def make_responder(self, **kwargs):
+        from kinesisresponder.kinesis_responder import KinesisResponder
+        fake_conn = MagicMock()
+        fake_conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'some-iterator'})
+        fake_conn.make_request = MagicMock(return_value={'ShardIterator': 'timestamp-iterator'})
+        with patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            r = KinesisResponder("fake role", "fake session", "teststream", "shard-0000", **kwargs)
+        r._conn = fake_conn
+        return r
+
+    def test_latest(self):
+        """
+        with an initial position of LATEST, new_shard_iterator should skip everything already in the shard
+        :return:
+        """
+        r = self.make_responder(initial_position="LATEST", skip_older_than=60)
+        self.assertEqual(r.new_shard_iterator(), "some-iterator")
+        r._conn.get_shard_iterator.assert_called_once_with("teststream", "shard-0000", "LATEST")
+
+    def test_at_timestamp(self):
+        """
+        with an initial position of AT_TIMESTAMP, new_shard_iterator should start at the given time
+        :return:
+        """
+        import json
+        r = self.make_responder(initial_position="AT_TIMESTAMP", initial_timestamp="2020-09-13T12:26:40")
+        self.assertEqual(r.new_shard_iterator(), "timestamp-iterator")
+        body = json.loads(r._conn.make_request.call_args[1]['body'])
+        self.assertEqual(body['ShardIteratorType'], "AT_TIMESTAMP")
+        self.assertEqual(body['Timestamp'], 1600000000)
+
+        with self.assertRaises(ValueError):
+            self.make_responder(initial_position="AT_TIMESTAMP")
+        with self.assertRaises(ValueError):
+            self.make_responder(initial_position="SOMEWHERE")
+
+    def test_skip_older_than(self):
+        """
+        skip_older_than should stop a cold start going further back than the given age, but not affect a shard that
+        has a checkpoint
+        :return:
+        """
+        from kinesisresponder.models import ShardCheckpoint
+        from datetime import datetime, timedelta
+
+        r = self.make_responder(initial_position="TRIM_HORIZON", skip_older_than=3600)
+        position, timestamp = r.cold_start_position()
+        self.assertEqual(position, "AT_TIMESTAMP")
+        self.assertAlmostEqual((datetime.utcnow() - timestamp).total_seconds(), 3600, delta=5)
+
+        r = self.make_responder(initial_position="AT_TIMESTAMP", initial_timestamp=datetime.utcnow() - timedelta(minutes=5),
+                                skip_older_than=3600)
+        position, timestamp = r.cold_start_position()
+        self.assertAlmostEqual((datetime.utcnow() - timestamp).total_seconds(), 300, delta=5)
+
+        ShardCheckpoint(stream_name="teststream", shard_id="shard-0000", sequence_number="1234", updated=datetime.now()).save()
+        r.new_shard_iterator()
+        r._conn.get_shard_iterator.assert_called_once_with("teststream", "shard-0000", "AFTER_SEQUENCE_NUMBER",
+                                                           starting_sequence_number="1234")
+
+    def test_child_shard(self):
+        """
+        a shard that came from resharding should start at the trim horizon, whatever the initial position says
+        :return:
+        """
+        r = self.make_responder(initial_position="LATEST", skip_older_than=60, parent_shard_ids=["shard-parent"])
+        self.assertEqual(r.cold_start_position(), ("TRIM_HORIZON", None))
+        r.new_shard_iterator()
+        r._conn.get_shard_iterator.assert_called_once_with("teststream", "shard-0000", "TRIM_HORIZON")
@@ -0,0 +1,147 @@
+import django.test
+from mock import MagicMock, patch
+from threading import Event, Thread
+
+
+class TestCredentialProvider(django.test.SimpleTestCase):
+    @staticmethod
+    def fake_sts(expired=False):
+        fake_credentials = MagicMock()
+        fake_credentials.is_expired = MagicMock(return_value=expired)
+        sts_conn = MagicMock()
+        sts_conn.assume_role = MagicMock(return_value=MagicMock(credentials=fake_credentials))
+        return sts_conn
+
+    def test_cached(self):
+        """
+        CredentialProvider should only assume the role once while the credentials are valid, and reuse connections
+        :return:
+        """
+        from kinesisresponder.credentials import CredentialProvider
+
+        sts_conn = self.fake_sts()
+        fake_factory = MagicMock(side_effect=lambda *args, **kwargs: MagicMock())
+        with patch("kinesisresponder.credentials.sts.connect_to_region", return_value=sts_conn):
+            with patch.dict("kinesisresponder.credentials.connection_factories", {'s3': fake_factory}):
+                p = CredentialProvider("fake role", "fake session")
+                first = p.connection('s3')
+                self.assertIs(p.connection('s3'), first)
+                p.get_credentials()
+
+        sts_conn.assume_role.assert_called_once_with("fake role", "fake session")
+        fake_factory.assert_called_once()
+
+    def test_refresh_before_expiry(self):
+        """
+        CredentialProvider should assume the role again, and build new connections, once the credentials are close to expiry
+        :return:
+        """
+        from kinesisresponder.credentials import CredentialProvider
+
+        sts_conn = self.fake_sts(expired=True)
+        fake_factory = MagicMock(side_effect=lambda *args, **kwargs: MagicMock())
+        with patch("kinesisresponder.credentials.sts.connect_to_region", return_value=sts_conn):
+            with patch.dict("kinesisresponder.credentials.connection_factories", {'s3': fake_factory}):
+                p = CredentialProvider("fake role", "fake session", refresh_margin=300)
+                first = p.connection('s3')
+                self.assertIsNot(p.connection('s3'), first)
+
+        self.assertEqual(sts_conn.assume_role.call_count, 2)
+        sts_conn.assume_role.return_value.credentials.is_expired.assert_called_with(time_offset_seconds=300)
+
+    def test_lifetime(self):
+        """
+        get_credentials should assume the role for a longer session when the current credentials won't last long enough,
+        but never for longer than max_session_duration
+        :return:
+        """
+        from kinesisresponder.credentials import CredentialProvider
+        from datetime import datetime, timedelta
+
+        def credentials_lasting(seconds):
+            return MagicMock(expiration=(datetime.utcnow() + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                             is_expired=MagicMock(return_value=False))
+
+        sts_conn = MagicMock()
+        sts_conn.assume_role = MagicMock(side_effect=[MagicMock(credentials=credentials_lasting(600)),
+                                                      MagicMock(credentials=credentials_lasting(7500)),
+                                                      MagicMock(credentials=credentials_lasting(10800))])
+        with patch("kinesisresponder.credentials.sts.connect_to_region", return_value=sts_conn):
+            p = CredentialProvider("fake role", "fake session", refresh_margin=300, max_session_duration=10800)
+            p.get_credentials()
+            #the cached credentials will only last another 10 minutes
+            credentials = p.get_credentials(lifetime=7200)
+            self.assertGreater(p.remaining_lifetime(credentials), 7200)
+            sts_conn.assume_role.assert_called_with("fake role", "fake session", duration_seconds=7500)
+            #these are good enough already
+            self.assertIs(p.get_credentials(lifetime=3600), credentials)
+            p.get_credentials(lifetime=86400)
+            sts_conn.assume_role.assert_called_with("fake role", "fake session", duration_seconds=10800)
+        self.assertEqual(sts_conn.assume_role.call_count, 3)
+
+    def test_per_thread_connections(self):
+        """
+        CredentialProvider should give each thread its own connection, but share the credentials
+        :return:
+        """
+        from kinesisresponder.credentials import CredentialProvider
+
+        sts_conn = self.fake_sts()
+        fake_factory = MagicMock(side_effect=lambda *args, **kwargs: MagicMock())
+        results = []
+        with patch("kinesisresponder.credentials.sts.connect_to_region", return_value=sts_conn):
+            with patch.dict("kinesisresponder.credentials.connection_factories", {'kinesis': fake_factory}):
+                p = CredentialProvider("fake role", "fake session")
+                threads = [Thread(target=lambda: results.append(p.connection('kinesis'))) for n in range(0, 3)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+        self.assertEqual(len(set([id(conn) for conn in results])), 3)
+        sts_conn.assume_role.assert_called_once()
+
+    def test_expire_connection(self):
+        """
+        expire_connection should cause one refresh even if it is reported more than once for the same credentials
+        :return:
+        """
+        from kinesisresponder.credentials import CredentialProvider
+
+        sts_conn = self.fake_sts()
+        fake_factory = MagicMock(side_effect=lambda *args, **kwargs: MagicMock())
+        with patch("kinesisresponder.credentials.sts.connect_to_region", return_value=sts_conn):
+            with patch.dict("kinesisresponder.credentials.connection_factories", {'kinesis': fake_factory}):
+                p = CredentialProvider("fake role", "fake session")
+                got_old_connection = Event()
+                old_credentials_expired = Event()
+
+                def other_thread():
+                    p.connection('kinesis')
+                    got_old_connection.set()
+                    old_credentials_expired.wait(5)
+                    #this thread is reporting the same old credentials, so it should not cause another refresh
+                    p.expire_connection('kinesis')
+
+                t = Thread(target=other_thread)
+                t.start()
+                got_old_connection.wait(5)
+                p.connection('kinesis')
+                p.expire_connection('kinesis')
+                p.connection('kinesis')
+                self.assertEqual(sts_conn.assume_role.call_count, 2)
+                old_credentials_expired.set()
+                t.join()
+                p.connection('kinesis')
+                self.assertEqual(sts_conn.assume_role.call_count, 2)
+
+    def test_shared_provider(self):
+        """
+        get_credential_provider should return the same provider for the same role and session
+        :return:
+        """
+        from kinesisresponder.credentials import get_credential_provider
+
+        a = get_credential_provider("role", "session", aws_access_key_id="key", aws_secret_access_key="secret")
+        self.assertIs(get_credential_provider("role", "session", aws_access_key_id="key", aws_secret_access_key="secret"), a)
+        self.assertIsNot(get_credential_provider("role", "other session"), a)
@@ -0,0 +1,121 @@
+import django.test
+from mock import MagicMock, patch
+from datetime import timedelta
+
+
+class TestLeaseManager(django.test.TestCase):
+    shard_ids = ["shardId-00{0}".format(n) for n in range(0, 4)]
+
+    def make_manager(self, worker_id):
+        from kinesisresponder.lease_manager import LeaseManager
+        from kinesisresponder.metrics import ShardMetrics
+        m = LeaseManager("teststream", worker_id=worker_id, lease_duration=30, metrics=ShardMetrics())
+        m.sync_shards(self.shard_ids)
+        return m
+
+    def test_single_worker_takes_everything(self):
+        """
+        a single worker should take every lease, and sync_shards should not create duplicates
+        :return:
+        """
+        from kinesisresponder.models import ShardLease
+
+        a = self.make_manager("worker-a")
+        a.sync_shards(self.shard_ids)
+        self.assertEqual(ShardLease.objects.count(), 4)
+        self.assertEqual(a.acquire_leases(), set(self.shard_ids))
+        self.assertEqual(a.renew_leases(), set())
+        self.assertEqual(a.held_shards, set(self.shard_ids))
+
+    def test_balancing_by_stealing(self):
+        """
+        a second worker should steal leases one at a time until both have an even share
+        :return:
+        """
+        a = self.make_manager("worker-a")
+        b = self.make_manager("worker-b")
+        a.acquire_leases()
+
+        self.assertEqual(len(b.acquire_leases()), 1)
+        self.assertEqual(len(a.renew_leases()), 1)
+        self.assertEqual(len(b.acquire_leases()), 1)
+        self.assertEqual(len(a.renew_leases()), 1)
+
+        #balanced now, so nothing more should move
+        self.assertEqual(b.acquire_leases(), set())
+        self.assertEqual(a.acquire_leases(), set())
+        self.assertEqual(len(a.held_shards), 2)
+        self.assertEqual(len(b.held_shards), 2)
+        self.assertEqual(a.held_shards & b.held_shards, set())
+
+    def test_expired_leases_taken_over(self):
+        """
+        once a worker stops renewing, another should take over its leases
+        :return:
+        """
+        from django.utils import timezone
+
+        a = self.make_manager("worker-a")
+        b = self.make_manager("worker-b")
+        a.acquire_leases()
+
+        later = timezone.now() + timedelta(seconds=60)
+        with patch("kinesisresponder.lease_manager.timezone.now", return_value=later):
+            self.assertEqual(b.acquire_leases(), set(self.shard_ids))
+        self.assertEqual(a.renew_leases(), set(self.shard_ids))
+        self.assertEqual(a.held_shards, set())
+
+    def test_release(self):
+        """
+        released leases should be free for another worker to take straight away
+        :return:
+        """
+        a = self.make_manager("worker-a")
+        b = self.make_manager("worker-b")
+        a.acquire_leases()
+        a.release_all()
+        self.assertEqual(b.acquire_leases(), set(self.shard_ids))
+
+
+class TestLeaseCycle(django.test.TestCase):
+    def test_run_lease_cycle(self):
+        """
+        run_lease_cycle should start threads for shards that we hold and stop them for shards that we lose
+        :return:
+        """
+        from kinesisresponder.management.kinesis_responder_basecommand import KinesisResponderBaseCommand
+        from kinesisresponder.lease_manager import LeaseManager
+        from kinesisresponder.metrics import ShardMetrics
+
+        shardlist = [{'ShardId': 'shardId-000'}, {'ShardId': 'shardId-001'}]
+
+        class FakeCommand(KinesisResponderBaseCommand):
+            stream_name = "teststream"
+
+            def startup_thread(self, conn, shardinfo):
+                t = MagicMock()
+                t.is_alive = MagicMock(return_value=True)
+                t.shard_id = shardinfo['ShardId']
+                return t
+
+        cmd = FakeCommand()
+        a = LeaseManager("teststream", worker_id="worker-a", metrics=ShardMetrics())
+        a.sync_shards(['shardId-000', 'shardId-001'])
+        threads = {}
+        cmd.run_lease_cycle(a, None, shardlist, threads)
+        self.assertEqual(set(threads.keys()), {'shardId-000', 'shardId-001'})
+        for t in threads.values():
+            t.start.assert_called_once()
+
+        b = LeaseManager("teststream", worker_id="worker-b", metrics=ShardMetrics())
+        stolen = b.acquire_leases()
+        self.assertEqual(len(stolen), 1)
+        stolen_thread = threads[list(stolen)[0]]
+
+        stopping = {}
+        cmd.run_lease_cycle(a, None, shardlist, threads, stopping)
+        self.assertEqual(set(threads.keys()), {'shardId-000', 'shardId-001'} - stolen)
+        stolen_thread.request_stop.assert_called_once()
+        #the heartbeat mustn't wait for the thread, it is reaped on a later cycle
+        stolen_thread.join.assert_not_called()
+        self.assertEqual(set(stopping.keys()), stolen)
@@ -0,0 +1,201 @@
+import django.test
+from mock import MagicMock, patch
+from threading import Event, Lock
+
+
+class TestOrderedKeyExecutor(django.test.SimpleTestCase):
+    def test_same_key_in_order(self):
+        """
+        items with the same key should run one at a time in submission order
+        :return:
+        """
+        from kinesisresponder.ordered_executor import OrderedKeyExecutor
+        from time import sleep
+
+        ran = []
+        lock = Lock()
+
+        def make_fn(n):
+            def fn():
+                sleep(0.01 * (5 - n))  #earlier items take longer
+                with lock:
+                    ran.append(n)
+            return fn
+
+        e = OrderedKeyExecutor(4)
+        for n in range(0, 5):
+            e.submit("same-key", make_fn(n), lambda result: None)
+        e.shutdown()
+        self.assertEqual(ran, [0, 1, 2, 3, 4])
+
+    def test_completion_order(self):
+        """
+        on_done should be called in submission order even if later items finish first
+        :return:
+        """
+        from kinesisresponder.ordered_executor import OrderedKeyExecutor
+
+        first_may_finish = Event()
+        completed = []
+
+        def slow():
+            first_may_finish.wait(5)
+            return "slow"
+
+        e = OrderedKeyExecutor(2, max_in_flight=10)
+        e.submit("key-a", slow, completed.append)
+        e.submit("key-b", lambda: "fast", completed.append)
+        e.submit("key-c", lambda: "faster", completed.append)
+
+        #the fast items can't be reported before the slow one that came ahead of them
+        self.assertEqual(completed, [])
+        self.assertEqual(e.in_flight, 3)
+        first_may_finish.set()
+        e.wait_idle()
+        self.assertEqual(completed, ["slow", "fast", "faster"])
+        e.shutdown()
+
+    def test_unordered_callbacks(self):
+        """
+        with ordered_callbacks=False, fast items should complete and free their slots while a slow one is still running
+        :return:
+        """
+        from kinesisresponder.ordered_executor import OrderedKeyExecutor
+
+        first_may_finish = Event()
+        completed = []
+
+        def slow():
+            first_may_finish.wait(5)
+            return "slow"
+
+        e = OrderedKeyExecutor(2, max_in_flight=2, ordered_callbacks=False)
+        e.submit("key-a", slow, completed.append)
+        #with ordered callbacks, the third submit would block until the slow item finished
+        for n in range(0, 3):
+            e.submit("key-b", lambda: "fast", completed.append)
+        #the third submit could only go in once two of the fast items had completed
+        self.assertEqual(completed[:2], ["fast", "fast"])
+        first_may_finish.set()
+        e.wait_idle()
+        self.assertEqual(sorted(completed), ["fast", "fast", "fast", "slow"])
+        e.shutdown()
+
+    def test_callback_failure(self):
+        """
+        if an on_done callback fails then wait_idle should raise the exception
+        :return:
+        """
+        from kinesisresponder.ordered_executor import OrderedKeyExecutor
+
+        def broken_callback(result):
+            raise RuntimeError("database went away")
+
+        e = OrderedKeyExecutor(2)
+        e.submit(None, lambda: None, broken_callback)
+        with self.assertRaises(RuntimeError):
+            e.wait_idle()
+        with self.assertRaises(RuntimeError):
+            e.submit(None, lambda: None, lambda result: None)
+
+    def test_worker_failure(self):
+        """
+        if the work itself raises, on_done should be given the exception and traceback rather than None
+        :return:
+        """
+        from kinesisresponder.ordered_executor import OrderedKeyExecutor
+
+        def broken():
+            raise RuntimeError("sentry went away")
+
+        completed = []
+        e = OrderedKeyExecutor(2)
+        e.submit("key-a", broken, completed.append)
+        e.submit("key-a", lambda: None, completed.append)
+        e.shutdown()
+        self.assertIsInstance(completed[0][0], RuntimeError)
+        self.assertIn("sentry went away", completed[0][1])
+        self.assertIsNone(completed[1])
+
+    def test_callback_outside_lock(self):
+        """
+        a slow on_done should not stop other work being submitted and finishing, and callbacks should still be in order
+        :return:
+        """
+        from kinesisresponder.ordered_executor import OrderedKeyExecutor
+        from threading import Thread
+
+        callback_may_finish = Event()
+        completed = []
+
+        def slow_callback(result):
+            callback_may_finish.wait(5)
+            completed.append(result)
+
+        e = OrderedKeyExecutor(2, max_in_flight=10)
+        e.submit("key-a", lambda: "first", slow_callback)
+        second_ran = Event()
+
+        def submit_second():
+            e.submit("key-b", lambda: second_ran.set() or "second", completed.append)
+
+        t = Thread(target=submit_second)
+        t.start()
+        self.assertTrue(second_ran.wait(2))
+        t.join(2)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(completed, [])
+        callback_may_finish.set()
+        e.wait_idle()
+        self.assertEqual(completed, ["first", "second"])
+        e.shutdown()
+
+
+class TestParallelResponder(django.test.TransactionTestCase):
+    def test_mainloop_parallel(self):
+        """
+        mainloop with a worker pool should process every record and checkpoint the last one once all are done
+        :return:
+        """
+        from kinesisresponder.kinesis_responder import KinesisResponder
+        from kinesisresponder.models import KinesisTracker
+        import json
+        import base64
+
+        records = [{
+            'SequenceNumber': str(n),
+            'PartitionKey': "atom-{0}".format(n % 3),
+            'Data': base64.b64encode(json.dumps({"n": n}).encode("UTF-8")).decode("ASCII"),
+            'ApproximateArrivalTimestamp': 1600000000
+        } for n in range(100, 112)]
+
+        fake_conn = MagicMock()
+        fake_conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'first-iterator'})
+        fake_conn.get_records = MagicMock(return_value={
+            'Records': records,
+            'MillisBehindLatest': 0,
+            'NextShardIterator': None
+        })
+
+        processed = []
+        lock = Lock()
+
+        def fake_process(data, approx_arrival):
+            with lock:
+                processed.append(json.loads(data)["n"])
+
+        with patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            r = KinesisResponder("fake role", "fake session", "teststream", "shard-0000", checkpoint_mode="batched",
+                                 worker_pool_size=4)
+            r._conn = fake_conn
+            r.process = fake_process
+            r.mainloop()
+            r.checkpointer.flush()
+
+        self.assertEqual(sorted(processed), list(range(100, 112)))
+        for key in range(0, 3):
+            in_key_order = [n for n in processed if n % 3 == key]
+            self.assertEqual(in_key_order, sorted(in_key_order))
+        self.assertEqual(KinesisTracker.objects.filter(status=KinesisTracker.ST_DONE).count(), 12)
+        self.assertEqual(r.most_recent_message_id(), "111")
+        r.executor.shutdown()
@@ -0,0 +1,51 @@
+import django.test
+
+
+class TestPollController(django.test.SimpleTestCase):
+    def make_controller(self):
+        from kinesisresponder.poll_controller import PollController
+        from kinesisresponder.metrics import ShardMetrics
+
+        return PollController("teststream", "shard-0000", min_limit=10, max_limit=80, min_idle_delay=1,
+                              max_idle_delay=8, metrics=ShardMetrics())
+
+    def test_grows_when_behind(self):
+        """
+        the batch limit should double while we are behind and getting full batches, up to max_limit
+        :return:
+        """
+        c = self.make_controller()
+        for expected in [20, 40, 80, 80]:
+            c.record_batch(c.limit, 300000)
+            self.assertEqual(c.limit, expected)
+            self.assertEqual(c.next_delay(), 0)
+        self.assertEqual(c.metrics.get("teststream", "shard-0000", "limit_grow"), 3)
+        self.assertEqual(c.metrics.get("teststream", "shard-0000", "batch_limit"), 80)
+
+    def test_shrinks_when_caught_up(self):
+        """
+        the batch limit should halve once we are caught up, down to min_limit
+        :return:
+        """
+        c = self.make_controller()
+        c.limit = 40
+        for expected in [20, 10, 10]:
+            c.record_batch(3, 0)
+            self.assertEqual(c.limit, expected)
+
+    def test_idle_delay(self):
+        """
+        the idle delay should back off while the shard is quiet and reset as soon as something arrives
+        :return:
+        """
+        c = self.make_controller()
+        c.record_batch(0, 0)
+        self.assertEqual(c.next_delay(), 8)
+        c.record_batch(2, 0)
+        self.assertEqual(c.next_delay(), 0)
+        delays = []
+        for n in range(0, 5):
+            c.record_batch(0, 0)
+            delays.append(c.next_delay())
+        self.assertEqual(delays, [1, 2, 4, 8, 8])
+        self.assertEqual(c.metrics.get("teststream", "shard-0000", "idle_sleep"), 6)
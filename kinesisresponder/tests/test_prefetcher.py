@@ -0,0 +1,137 @@
+import django.test
+from mock import MagicMock, patch
+from threading import Event
+from time import sleep
+
+
+class TestRecordPrefetcher(django.test.SimpleTestCase):
+    @staticmethod
+    def make_batch(first, count, next_iterator="next-iterator"):
+        return {
+            'Records': [{'SequenceNumber': str(n), 'Data': 'e30=', 'ApproximateArrivalTimestamp': 1600000000}
+                        for n in range(first, first+count)],
+            'MillisBehindLatest': 1000,
+            'NextShardIterator': next_iterator
+        }
+
+    @staticmethod
+    def make_responder(get_records):
+        from kinesisresponder.poll_controller import PollController
+        from kinesisresponder.metrics import ShardMetrics
+        responder = MagicMock()
+        responder.stream_name = "teststream"
+        responder.shard_id = "shard-0000"
+        responder.poll_controller = PollController("teststream", "shard-0000", metrics=ShardMetrics())
+        responder._conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'first-iterator'})
+        responder._conn.get_records = get_records
+        return responder
+
+    @staticmethod
+    def wait_for(condition, timeout=5):
+        for n in range(0, int(timeout*100)):
+            if condition():
+                return True
+            sleep(0.01)
+        return False
+
+    def test_reads_ahead(self):
+        """
+        RecordPrefetcher should fetch the next batch while the current one is being processed, but no further ahead
+        than its buffer allows
+        :return:
+        """
+        from kinesisresponder.prefetcher import RecordPrefetcher
+        from kinesisresponder.metrics import ShardMetrics
+
+        get_records = MagicMock(side_effect=[self.make_batch(n*10, 10) for n in range(0, 3)] + [self.make_batch(30, 10, None)])
+        responder = self.make_responder(get_records)
+        stop = Event()
+
+        p = RecordPrefetcher(responder, ("TRIM_HORIZON", None, None), buffer_size=1, metrics=ShardMetrics())
+        p.start()
+        try:
+            #one batch in the buffer and one waiting to go in
+            self.assertTrue(self.wait_for(lambda: get_records.call_count == 2))
+            sleep(0.1)
+            self.assertEqual(get_records.call_count, 2)
+
+            self.assertEqual(p.next_batch(stop)['Records'][0]['SequenceNumber'], "0")
+            self.assertTrue(self.wait_for(lambda: get_records.call_count == 3))
+            self.assertEqual(p.next_batch(stop)['Records'][0]['SequenceNumber'], "10")
+            self.assertEqual(p.next_batch(stop)['Records'][0]['SequenceNumber'], "20")
+            self.assertEqual(p.next_batch(stop)['Records'][0]['SequenceNumber'], "30")
+            self.assertIsNone(p.next_batch(stop))
+        finally:
+            p.request_stop()
+            p.join()
+
+    def test_expired_iterator(self):
+        """
+        RecordPrefetcher should get a new iterator just after the last record that it fetched when the iterator expires
+        :return:
+        """
+        from kinesisresponder.prefetcher import RecordPrefetcher
+        from kinesisresponder.metrics import ShardMetrics
+        from boto.kinesis.exceptions import ExpiredIteratorException
+
+        get_records = MagicMock(side_effect=[self.make_batch(0, 5), ExpiredIteratorException(400, "expired"),
+                                             self.make_batch(5, 5, None)])
+        responder = self.make_responder(get_records)
+        stop = Event()
+        metrics = ShardMetrics()
+
+        p = RecordPrefetcher(responder, ("AFTER_SEQUENCE_NUMBER", "abc", None), buffer_size=2, metrics=metrics)
+        p.start()
+        try:
+            self.assertEqual(p.next_batch(stop)['Records'][0]['SequenceNumber'], "0")
+            self.assertEqual(p.next_batch(stop)['Records'][0]['SequenceNumber'], "5")
+            self.assertIsNone(p.next_batch(stop))
+        finally:
+            p.request_stop()
+            p.join()
+
+        self.assertEqual(responder._conn.get_shard_iterator.call_args_list[0][0], ("teststream", "shard-0000", "AFTER_SEQUENCE_NUMBER"))
+        self.assertEqual(responder._conn.get_shard_iterator.call_args_list[0][1], {'starting_sequence_number': 'abc'})
+        self.assertEqual(responder._conn.get_shard_iterator.call_args_list[1][1], {'starting_sequence_number': '4'})
+        self.assertEqual(metrics.get("teststream", "shard-0000", "iterator_expired"), 1)
+
+    def test_keeps_iterator_fresh(self):
+        """
+        RecordPrefetcher should renew its iterator if it gets stale while waiting for a slow batch to be processed
+        :return:
+        """
+        from kinesisresponder.prefetcher import RecordPrefetcher
+        from kinesisresponder.metrics import ShardMetrics
+
+        get_records = MagicMock(side_effect=[self.make_batch(0, 5), self.make_batch(5, 5), self.make_batch(10, 5, None)])
+        responder = self.make_responder(get_records)
+        stop = Event()
+        metrics = ShardMetrics()
+
+        with patch("kinesisresponder.prefetcher.ITERATOR_MAX_AGE", 0):
+            p = RecordPrefetcher(responder, ("TRIM_HORIZON", None, None), buffer_size=1, metrics=metrics)
+            p.start()
+            try:
+                self.assertTrue(self.wait_for(lambda: metrics.get("teststream", "shard-0000", "iterator_renewed", 0) > 0))
+                self.assertEqual(p.next_batch(stop)['Records'][0]['SequenceNumber'], "0")
+                self.assertEqual(p.next_batch(stop)['Records'][0]['SequenceNumber'], "5")
+            finally:
+                p.request_stop()
+                p.join()
+
+        self.assertEqual(responder._conn.get_shard_iterator.call_args_list[-1][1], {'starting_sequence_number': '9'})
+
+    def test_fetch_failure(self):
+        """
+        if fetching fails, next_batch should raise the exception in the processing thread
+        :return:
+        """
+        from kinesisresponder.prefetcher import RecordPrefetcher
+        from kinesisresponder.metrics import ShardMetrics
+
+        responder = self.make_responder(MagicMock(side_effect=RuntimeError("kaboom")))
+        p = RecordPrefetcher(responder, ("TRIM_HORIZON", None, None), metrics=ShardMetrics())
+        p.start()
+        with self.assertRaises(RuntimeError):
+            p.next_batch(Event())
+        p.join()
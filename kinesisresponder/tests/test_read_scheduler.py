@@ -0,0 +1,65 @@
+import django.test
+from time import monotonic
+
+
+class TestReadScheduler(django.test.SimpleTestCase):
+    def test_shard_reads(self):
+        """
+        ReadScheduler should space out reads from a shard to its read rate, and count the waits as throttles avoided
+        :return:
+        """
+        from kinesisresponder.read_scheduler import ReadScheduler
+        from kinesisresponder.metrics import ShardMetrics
+        metrics = ShardMetrics()
+        s = ReadScheduler("teststream", shard_reads_per_second=50, metrics=metrics)
+
+        started = monotonic()
+        for n in range(0, 5):
+            self.assertTrue(s.before_read("shard-0000"))
+        self.assertGreaterEqual(monotonic() - started, 0.07)
+        self.assertEqual(metrics.get("teststream", "shard-0000", "throttle_avoided"), 4)
+
+        #other shards have their own limits
+        s.before_read("shard-0001")
+        self.assertIsNone(metrics.get("teststream", "shard-0001", "throttle_avoided"))
+
+    def test_shard_bytes(self):
+        """
+        ReadScheduler should hold off the next read from a shard once it has gone over its byte rate
+        :return:
+        """
+        from kinesisresponder.read_scheduler import ReadScheduler
+        from kinesisresponder.metrics import ShardMetrics
+        metrics = ShardMetrics()
+        s = ReadScheduler("teststream", shard_reads_per_second=1000, shard_bytes_per_second=10000, metrics=metrics)
+
+        s.before_read("shard-0000")
+        s.after_read("shard-0000", [{'Data': 'x'*11000, 'PartitionKey': ''}])
+        started = monotonic()
+        s.before_read("shard-0000")
+        self.assertGreaterEqual(monotonic() - started, 0.09)
+        self.assertEqual(metrics.get("teststream", "shard-0000", "throttle_avoided"), 1)
+
+    def test_stream_reads(self):
+        """
+        ReadScheduler should apply the stream-wide read rate across all shards
+        :return:
+        """
+        from kinesisresponder.read_scheduler import ReadScheduler
+        from kinesisresponder.metrics import ShardMetrics
+        from threading import Event
+        metrics = ShardMetrics()
+        s = ReadScheduler("teststream", stream_reads_per_second=20, metrics=metrics)
+
+        started = monotonic()
+        s.before_read("shard-0000")
+        s.before_read("shard-0001")
+        self.assertGreaterEqual(monotonic() - started, 0.04)
+        self.assertEqual(metrics.get("teststream", "shard-0001", "throttle_avoided"), 1)
+
+        s.record_throttled("shard-0000")
+        self.assertEqual(metrics.get("teststream", "shard-0000", "throttle_hit"), 1)
+
+        stop = Event()
+        stop.set()
+        self.assertFalse(s.before_read("shard-0000", stop_event=stop))
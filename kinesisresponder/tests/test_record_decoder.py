@@ -0,0 +1,144 @@
+import django.test
+from mock import MagicMock, patch
+import base64
+import gzip
+import hashlib
+import json
+
+
+def varint(value):
+    out = b''
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value:
+            out += bytes([b | 0x80])
+        else:
+            return out + bytes([b])
+
+
+def length_delimited(field_number, data):
+    return varint((field_number << 3) | 2) + varint(len(data)) + data
+
+
+def make_aggregate(partition_keys, records):
+    """
+    Builds a KPL aggregated record
+    :param partition_keys: list of partition key strings
+    :param records: list of (partition key index, data bytes)
+    """
+    message = b''.join([length_delimited(1, key.encode("UTF-8")) for key in partition_keys])
+    for index, data in records:
+        message += length_delimited(3, varint(1 << 3) + varint(index) + length_delimited(3, data))
+    return b'\xf3\x89\x9a\xc2' + message + hashlib.md5(message).digest()
+
+
+class TestRecordDecoder(django.test.SimpleTestCase):
+    def test_deaggregate(self):
+        """
+        deaggregate should unpack the sub-records of a KPL aggregated record, and ignore anything else
+        :return:
+        """
+        from kinesisresponder.record_decoder import deaggregate
+
+        data = make_aggregate(["key-a", "key-b"], [(0, b'{"n": 1}'), (1, b'{"n": 2}'), (0, b'{"n": 3}')])
+        self.assertEqual(deaggregate(data), [("key-a", b'{"n": 1}'), ("key-b", b'{"n": 2}'), ("key-a", b'{"n": 3}')])
+
+        self.assertIsNone(deaggregate(b'{"n": 1}'))
+        #bad digest
+        self.assertIsNone(deaggregate(data[:-1] + b'\x00'))
+
+    def test_decode_records(self):
+        """
+        decode_records should expand aggregated records, un-gzip payloads and mark the last sub-record of each record
+        :return:
+        """
+        from kinesisresponder.record_decoder import decode_records
+
+        aggregate = make_aggregate(["key-a", "key-b"], [(0, b'{"n": 1}'), (1, gzip.compress(b'{"n": 2}'))])
+        records = [
+            {'SequenceNumber': '1', 'PartitionKey': 'agg', 'Data': base64.b64encode(aggregate).decode("ASCII")},
+            {'SequenceNumber': '2', 'PartitionKey': 'plain', 'Data': base64.b64encode(b'{"n": 3}').decode("ASCII")},
+            {'SequenceNumber': '3', 'PartitionKey': 'zipped', 'Data': base64.b64encode(gzip.compress(b'{"n": 4}')).decode("ASCII")},
+        ]
+
+        result = decode_records(records)
+        self.assertEqual([rec['Data'] for rec in result], ['{"n": 1}', '{"n": 2}', '{"n": 3}', '{"n": 4}'])
+        self.assertEqual([rec['SequenceNumber'] for rec in result], ['1', '1', '2', '3'])
+        self.assertEqual([rec['PartitionKey'] for rec in result], ['key-a', 'key-b', 'plain', 'zipped'])
+        self.assertEqual([rec.get('LastSubRecord', True) for rec in result], [False, True, True, True])
+        self.assertEqual(result[1]['SubSequenceNumber'], 1)
+
+    def test_corrupt_records(self):
+        """
+        decode_records should pass on records that it can't decode as they are, and count them, rather than raising
+        :return:
+        """
+        from kinesisresponder.record_decoder import decode_records
+
+        #a protobuf that is cut short, with a digest that matches it
+        good = make_aggregate(["key-a"], [(0, b'{"n": 1}')])
+        truncated_message = good[4:-16][:-3]
+        truncated = b'\xf3\x89\x9a\xc2' + truncated_message + hashlib.md5(truncated_message).digest()
+        bad_gzip = gzip.compress(b'{"n": 2}')[:-6]
+        records = [
+            {'SequenceNumber': '1', 'PartitionKey': 'agg', 'Data': base64.b64encode(truncated).decode("ASCII")},
+            {'SequenceNumber': '2', 'PartitionKey': 'zipped', 'Data': base64.b64encode(bad_gzip).decode("ASCII")},
+            {'SequenceNumber': '3', 'PartitionKey': 'garbled', 'Data': b'\x1f\x8b\x08corrupt'},
+            {'SequenceNumber': '4', 'PartitionKey': 'plain', 'Data': base64.b64encode(b'{"n": 3}').decode("ASCII")},
+        ]
+        errors = []
+
+        result = decode_records(records, on_error=errors.append)
+        self.assertEqual([rec['SequenceNumber'] for rec in result], ['1', '2', '3', '4'])
+        self.assertEqual(result[1]['Data'], bad_gzip.decode("UTF-8", errors="replace"))
+        self.assertEqual(result[3]['Data'], '{"n": 3}')
+        self.assertEqual(errors, ["decode_error_aggregate", "decode_error_gzip", "decode_error_base64", "decode_error_gzip"])
+
+
+class TestAggregatedCheckpointing(django.test.TestCase):
+    def test_mainloop_aggregated(self):
+        """
+        mainloop should process every sub-record of an aggregated record, and only checkpoint the record once the last
+        one is done
+        :return:
+        """
+        from kinesisresponder.kinesis_responder import KinesisResponder
+
+        aggregate = make_aggregate(["key-a"], [(0, json.dumps({"n": n}).encode("UTF-8")) for n in range(0, 3)])
+        fake_conn = MagicMock()
+        fake_conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'first-iterator'})
+        fake_conn.get_records = MagicMock(return_value={
+            'Records': [{'SequenceNumber': '10', 'PartitionKey': 'agg', 'ApproximateArrivalTimestamp': 1600000000,
+                         'Data': base64.b64encode(aggregate).decode("ASCII")}],
+            'MillisBehindLatest': 0,
+            'NextShardIterator': None
+        })
+
+        checkpoints = []
+        with patch('kinesisresponder.kinesis_responder.KinesisResponder.refresh_access_credentials'):
+            r = KinesisResponder("fake role", "fake session", "teststream", "shard-0000")
+            r._conn = fake_conn
+            r.process = MagicMock()
+            real_save_checkpoint = r.checkpointer.save_checkpoint
+            r.checkpointer.save_checkpoint = MagicMock(side_effect=lambda seq: checkpoints.append(seq) or real_save_checkpoint(seq))
+            r.mainloop()
+
+        self.assertEqual([call[0][0] for call in r.process.call_args_list], ['{"n": 0}', '{"n": 1}', '{"n": 2}'])
+        self.assertEqual(checkpoints, ['10'])
+        self.assertEqual(r.most_recent_message_id(), '10')
+
+    def test_batched_partial_aggregate(self):
+        """
+        BatchedCheckpointer should not move the checkpoint onto an aggregated record that is only partly done
+        :return:
+        """
+        from kinesisresponder.checkpointer import BatchedCheckpointer
+        from kinesisresponder.models import KinesisTracker, ShardCheckpoint
+
+        c = BatchedCheckpointer("teststream", "shard-0000")
+        c.record_done(c.record_seen({'SequenceNumber': '1'}, 0))
+        c.record_done(c.record_seen({'SequenceNumber': '2', 'LastSubRecord': False}, 0))
+        c.flush()
+        self.assertEqual(KinesisTracker.objects.count(), 2)
+        self.assertEqual(ShardCheckpoint.objects.get(stream_name="teststream", shard_id="shard-0000").sequence_number, '1')
@@ -0,0 +1,137 @@
+import django.test
+from mock import MagicMock, patch
+from datetime import datetime
+
+
+class TestTokenBucket(django.test.SimpleTestCase):
+    def test_rate(self):
+        """
+        TokenBucket should allow a burst up to its capacity and then refill at its rate
+        :return:
+        """
+        from kinesisresponder.rate_limiter import TokenBucket
+        now = [100.0]
+        b = TokenBucket(2, capacity=4, clock=lambda: now[0])
+        for n in range(0, 4):
+            self.assertTrue(b.try_acquire())
+        self.assertFalse(b.try_acquire())
+        now[0] += 0.5
+        self.assertTrue(b.try_acquire())
+        self.assertFalse(b.try_acquire())
+        now[0] += 10
+        self.assertTrue(b.try_acquire(4))
+        self.assertFalse(b.try_acquire())
+
+    def test_acquire_stop(self):
+        """
+        TokenBucket.acquire should give up when the stop event is set
+        :return:
+        """
+        from kinesisresponder.rate_limiter import TokenBucket
+        from threading import Event
+        b = TokenBucket(0.001, capacity=1)
+        self.assertEqual(b.acquire(), 0)
+        stop = Event()
+        stop.set()
+        self.assertIsNone(b.acquire(stop_event=stop))
+
+
+class TestShardReplayer(django.test.TestCase):
+    @staticmethod
+    def make_record(seq, arrival):
+        import base64
+        return {'SequenceNumber': seq, 'Data': base64.b64encode(('{"seq": "%s"}' % seq).encode("UTF-8")).decode("ASCII"), 'PartitionKey': 'key', 'ApproximateArrivalTimestamp': arrival}
+
+    def make_replayer(self, conn, handler, **kwargs):
+        from kinesisresponder.replay import ShardReplayer
+        provider = MagicMock()
+        provider.connection = MagicMock(return_value=conn)
+        with patch("kinesisresponder.replay.get_credential_provider", return_value=provider):
+            return ShardReplayer("fake role", "fake session", "teststream", "shardId-000", handler, **kwargs)
+
+    def test_at_timestamp(self):
+        """
+        ShardReplayer should start at the given timestamp, stop at the end of the window and leave the checkpoints alone
+        :return:
+        """
+        from kinesisresponder.kinesis_responder import AT_TIMESTAMP
+        from kinesisresponder.models import ShardCheckpoint, KinesisTracker
+        import json
+
+        conn = MagicMock()
+        conn.make_request = MagicMock(return_value={'ShardIterator': 'it-1'})
+        conn.get_records = MagicMock(side_effect=[
+            {'Records': [self.make_record('1', 1000.0), self.make_record('2', 1001.0)], 'NextShardIterator': 'it-2', 'MillisBehindLatest': 5000},
+            {'Records': [self.make_record('3', 1002.0), self.make_record('4', 2000.0)], 'NextShardIterator': 'it-3', 'MillisBehindLatest': 5000},
+        ])
+        seen = []
+
+        def handler(rec):
+            seen.append(rec['SequenceNumber'])
+            if rec['SequenceNumber'] == '2':
+                raise ValueError("broken")
+            return "ok"
+
+        r = self.make_replayer(conn, handler, iterator_type=AT_TIMESTAMP, timestamp=datetime(1970, 1, 1, 0, 16, 40),
+                               end_timestamp=datetime(1970, 1, 1, 0, 16, 50))
+        r.run()
+
+        self.assertEqual(seen, ['1', '2', '3'])
+        request_body = json.loads(conn.make_request.call_args[1]['body'])
+        self.assertEqual(request_body['ShardIteratorType'], 'AT_TIMESTAMP')
+        self.assertEqual(request_body['Timestamp'], 1000.0)
+        self.assertEqual(r.stats.get("teststream", "shardId-000", "ok"), 2)
+        self.assertEqual(r.stats.get("teststream", "shardId-000", "error"), 1)
+        self.assertEqual(r.stats.get("teststream", "shardId-000", "last_sequence_number"), '3')
+        self.assertEqual(ShardCheckpoint.objects.count(), 0)
+        self.assertEqual(KinesisTracker.objects.count(), 0)
+
+    def test_at_sequence_number(self):
+        """
+        ShardReplayer should start at the given sequence number and stop once it has caught up
+        :return:
+        """
+        from kinesisresponder.kinesis_responder import AT_SEQUENCE_NUMBER
+        conn = MagicMock()
+        conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'it-1'})
+        conn.get_records = MagicMock(side_effect=[
+            {'Records': [self.make_record('5', 1000.0)], 'NextShardIterator': 'it-2', 'MillisBehindLatest': 0},
+            {'Records': [], 'NextShardIterator': 'it-3', 'MillisBehindLatest': 0},
+        ])
+        handler = MagicMock(return_value=None)
+
+        r = self.make_replayer(conn, handler, iterator_type=AT_SEQUENCE_NUMBER, sequence_number='5')
+        r.run()
+
+        conn.get_shard_iterator.assert_called_once_with("teststream", "shardId-000", AT_SEQUENCE_NUMBER, starting_sequence_number='5')
+        handler.assert_called_once()
+        self.assertEqual(conn.get_records.call_count, 2)
+        self.assertEqual(r.stats.get("teststream", "shardId-000", "processed"), 1)
+
+    def test_expired_iterator(self):
+        """
+        if the iterator expires part way through, ShardReplayer should carry on after the last record that it replayed,
+        or from the original start position if it hasn't replayed anything yet
+        :return:
+        """
+        from kinesisresponder.kinesis_responder import AT_SEQUENCE_NUMBER, AFTER_SEQUENCE_NUMBER
+        from boto.kinesis.exceptions import ExpiredIteratorException
+        conn = MagicMock()
+        conn.get_shard_iterator = MagicMock(return_value={'ShardIterator': 'it-1'})
+        conn.get_records = MagicMock(side_effect=[
+            ExpiredIteratorException(400, "Bad Request"),
+            {'Records': [self.make_record('5', 1000.0), self.make_record('6', 1001.0)], 'NextShardIterator': 'it-2', 'MillisBehindLatest': 1000},
+            ExpiredIteratorException(400, "Bad Request"),
+            {'Records': [self.make_record('7', 1002.0)], 'NextShardIterator': 'it-3', 'MillisBehindLatest': 0},
+            {'Records': [], 'NextShardIterator': 'it-4', 'MillisBehindLatest': 0},
+        ])
+        handler = MagicMock(return_value=None)
+
+        r = self.make_replayer(conn, handler, iterator_type=AT_SEQUENCE_NUMBER, sequence_number='5')
+        r.run()
+
+        self.assertEqual([call[1]['starting_sequence_number'] for call in conn.get_shard_iterator.call_args_list], ['5', '5', '6'])
+        self.assertEqual(conn.get_shard_iterator.call_args_list[2][0][2], AFTER_SEQUENCE_NUMBER)
+        self.assertEqual(handler.call_count, 3)
+        self.assertEqual(r.stats.get("teststream", "shardId-000", "iterator_expired"), 2)
+        self.assertIsNone(r.stats.get("teststream", "shardId-000", "failed"))
@@ -0,0 +1,32 @@
+from .MessageProcessor import MessageProcessor
+from .VidispineMessageProcessor import VidispineMessageProcessor
+from .job_notification import JobNotification
+from atomresponder.item_mapping import get_item_mapping
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class VidispineItemMessageProcessor(MessageProcessor):
+    """
+    Listens for items being deleted from Vidispine, so that we stop mapping atoms onto them
+    """
+    routing_key = "vidispine.item.delete"
+    #item notifications have the same key/value layout as job notifications
+    schema = VidispineMessageProcessor.schema
+
+    def valid_message_receive(self, exchange_name, routing_key, delivery_tag, body: dict):
+        """
+        receives the validated vidispine json message.
+        :param exchange_name:
+        :param routing_key:
+        :param delivery_tag:
+        :param body:
+        :return:
+        """
+        notification = JobNotification(body)
+        if notification.itemId is None:
+            logger.warning("Got an item deletion notification with no item ID: {0}".format(body))
+            return
+        logger.info("{0}: Item has been deleted from Vidispine".format(notification.itemId))
+        get_item_mapping().forget_item(notification.itemId)
@@ -2,6 +2,7 @@ from .MessageProcessor import MessageProcessor
 from .job_notification import JobNotification
 import logging
 from atomresponder.models import ImportJob
+from atomresponder.storage_manager import get_storage_manager
 from kinesisresponder.sentry import inform_sentry_exception
 from .transcode_check import check_for_broken_proxy, delete_existing_proxy, transcode_proxy
 from datetime import datetime
@@ -57,6 +58,11 @@ class VidispineMessageProcessor(MessageProcessor):
         importjob.completed_at = datetime.now(tz=pytz.timezone(time_zone))
         importjob.save()
 
+        try:
+            get_storage_manager().job_completed(importjob)
+        except Exception as e:
+            logger.exception("{0}: Could not clean up downloaded media: ".format(importjob.item_id), exc_info=e)
+
         if importjob.is_failed():
             VidispineMessageProcessor.handle_failed_job(importjob)
         else:
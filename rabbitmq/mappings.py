@@ -1,6 +1,7 @@
 from .ProjectMessageProcessor import ProjectMessageProcessor
 from .CommissionMessageProcessor import CommissionMessageProcessor
 from .VidispineMessageProcessor import VidispineMessageProcessor
+from .VidispineItemMessageProcessor import VidispineItemMessageProcessor
 
 ##This structure is imported by name in the run_rabbitmq_responder
 EXCHANGE_MAPPINGS = [
@@ -16,5 +17,10 @@ EXCHANGE_MAPPINGS = [
         "exchange": "vidispine-events",
         "durable": True,
         "handler": VidispineMessageProcessor(),
+    },
+    {
+        "exchange": "vidispine-events",
+        "durable": True,
+        "handler": VidispineItemMessageProcessor(),
     }
 ]
@@ -16,7 +16,7 @@ def update_kinesis(project_instance: ProjectModel, commission_instance: CachedCo
     :param message_type: either `media_atom.MSG_PROJECT_CREATED` or `media_atom.MSG_PROJECT_UPDATED`
     :return:
     """
-    from boto import sts, kinesis
+    from kinesisresponder.credentials import get_credential_provider
     from django.conf import settings
     import json
 
@@ -29,22 +29,12 @@ def update_kinesis(project_instance: ProjectModel, commission_instance: CachedCo
                                                                           )
                 )
 
-    sts_connection = sts.STSConnection(
-        aws_access_key_id=settings.MEDIA_ATOM_AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.MEDIA_ATOM_AWS_SECRET_ACCESS_KEY)
-
-    assume_role_result = sts_connection.assume_role(
-        role_arn=settings.MEDIA_ATOM_ROLE_ARN,
-        role_session_name=SESSION_NAME)
-
-    credentials = assume_role_result.credentials
-
-    logger.debug("{0}: Got kinesis credentials".format(project_id))
-    kinesis_connection = kinesis.connect_to_region(
-        region_name='eu-west-1',
-        aws_access_key_id=credentials.access_key,
-        aws_secret_access_key=credentials.secret_key,
-        security_token=credentials.session_token)
+    #credentials and connection are cached between calls, and only refreshed when they are about to expire
+    kinesis_connection = get_credential_provider(settings.MEDIA_ATOM_ROLE_ARN, SESSION_NAME,
+                                                 aws_access_key_id=settings.MEDIA_ATOM_AWS_ACCESS_KEY_ID,
+                                                 aws_secret_access_key=settings.MEDIA_ATOM_AWS_SECRET_ACCESS_KEY)\
+        .connection('kinesis')
+    logger.debug("{0}: Got kinesis connection".format(project_id))
 
     message_content = {
         'type': message_type,
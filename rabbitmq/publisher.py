@@ -0,0 +1,202 @@
+from concurrent.futures import Future
+from collections import deque
+from threading import Event, Lock, Thread
+import logging
+import pika
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PublishNacked(Exception):
+    pass
+
+
+def connection_parameters():
+    """
+    Returns the pika ConnectionParameters for the broker in the settings
+    """
+    from django.conf import settings
+    return pika.ConnectionParameters(
+        host=settings.RABBITMQ_HOST,
+        port=getattr(settings, "RABBITMQ_PORT", 5672),
+        virtual_host=getattr(settings, "RABBITMQ_VHOST", "/"),
+        credentials=pika.PlainCredentials(username=settings.RABBITMQ_USER, password=settings.RABBITMQ_PASSWORD),
+        connection_attempts=getattr(settings, "RABBITMQ_CONNECTION_ATTEMPTS", 3),
+        retry_delay=getattr(settings, "RABBITMQ_RETRY_DELAY", 3)
+    )
+
+
+class Publisher(object):
+    """
+    Long-lived publisher to a RabbitMQ topic exchange, shared by every thread in the process.
+    pika connections and channels can't be used from more than one thread, so a single thread owns the connection and
+    its channel and runs the pika ioloop.  publish() can be called from any thread: it queues the message, wakes the
+    ioloop with add_callback_threadsafe and waits for the broker to confirm it.  Publishes are pipelined, so many can be
+    waiting for their confirm at once and the broker can acknowledge a batch of them with one multiple=True ack.
+    If the connection drops it is opened again after reconnect_delay seconds, and anything that had not been confirmed
+    is published again, so a message can occasionally be delivered twice.
+    """
+    def __init__(self, exchange, parameters=connection_parameters, reconnect_delay=3, publish_timeout=30):
+        """
+        Initialise
+        :param exchange: name of the topic exchange to publish to. It is declared durable when we connect.
+        :param parameters: callable that returns pika ConnectionParameters
+        :param reconnect_delay: seconds to wait before connecting again after the connection is lost
+        :param publish_timeout: seconds that publish() waits for the broker to confirm a message
+        """
+        self.exchange = exchange
+        self.parameters = parameters
+        self.reconnect_delay = reconnect_delay
+        self.publish_timeout = publish_timeout
+        self._lock = Lock()
+        self._outbox = deque()
+        #delivery tag -> (routing key, body, future) for messages waiting for a confirm. Only used on the ioloop thread.
+        self._pending = {}
+        self._next_tag = 1
+        self._connection = None
+        self._channel = None
+        self._thread = None
+        self._ready = Event()
+
+    def start(self):
+        """
+        Starts the publisher thread, if it isn't already running
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name="rabbitmq-publisher", daemon=True)
+                self._thread.start()
+
+    def wait_connected(self, timeout):
+        """
+        Starts the publisher and waits for it to connect
+        :param timeout: seconds to wait
+        :return: None. Raises ConnectionError if we did not connect in time.
+        """
+        self.start()
+        if not self._ready.wait(timeout):
+            raise ConnectionError("Could not connect to RabbitMQ to publish to {0}".format(self.exchange))
+
+    def submit(self, routing_key, body):
+        """
+        Queues a message for publishing without waiting for it
+        :param routing_key: routing key string
+        :param body: message body as bytes
+        :return: a Future, that completes when the broker has confirmed the message or fails with PublishNacked
+        """
+        future = Future()
+        with self._lock:
+            self._outbox.append((routing_key, body, future))
+            connection = self._connection
+        self.start()
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._flush)
+            except Exception as e:
+                #the connection is going away, the message will be sent when it is re-opened
+                logger.debug("Could not wake the publisher: {0}".format(e))
+        return future
+
+    def publish(self, routing_key, body):
+        """
+        Publishes a message and waits for the broker to confirm it
+        :param routing_key: routing key string
+        :param body: message body as bytes
+        :return: None. Raises PublishNacked if the broker refused the message, or concurrent.futures.TimeoutError if it
+        was not confirmed within publish_timeout seconds.
+        """
+        self.submit(routing_key, body).result(self.publish_timeout)
+
+    def _run(self):
+        while True:
+            connection = pika.SelectConnection(self.parameters(),
+                                               on_open_callback=self._on_open,
+                                               on_open_error_callback=self._on_closed,
+                                               on_close_callback=self._on_closed)
+            with self._lock:
+                self._connection = connection
+            connection.ioloop.start()
+            logger.warning("Publisher connection to RabbitMQ closed, reconnecting in {0}s".format(self.reconnect_delay))
+            time.sleep(self.reconnect_delay)
+
+    def _on_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.exchange_declare(self.exchange, exchange_type="topic", durable=True,
+                                 callback=lambda frame: self._on_exchange_declared(channel))
+
+    def _on_exchange_declared(self, channel):
+        channel.confirm_delivery(self._on_confirm)
+        #delivery tags count up from 1 on every new channel
+        self._next_tag = 1
+        self._channel = channel
+        logger.info("Publisher connected to RabbitMQ exchange {0}".format(self.exchange))
+        self._ready.set()
+        self._flush()
+
+    def _flush(self):
+        """
+        Publishes everything in the outbox. Runs on the ioloop thread.
+        """
+        if self._channel is None or not self._channel.is_open:
+            return
+        while True:
+            with self._lock:
+                if len(self._outbox) == 0:
+                    return
+                routing_key, body, future = self._outbox.popleft()
+            self._channel.basic_publish(self.exchange, routing_key, body)
+            self._pending[self._next_tag] = (routing_key, body, future)
+            self._next_tag += 1
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = sorted([tag for tag in self._pending.keys() if tag <= method.delivery_tag])
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._pending else []
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        for tag in tags:
+            routing_key, body, future = self._pending.pop(tag)
+            if acked:
+                future.set_result(None)
+            else:
+                future.set_exception(PublishNacked("Broker refused message to {0} with routing key {1}".format(self.exchange, routing_key)))
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning("Publisher channel closed: {0}".format(reason))
+        self._channel = None
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _on_closed(self, connection, error=None):
+        logger.warning("Publisher connection closed: {0}".format(error))
+        self._ready.clear()
+        self._channel = None
+        #anything that wasn't confirmed goes out again, in the same order, once we have reconnected
+        with self._lock:
+            for tag in sorted(self._pending.keys(), reverse=True):
+                self._outbox.appendleft(self._pending[tag])
+            self._pending.clear()
+            self._connection = None
+        connection.ioloop.stop()
+
+
+_publishers = {}
+_publishers_lock = Lock()
+
+
+def get_publisher():
+    """
+    Returns the process-wide Publisher for RABBITMQ_EXCHANGE
+    """
+    from django.conf import settings
+    with _publishers_lock:
+        if settings.RABBITMQ_EXCHANGE not in _publishers:
+            _publishers[settings.RABBITMQ_EXCHANGE] = Publisher(settings.RABBITMQ_EXCHANGE,
+                                                                reconnect_delay=getattr(settings, "RABBITMQ_RETRY_DELAY", 3),
+                                                                publish_timeout=getattr(settings, "RABBITMQ_PUBLISH_TIMEOUT", 30))
+        return _publishers[settings.RABBITMQ_EXCHANGE]
@@ -0,0 +1,67 @@
+from django.test import SimpleTestCase
+from mock import MagicMock
+import pika
+
+
+class TestPublisher(SimpleTestCase):
+    """
+    These drive the ioloop callbacks directly, with a fake channel, rather than connecting to a broker
+    """
+    @staticmethod
+    def confirm(delivery_tag, multiple=False, ack=True):
+        method = pika.spec.Basic.Ack(delivery_tag=delivery_tag, multiple=multiple) if ack else \
+            pika.spec.Basic.Nack(delivery_tag=delivery_tag, multiple=multiple)
+        return MagicMock(method=method)
+
+    def make_publisher(self):
+        from rabbitmq.publisher import Publisher
+        publisher = Publisher("test-exchange")
+        publisher.start = MagicMock()
+        channel = MagicMock(is_open=True)
+        publisher._on_exchange_declared(channel)
+        return publisher, channel
+
+    def test_publish_and_confirm(self):
+        """
+        queued messages should be published in order and completed by the broker's confirms, including a multiple ack
+        :return:
+        """
+        from rabbitmq.publisher import PublishNacked
+        publisher, channel = self.make_publisher()
+        channel.confirm_delivery.assert_called_once_with(publisher._on_confirm)
+
+        futures = [publisher.submit("atomresponder.atom.video-upload", "message {0}".format(n).encode("UTF-8")) for n in range(4)]
+        publisher._flush()
+        self.assertEqual([c[0][2] for c in channel.basic_publish.call_args_list], [b"message 0", b"message 1", b"message 2", b"message 3"])
+        self.assertEqual(sorted(publisher._pending.keys()), [1, 2, 3, 4])
+
+        publisher._on_confirm(self.confirm(3, multiple=True))
+        self.assertTrue(all([f.done() for f in futures[:3]]))
+        self.assertFalse(futures[3].done())
+
+        publisher._on_confirm(self.confirm(4, ack=False))
+        with self.assertRaises(PublishNacked):
+            futures[3].result(0)
+        self.assertEqual(publisher._pending, {})
+
+    def test_reconnect(self):
+        """
+        messages that were not confirmed when the connection dropped should be published again, in order, on a new channel
+        :return:
+        """
+        publisher, channel = self.make_publisher()
+        futures = [publisher.submit("key", "message {0}".format(n).encode("UTF-8")) for n in range(3)]
+        publisher._flush()
+        publisher._on_confirm(self.confirm(1))
+        later = publisher.submit("key", b"message 3")
+
+        connection = MagicMock()
+        publisher._on_closed(connection, "connection reset")
+        connection.ioloop.stop.assert_called_once()
+        self.assertFalse(publisher._ready.is_set())
+
+        new_channel = MagicMock(is_open=True)
+        publisher._on_exchange_declared(new_channel)
+        self.assertEqual([c[0][2] for c in new_channel.basic_publish.call_args_list], [b"message 1", b"message 2", b"message 3"])
+        publisher._on_confirm(self.confirm(3, multiple=True))
+        self.assertTrue(futures[0].done() and futures[1].done() and futures[2].done() and later.done())
@@ -0,0 +1,27 @@
+from django.test import TestCase
+from rabbitmq.VidispineItemMessageProcessor import VidispineItemMessageProcessor
+from mock import MagicMock, patch
+
+
+class TestVidispineItemMessageProcessor(TestCase):
+    def test_item_deleted(self):
+        """
+        valid_message_receive should forget the mappings to an item that has been deleted
+        :return:
+        """
+        mock_mapping = MagicMock()
+        body = {"field": [{"key": "itemId", "value": "VX-1234"}, {"key": "action", "value": "DELETE"}]}
+
+        with patch("rabbitmq.VidispineItemMessageProcessor.get_item_mapping", return_value=mock_mapping):
+            VidispineItemMessageProcessor().valid_message_receive("vidispine-events", "vidispine.item.delete", 1, body)
+            mock_mapping.forget_item.assert_called_once_with("VX-1234")
+
+    def test_no_item_id(self):
+        """
+        valid_message_receive should ignore a notification without an item ID
+        :return:
+        """
+        mock_mapping = MagicMock()
+        with patch("rabbitmq.VidispineItemMessageProcessor.get_item_mapping", return_value=mock_mapping):
+            VidispineItemMessageProcessor().valid_message_receive("vidispine-events", "vidispine.item.delete", 1, {"field": []})
+            mock_mapping.forget_item.assert_not_called()
@@ -63,3 +63,23 @@ class TestVidispineMessageProcessor(TestCase):
                 self.assertEqual(after_record.status,'FINISHED')
                 toTest.handle_failed_job.assert_not_called()
                 mock_check_proxy.assert_called_once_with(before_record.item_id)
+
+    def test_process_notification_cleans_up(self):
+        """
+        valid_message_receive should tell the storage manager that the job has ended, so that its media can be removed
+        :return:
+        """
+        from rabbitmq.job_notification import JobNotification
+
+        content = self._get_test_data("samplemessage.json")
+        parsed_content = json.loads(content)
+        toTest = VidispineMessageProcessor()
+        toTest.handle_failed_job = MagicMock()
+        mock_storage = MagicMock()
+        with patch("rabbitmq.VidispineMessageProcessor.get_storage_manager", return_value=mock_storage):
+            with patch("rabbitmq.VidispineMessageProcessor.check_for_broken_proxy", return_value=(False, "VX-999")):
+                toTest.valid_message_receive("example_exchange","vidispine.job.essence_version.stop","1",parsed_content)
+                mock_storage.job_completed.assert_called_once()
+                completed_job = mock_storage.job_completed.call_args[0][0]
+                self.assertEqual(completed_job.job_id, JobNotification(parsed_content).jobId)
+                self.assertEqual(completed_job.status, 'FINISHED')
@@ -170,12 +170,47 @@ STATIC_ROOT = 'static/'
 VIDISPINE_URL=os.environ.get("VIDISPINE_URL","http://vidispine.local:80")
 VIDISPINE_USERNAME=os.environ.get("VIDISPINE_USER","admin")
 VIDISPINE_PASSWORD=os.environ.get("VIDISPINE_PASSWORD","admin")
+# seconds to wait for Vidispine to answer the REST calls that we make directly, e.g. item lookups, before giving up
+VIDISPINE_REQUEST_TIMEOUT=int(os.environ.get("VIDISPINE_REQUEST_TIMEOUT", "30"))
 # this is the location that Vidispine can send messages to us
 VIDISPINE_CALLBACK_URL=os.environ.get("VIDISPINE_CALLBACK_URL", None)
 
 ### Local cache locations
 ATOM_RESPONDER_DOWNLOAD_PATH=os.environ.get("LOCAL_DOWNLOAD_PATH", "/path/to/download")
 ATOM_RESPONDER_DOWNLOAD_BUCKET=os.environ.get("DOWNLOAD_BUCKET", "bucketname")
+# downloads are fetched as byte ranges of this size, this many at a time
+ATOM_RESPONDER_DOWNLOAD_PART_SIZE=int(os.environ.get("ATOM_RESPONDER_DOWNLOAD_PART_SIZE", str(16*1024*1024)))
+ATOM_RESPONDER_DOWNLOAD_CONCURRENCY=int(os.environ.get("ATOM_RESPONDER_DOWNLOAD_CONCURRENCY", "4"))
+# check downloads against the S3 ETag. Objects encrypted with SSE-KMS are never checked, because their ETag is not an MD5.
+ATOM_RESPONDER_VERIFY_DOWNLOADS=os.environ.get("ATOM_RESPONDER_VERIFY_DOWNLOADS", "true").lower() == "true"
+# downloaded media is kept in a cache keyed on bucket, key and ETag, so that an unchanged object is not downloaded twice.
+# The cache must be on the same filesystem as LOCAL_DOWNLOAD_PATH, and is off if the size limit is 0.
+ATOM_RESPONDER_DOWNLOAD_CACHE_PATH=os.environ.get("ATOM_RESPONDER_DOWNLOAD_CACHE_PATH", os.path.join(ATOM_RESPONDER_DOWNLOAD_PATH, ".cache"))
+ATOM_RESPONDER_DOWNLOAD_CACHE_MAX_BYTES=int(os.environ.get("ATOM_RESPONDER_DOWNLOAD_CACHE_MAX_BYTES", str(50*1024*1024*1024)))
+# downloaded media is deleted once Vidispine has imported it. Before each download, files that are no longer needed are
+# evicted to keep the volume below the high-water mark (a fraction of its size) with the reserve still free; if that isn't
+# enough the download waits up to ATOM_RESPONDER_DOWNLOAD_SPACE_WAIT seconds for imports to finish. After that a staged
+# ingest is retried later, and an import straight from the shard carries on waiting so that the upload is never skipped.
+ATOM_RESPONDER_DOWNLOAD_HIGH_WATER_MARK=float(os.environ.get("ATOM_RESPONDER_DOWNLOAD_HIGH_WATER_MARK", "0.85"))
+ATOM_RESPONDER_DOWNLOAD_RESERVE_BYTES=int(os.environ.get("ATOM_RESPONDER_DOWNLOAD_RESERVE_BYTES", str(1024*1024*1024)))
+ATOM_RESPONDER_DOWNLOAD_SPACE_WAIT=int(os.environ.get("ATOM_RESPONDER_DOWNLOAD_SPACE_WAIT", "900"))
+# a download that never got as far as an import can be evicted after this many seconds
+ATOM_RESPONDER_DOWNLOAD_ORPHAN_AGE=int(os.environ.get("ATOM_RESPONDER_DOWNLOAD_ORPHAN_AGE", "86400"))
+# how many atom ID -> Vidispine item ID mappings to keep in memory. They are all kept in the database as well.
+ATOM_RESPONDER_ITEM_MAPPING_CACHE_SIZE=int(os.environ.get("ATOM_RESPONDER_ITEM_MAPPING_CACHE_SIZE", "10000"))
+# a mapping held in memory is checked against the database again after this many seconds, because deleted items are
+# removed from the database by the rabbitmq responder, which can't reach this process's memory
+ATOM_RESPONDER_ITEM_MAPPING_VERIFY_AFTER=int(os.environ.get("ATOM_RESPONDER_ITEM_MAPPING_VERIFY_AFTER", "60"))
+# "fields" looks up items by fetching only the few metadata fields that we need, "full" populates the whole item
+ATOM_RESPONDER_ITEM_LOOKUP=os.environ.get("ATOM_RESPONDER_ITEM_LOOKUP", "fields")
+# "download" fetches the media here and gives Vidispine a file:// URI, "presigned" lets Vidispine pull it straight from a
+# presigned S3 URL, and "auto" tries presigned first and downloads instead if Vidispine fails to import it
+ATOM_RESPONDER_INGEST_STRATEGY=os.environ.get("ATOM_RESPONDER_INGEST_STRATEGY", "download")
+# presigned URLs last long enough to read the object at this many bytes per second, plus the margin, and never less than the
+# minimum. They can't outlast the role session that signs them, so this is capped at AWS_ROLE_MAX_SESSION_DURATION.
+ATOM_RESPONDER_PRESIGNED_URL_MIN_EXPIRY=int(os.environ.get("ATOM_RESPONDER_PRESIGNED_URL_MIN_EXPIRY", "3600"))
+ATOM_RESPONDER_PRESIGNED_URL_MARGIN=int(os.environ.get("ATOM_RESPONDER_PRESIGNED_URL_MARGIN", "1800"))
+ATOM_RESPONDER_PRESIGNED_URL_BYTES_PER_SECOND=int(os.environ.get("ATOM_RESPONDER_PRESIGNED_URL_BYTES_PER_SECOND", str(2*1024*1024)))
 
 ### Connection to Kinesis
 INCOMING_KINESIS_STREAM=os.environ.get("INCOMING_KINESIS_STREAM","instream") #Kinesis stream we publish project updates to
@@ -183,12 +218,69 @@ OUTGOING_KINESIS_STREAM=os.environ.get("OUTGOING_KINESIS_STREAM","outstream") #K
 MEDIA_ATOM_ROLE_ARN=os.environ.get("MEDIA_ATOM_ROLE_ARN","somearn")     #Role to use when connecting to the stream
 MEDIA_ATOM_AWS_ACCESS_KEY_ID=os.environ.get("MEDIA_ATOM_AWS_ACCESS_KEY_ID","somekey")   #AWS creds to use when assuming the role
 MEDIA_ATOM_AWS_SECRET_ACCESS_KEY=os.environ.get("MEDIA_ATOM_AWS_SECRET_ACCESS_KEY","somesecret")
+# longest session, in seconds, that we may ask for when assuming the role. This can't be more than the role's own maximum
+# session duration, and limits how long a presigned URL can last because the URL stops working when its session ends.
+AWS_ROLE_MAX_SESSION_DURATION=int(os.environ.get("AWS_ROLE_MAX_SESSION_DURATION", "3600"))
 SESSION_NAME="pluto-atomresponder"  #Session description for temporary credentials associated with role
+# 'record' writes every state change of every message to the tracker table, 'batched' writes progress out in bulk
+KINESIS_CHECKPOINT_MODE=os.environ.get("KINESIS_CHECKPOINT_MODE", "record")
+# in batched mode, flush after this many records or seconds instead of once per get_records batch
+KINESIS_CHECKPOINT_EVERY_RECORDS=int(os.environ["KINESIS_CHECKPOINT_EVERY_RECORDS"]) if "KINESIS_CHECKPOINT_EVERY_RECORDS" in os.environ else None
+KINESIS_CHECKPOINT_EVERY_SECONDS=float(os.environ["KINESIS_CHECKPOINT_EVERY_SECONDS"]) if "KINESIS_CHECKPOINT_EVERY_SECONDS" in os.environ else None
+# largest get_records batch to ask for when catching up, and the range of sleeps to use when a shard is idle
+KINESIS_MAX_BATCH_LIMIT=int(os.environ.get("KINESIS_MAX_BATCH_LIMIT", "10000"))
+KINESIS_MIN_IDLE_DELAY=float(os.environ.get("KINESIS_MIN_IDLE_DELAY", "1"))
+KINESIS_MAX_IDLE_DELAY=float(os.environ.get("KINESIS_MAX_IDLE_DELAY", "10"))
+# number of get_records batches to read ahead of the one being processed
+KINESIS_PREFETCH_BATCHES=int(os.environ.get("KINESIS_PREFETCH_BATCHES", "1"))
+# get_records calls are paced to stay inside these limits. The per-shard defaults are the Kinesis limits; the stream-wide
+# ones are off unless set, and are useful when other consumers share the stream's read capacity
+KINESIS_SHARD_READS_PER_SECOND=float(os.environ.get("KINESIS_SHARD_READS_PER_SECOND", "5"))
+KINESIS_SHARD_READ_BYTES_PER_SECOND=int(os.environ.get("KINESIS_SHARD_READ_BYTES_PER_SECOND", str(2*1024*1024)))
+KINESIS_STREAM_READS_PER_SECOND=float(os.environ["KINESIS_STREAM_READS_PER_SECOND"]) if "KINESIS_STREAM_READS_PER_SECOND" in os.environ else None
+KINESIS_STREAM_READ_BYTES_PER_SECOND=int(os.environ["KINESIS_STREAM_READ_BYTES_PER_SECOND"]) if "KINESIS_STREAM_READ_BYTES_PER_SECOND" in os.environ else None
+# number of records to process in parallel on each shard. Records for the same atom are always processed in order.
+# KINESIS_SHARD_WORKER_POOL_SIZES overrides this for individual shards, in the form "shardId-000000000000=4,shardId-000000000001=2"
+KINESIS_WORKER_POOL_SIZE=int(os.environ.get("KINESIS_WORKER_POOL_SIZE", "1"))
+KINESIS_SHARD_WORKER_POOL_SIZES={entry.split("=")[0]: int(entry.split("=")[1]) for entry in os.environ.get("KINESIS_SHARD_WORKER_POOL_SIZES", "").split(",") if "=" in entry}
+# set KINESIS_USE_LEASES to share the stream's shards between several replicas, via leases in the database. This works
+# with either KINESIS_ENGINE.
+KINESIS_USE_LEASES=os.environ.get("KINESIS_USE_LEASES", "false").lower()=="true"
+KINESIS_LEASE_DURATION=int(os.environ.get("KINESIS_LEASE_DURATION", "30"))
+# how often to re-describe the stream to pick up resharding
+KINESIS_RESHARD_CHECK_INTERVAL=int(os.environ.get("KINESIS_RESHARD_CHECK_INTERVAL", "300"))
+# "threads" runs a thread per shard; "asyncio" runs every shard from one event loop, with process() and the database
+# work on a pool of KINESIS_ASYNC_WORKERS threads and the Kinesis calls on KINESIS_ASYNC_IO_WORKERS threads
+KINESIS_ENGINE=os.environ.get("KINESIS_ENGINE", "threads")
+KINESIS_ASYNC_WORKERS=int(os.environ.get("KINESIS_ASYNC_WORKERS", "8"))
+KINESIS_ASYNC_IO_WORKERS=int(os.environ.get("KINESIS_ASYNC_IO_WORKERS", "4"))
+# where to start reading a shard that has no checkpoint yet: TRIM_HORIZON, LATEST or AT_TIMESTAMP (which uses KINESIS_INITIAL_TIMESTAMP, in UTC)
+KINESIS_INITIAL_POSITION=os.environ.get("KINESIS_INITIAL_POSITION", "TRIM_HORIZON")
+KINESIS_INITIAL_TIMESTAMP=os.environ.get("KINESIS_INITIAL_TIMESTAMP")
+# if set, a shard with no checkpoint never starts further back than this many seconds ago
+KINESIS_SKIP_RECORDS_OLDER_THAN=int(os.environ["KINESIS_SKIP_RECORDS_OLDER_THAN"]) if "KINESIS_SKIP_RECORDS_OLDER_THAN" in os.environ else None
 
 ### Ingest parameters
 ATOM_RESPONDER_SHAPE_TAG=os.environ.get("ATOM_RESPONDER_SHAPE_TAG", "lowres")
 ATOM_RESPONDER_IMPORT_PRIORITY=os.environ.get("ATOM_RESPONDER_IMPORT_PRIORITY", "HIGH")
 MAX_IMPORT_RETRIES = os.environ.get("MAX_IMPORT_RETRIES", 10)
+# repeats of a media message (same content, or same atomId and s3Key) within this many seconds of it being processed are
+# dropped. Set to 0 to turn this off.
+ATOM_RESPONDER_DEDUPE_TTL=int(os.environ.get("ATOM_RESPONDER_DEDUPE_TTL", "300"))
+ATOM_RESPONDER_DEDUPE_MAX_ENTRIES=int(os.environ.get("ATOM_RESPONDER_DEDUPE_MAX_ENTRIES", "10000"))
+# set ATOM_RESPONDER_STAGED_INGEST to run the download and import for media messages on a separate pool of
+# ATOM_RESPONDER_INGEST_WORKERS threads, so that they don't hold up the shard. The shard waits when the workers and a
+# queue of ATOM_RESPONDER_INGEST_QUEUE_SIZE more are all busy.
+ATOM_RESPONDER_STAGED_INGEST=os.environ.get("ATOM_RESPONDER_STAGED_INGEST", "false").lower()=="true"
+ATOM_RESPONDER_INGEST_WORKERS=int(os.environ.get("ATOM_RESPONDER_INGEST_WORKERS", "2"))
+ATOM_RESPONDER_INGEST_QUEUE_SIZE=int(os.environ.get("ATOM_RESPONDER_INGEST_QUEUE_SIZE", "4"))
+# a staged ingest that fails is retried after ATOM_RESPONDER_INGEST_RETRY_DELAY seconds, doubling each time, for up to
+# ATOM_RESPONDER_INGEST_MAX_ATTEMPTS attempts. One left running by a process that has not updated it for
+# ATOM_RESPONDER_INGEST_STALE_AFTER seconds is taken over. Both are checked every ATOM_RESPONDER_INGEST_SWEEP_INTERVAL seconds.
+ATOM_RESPONDER_INGEST_MAX_ATTEMPTS=int(os.environ.get("ATOM_RESPONDER_INGEST_MAX_ATTEMPTS", "5"))
+ATOM_RESPONDER_INGEST_RETRY_DELAY=int(os.environ.get("ATOM_RESPONDER_INGEST_RETRY_DELAY", "60"))
+ATOM_RESPONDER_INGEST_STALE_AFTER=int(os.environ.get("ATOM_RESPONDER_INGEST_STALE_AFTER", "600"))
+ATOM_RESPONDER_INGEST_SWEEP_INTERVAL=int(os.environ.get("ATOM_RESPONDER_INGEST_SWEEP_INTERVAL", "60"))
 
 ### Connection to media atom tool, for resending
 ATOM_TOOL_HOST=os.environ.get("ATOM_TOOL_HOST", 'https://atomtool')
@@ -202,3 +294,5 @@ RABBITMQ_VHOST = os.environ.get("RABBITMQ_VHOST", "prexit")
 RABBITMQ_EXCHANGE = 'pluto-atomresponder'
 RABBITMQ_USER = os.environ.get("RABBITMQ_USER","pluto-ng")
 RABBITMQ_PASSWORD = os.environ.get("RABBITMQ_PASSWD","")
+# how long to wait for the broker to confirm a message that we publish
+RABBITMQ_PUBLISH_TIMEOUT = int(os.environ.get("RABBITMQ_PUBLISH_TIMEOUT", "30"))